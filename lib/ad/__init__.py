@@ -9,7 +9,7 @@
 from ad.core.exception import *
 from ad.core.constant import *
 
-from ad.core.client import Client
+from ad.core.client import Client, AsyncClient
 from ad.core.creds import Creds
 from ad.core.locate import Locator
 from ad.core.object import activate
@@ -7,6 +7,11 @@
 # "AUTHORS" for a complete overview.
 
 import re
+import sys
+import time
+import select
+import Queue
+import threading
 import dns
 import dns.resolver
 import dns.exception
@@ -19,6 +24,7 @@ from ad.core.exception import Error as ADError
 from ad.core.object import factory, instance
 from ad.core.creds import Creds
 from ad.core.locate import Locator
+from ad.core.pool import ConnectionPool
 from ad.core.constant import LDAP_PORT, GC_PORT
 from ad.protocol import krb5
 from ad.util import compat
@@ -35,11 +41,21 @@ class Client(object):
     _sizelimit = 0
     _referrals = False
     _pagesize = 500
+    _prefetch = 0
+    _poolmin = 0
+    _poolmax = 8
+    _poolidle = 300
+    _retries = 2
+    _backoff = 0.5
+    _max_backoff = 4.0
+    _idempotent = ('search_s', 'compare_s')
 
     def __init__(self, domain):
         """Constructor."""
         self.m_locator = None
-        self.m_connections = None
+        self.m_lock = threading.Lock()
+        self.m_pools = {}
+        self.m_servers = {}
         self.m_naming_contexts = None
         self.m_domain = self.dn_from_domain_name(domain)
         self.m_forest = None
@@ -96,6 +112,50 @@ class Client(object):
             ld.sasl_interactive_bind_s('', sasl)
         return ld
 
+    def _connect(self, uri, servers, bind=True):
+        """Open a new LDAP connection to `uri', which contains the servers
+        `servers', and report the outcome to the health registry of our
+        locator.
+
+        The connection is attributed to the first server in the list. This is
+        the server that is used, unless it is unavailable.
+        """
+        health = self._locator().health()
+        begin = time.time()
+        try:
+            conn = self._create_ldap_connection(uri, bind)
+        except ldap.SERVER_DOWN:
+            for server in servers:
+                health.failure(server)
+            raise
+        if bind:
+            health.success(servers[0], time.time() - begin)
+        self.m_servers[conn] = servers[0]
+        return conn
+
+    _server_errors = (ldap.SERVER_DOWN, ldap.TIMEOUT, ldap.UNAVAILABLE,
+                      ldap.BUSY)
+
+    def _timed(self, conn, method, *args):
+        """Call `method' on the LDAP connection `conn' with arguments
+        `args', and report its latency or failure to the health registry
+        of our locator."""
+        server = self.m_servers.get(conn)
+        if server is None:
+            return getattr(conn, method)(*args)
+        health = self._locator().health()
+        begin = time.time()
+        try:
+            result = getattr(conn, method)(*args)
+        except self._server_errors:
+            health.failure(server)
+            raise
+        except ldap.LDAPError:
+            health.success(server, time.time() - begin)
+            raise
+        health.success(server, time.time() - begin)
+        return result
+
     def domain_name_from_dn(self, dn):
         """Given a DN, return a domain."""
         parts = compat.str2dn(dn)
@@ -122,7 +182,7 @@ class Client(object):
         locator = self._locator()
         servers = locator.locate_many(self.domain())
         uri = self._create_ldap_uri(servers)
-        conn = self._create_ldap_connection(uri, bind=False)
+        conn = self._connect(uri, servers, bind=False)
         try:
             attrs = ('rootDomainNamingContext', 'schemaNamingContext',
                      'configurationNamingContext')
@@ -175,7 +235,7 @@ class Client(object):
         locator = self._locator()
         servers = locator.locate_many(self.domain())
         uri = self._create_ldap_uri(servers)
-        conn = self._create_ldap_connection(uri)
+        conn = self._connect(uri, servers)
         base = 'cn=Partitions,%s' % self.configuration_base()
         filter = '(objectClass=crossRef)'
         try:
@@ -220,44 +280,143 @@ class Client(object):
                 naming_context = nc
         return naming_context
     
-    def _ldap_connection(self, base, server=None, scheme=None):
-        """Return the (cached) LDAP connection for a naming naming_context."""
+    def _ldap_pool(self, base, server=None, scheme=None):
+        """Return the LDAP connection pool for a naming naming_context."""
         naming_context = self._resolve_naming_context(base)
         scheme = self._fixup_scheme(scheme)
-        if self.m_connections is None:
-            self.m_connections = {}
         key = (naming_context, server, scheme)
-        if key not in self.m_connections:
-            locator = self._locator()
-            if naming_context == '':
-                assert server != None
-                uri = self._create_ldap_uri([server])
-                bind = False  # No need to bind for rootDSE
+        self.m_lock.acquire()
+        try:
+            pool = self.m_pools.get(key)
+            if pool is None:
+                connect = lambda: self._open_ldap_connection(naming_context,
+                                                             server, scheme)
+                pool = ConnectionPool(connect, self._close_ldap_connection,
+                                      self._check_ldap_connection,
+                                      self._poolmin, self._poolmax,
+                                      self._poolidle)
+                self.m_pools[key] = pool
+        finally:
+            self.m_lock.release()
+        pool.fill()
+        return pool
+
+    def _open_ldap_connection(self, naming_context, server, scheme):
+        """Open a new LDAP connection for a naming naming_context."""
+        locator = self._locator()
+        if naming_context == '':
+            assert server != None
+            servers = [server]
+            uri = self._create_ldap_uri(servers)
+            bind = False  # No need to bind for rootDSE
+        else:
+            domain = self.domain_name_from_dn(naming_context)
+            if scheme == 'gc':
+                role = 'gc'
+            elif scheme == 'ldap':
+                role = 'dc'
+            if server is None:
+                servers = locator.locate_many(domain, role=role)
+                uri = self._create_ldap_uri(servers, scheme)
             else:
-                domain = self.domain_name_from_dn(naming_context)
-                if scheme == 'gc':
-                    role = 'gc'
-                elif scheme == 'ldap':
-                    role = 'dc'
-                if server is None:
-                    servers = locator.locate_many(domain, role=role)
-                    uri = self._create_ldap_uri(servers, scheme)
-                else:
-                    if not locator.check_domain_controller(server, domain, role):
-                        raise ADError, 'Unsuitable server provided.'
-                    uri = self._create_ldap_uri([server], scheme)
-                creds = self._credentials()
-                creds._resolve_servers_for_domain(domain)
-                bind = True
-            conn = self._create_ldap_connection(uri, bind)
-            self.m_connections[key] = conn
-        return self.m_connections[key]
+                if not locator.check_domain_controller(server, domain, role):
+                    raise ADError, 'Unsuitable server provided.'
+                servers = [server]
+                uri = self._create_ldap_uri(servers, scheme)
+            creds = self._credentials()
+            creds._resolve_servers_for_domain(domain)
+            bind = True
+        return self._connect(uri, servers, bind)
+
+    def _close_ldap_connection(self, conn):
+        """Close the LDAP connection `conn'."""
+        self.m_servers.pop(conn, None)
+        conn.unbind_s()
+
+    def _check_ldap_connection(self, conn):
+        """Check that the LDAP connection `conn' is still alive by reading
+        the rootDSE."""
+        conn.search_s('', ldap.SCOPE_BASE, '(objectClass=*)', ['1.1'])
+        return True
+
+    def _pooled(self, pool, method, *args):
+        """Check out a connection from `pool', call `method' on it with
+        arguments `args' and return the connection to the pool.
+
+        A connection that fails with a server error is closed. Idempotent
+        operations are then retried on a new connection, up to `_retries'
+        times with exponential backoff. If the server is down, the new
+        connection goes to the next available domain controller.
+        """
+        attempt = 0
+        while True:
+            conn = self._checkout(pool)
+            error = None
+            try:
+                try:
+                    return self._timed(conn, method, *args)
+                except self._server_errors:
+                    error = sys.exc_info()
+            finally:
+                if error is None:
+                    pool.checkin(conn)
+            self._connection_failed(pool, conn, error[1])
+            if method not in self._idempotent or attempt == self._retries:
+                raise error[0], error[1], error[2]
+            time.sleep(self._delay(attempt))
+            attempt += 1
+
+    def _checkout(self, pool):
+        """Check out a connection from `pool'. If a new connection cannot be
+        opened, this is retried up to `_retries' times with exponential
+        backoff."""
+        attempt = 0
+        while True:
+            try:
+                return pool.checkout()
+            except self._server_errors:
+                if attempt == self._retries:
+                    raise
+            time.sleep(self._delay(attempt))
+            attempt += 1
+
+    def _delay(self, attempt):
+        """Return the backoff delay before retry number `attempt'."""
+        return min(self._backoff * 2 ** attempt, self._max_backoff)
+
+    def _connection_failed(self, pool, conn, error):
+        """Close the connection `conn' from `pool', which failed with the
+        server error `error'. If the server is down, it is marked as
+        unavailable in the health registry of our locator, and the other
+        idle connections to it are closed as well."""
+        server = self.m_servers.get(conn)
+        pool.checkin(conn, discard=True)
+        if server is None or not isinstance(error, ldap.SERVER_DOWN):
+            return
+        self._locator().health().down(server)
+        pool.purge(lambda conn: self.m_servers.get(conn) == server)
+
+    def pool_stats(self):
+        """Return a dictionary with the statistics of the LDAP connection
+        pools. The keys are (naming_context, server, scheme) tuples and the
+        values are the statistics returned by ConnectionPool.stats()."""
+        self.m_lock.acquire()
+        try:
+            pools = self.m_pools.items()
+        finally:
+            self.m_lock.release()
+        return dict([ (key, pool.stats()) for key, pool in pools ])
 
     def close(self):
         """Close any active LDAP connection."""
-        for conn in self.m_connections.values():
-            conn.unbind_s()
-        self.m_connections = None
+        self.m_lock.acquire()
+        try:
+            pools = self.m_pools.values()
+            self.m_pools = {}
+        finally:
+            self.m_lock.release()
+        for pool in pools:
+            pool.close()
 
     def _remove_empty_search_entries(self, result):
         """Remove empty search entries from a search result."""
@@ -266,14 +425,17 @@ class Client(object):
 
     re_range = re.compile('([^;]+);[Rr]ange=([0-9]+)(?:-([0-9]+|\\*))?')
 
-    def _retrieve_all_ranges(self, dn, key, attrs):
-        """Retrieve all ranges for a multivalued attributed."""
+    def _retrieve_all_ranges(self, dn, key, attrs, conn=None):
+        """Retrieve all ranges for a multivalued attributed. If `conn' is
+        given, the ranges are retrieved on that connection, otherwise on a
+        connection from the pool for `dn'."""
         assert key in attrs
         mobj = self.re_range.match(key)
         assert mobj is not None
         type, lo, hi = mobj.groups()
         values = attrs[key]
-        conn = self._ldap_connection(dn)
+        if conn is None:
+            pool = self._ldap_pool(dn)
         base = self._resolve_naming_context(dn)
         while hi != '*':
             try:
@@ -283,7 +445,12 @@ class Client(object):
                 raise ADError, m
             rqattrs = ('%s;range=%s-*' % (type, hi+1),)
             filter = '(distinguishedName=%s)' % dn
-            result = conn.search_s(base, ldap.SCOPE_SUBTREE, filter, rqattrs)
+            if conn is None:
+                result = self._pooled(pool, 'search_s', base,
+                                      ldap.SCOPE_SUBTREE, filter, rqattrs)
+            else:
+                result = self._timed(conn, 'search_s', base,
+                                     ldap.SCOPE_SUBTREE, filter, rqattrs)
             if not result:
                 # Object deleted? Assume it was and return no further
                 # attributes.
@@ -304,12 +471,13 @@ class Client(object):
         attrs[type] = values
         del attrs[key]
 
-    def _process_range_subtypes(self, result):
-        """Incremental retrieval of multi-valued attributes."""
+    def _process_range_subtypes(self, result, conn=None):
+        """Incremental retrieval of multi-valued attributes, optionally on
+        the connection `conn'."""
         for dn,attrs in result:
             for key in attrs.keys():  # dict will be updated
                 if self.re_range.match(key):
-                    self._retrieve_all_ranges(dn, key, attrs)
+                    self._retrieve_all_ranges(dn, key, attrs, conn)
         return result
 
     def _fixup_filter(self, filter):
@@ -358,38 +526,124 @@ class Client(object):
             raise TypeError, 'Expecting sequence of strings.'
         return attrs
 
-    def _search_with_paged_results(self, conn, filter, base, scope, attrs):
-        """Perform an ldap search operation with paged results."""
+    def _search_with_paged_results(self, pool, filter, base, scope, attrs):
+        """Perform an ldap search operation with paged results. This is a
+        generator that yields the result one page at a time.
+
+        The paged results cookie is only valid on the connection that
+        returned it, so one connection from `pool' is used for the entire
+        search. Ranged multi-valued attributes are retrieved on the same
+        connection, so that a search never needs a second connection from
+        the pool. If the connection fails before the first page is yielded,
+        the search is retried like other idempotent operations.
+
+        The first value yielded is None, once the connection has been
+        checked out. The connection is returned to the pool when the
+        generator finishes or is closed.
+        """
         ctrl = ldap.controls.SimplePagedResultsControl(
                     ldap.LDAP_CONTROL_PAGE_OID, True, (self._pagesize, ''))
-        result = []
-        while True:
-            msgid = conn.search_ext(base, scope, filter, attrs,
-                                    serverctrls=[ctrl])
-            type, data, msgid, ctrls = conn.result3(msgid)
-            result += data
-            rctrls = [ c for c in ctrls
-                       if c.controlType == ldap.LDAP_CONTROL_PAGE_OID ]
-            if not rctrls:
-                m = 'Server does not honour paged results.'
-                raise ADError, m
-            est, cookie = rctrls[0].controlValue
-            if not cookie:
-                break
-            ctrl.controlValue = (self._pagesize, cookie)
-        return result
+        conn = self._checkout(pool)
+        pages = 0
+        attempt = 0
+        try:
+            yield None
+            while True:
+                try:
+                    msgid = conn.search_ext(base, scope, filter, attrs,
+                                            serverctrls=[ctrl])
+                    type, data, msgid, ctrls = \
+                            self._timed(conn, 'result3', msgid)
+                    data = self._remove_empty_search_entries(data)
+                    data = self._process_range_subtypes(data, conn)
+                except self._server_errors:
+                    error = sys.exc_info()
+                    failed, conn = conn, None
+                    self._connection_failed(pool, failed, error[1])
+                    if pages or attempt == self._retries:
+                        raise error[0], error[1], error[2]
+                    time.sleep(self._delay(attempt))
+                    attempt += 1
+                    conn = self._checkout(pool)
+                    continue
+                rctrls = [ c for c in ctrls
+                           if c.controlType == ldap.LDAP_CONTROL_PAGE_OID ]
+                if not rctrls:
+                    m = 'Server does not honour paged results.'
+                    raise ADError, m
+                yield data
+                pages += 1
+                est, cookie = rctrls[0].controlValue
+                if not cookie:
+                    break
+                ctrl.controlValue = (self._pagesize, cookie)
+        finally:
+            if conn is not None:
+                pool.checkin(conn)
 
-    def search(self, filter=None, base=None, scope=None, attrs=None,
-               server=None, scheme=None):
-        """Search Active Directory and return a list of objects.
+    def _prefetch_pages(self, pages, depth):
+        """Retrieve the pages from the generator `pages' in a separate
+        thread, staying up to `depth' pages ahead of the consumer. This is
+        a generator that yields the pages in order. The generator `pages'
+        is closed as soon as the producer stops."""
+        queue = Queue.Queue(depth)
+        stop = threading.Event()
+        def producer():
+            try:
+                try:
+                    while not stop.isSet():
+                        try:
+                            page = pages.next()
+                        except StopIteration:
+                            queue.put((None, None))
+                            return
+                        queue.put((page, None))
+                except Exception:
+                    if not stop.isSet():
+                        queue.put((None, sys.exc_info()))
+            finally:
+                pages.close()
+        thread = threading.Thread(target=producer)
+        thread.setDaemon(True)
+        thread.start()
+        try:
+            while True:
+                page, error = queue.get()
+                if error is not None:
+                    raise error[0], error[1], error[2]
+                if page is None:
+                    break
+                yield page
+        finally:
+            # Unblock the producer in case we were abandoned early.
+            stop.set()
+            while True:
+                try:
+                    queue.get_nowait()
+                except Queue.Empty:
+                    break
 
-        The `filter' argument specifies an RFC 2254 search filter. If it is
-        not provided, the default is '(objectClass=*)'.  `base' is the search
-        base and defaults to the base of the current domain.  `scope' is the
-        search scope and must be one of 'base', 'one' or 'subtree'. The
-        default scope is 'substree'. `attrs' is the attribute list to
-        retrieve. The default is to retrieve all attributes.
+    def _iter_search_results(self, pages):
+        """Yield the individual objects from the search result pages
+        `pages'."""
+        for page in pages:
+            for entry in page:
+                yield entry
+
+    def search_iter(self, filter=None, base=None, scope=None, attrs=None,
+                    server=None, scheme=None, prefetch=None):
+        """Search Active Directory and return an iterator over the objects
+        found.
+
+        The arguments are the same as for search(). The result is retrieved
+        from the server one page at a time, so that only a single page needs
+        to be kept in memory. If `prefetch' is nonzero, pages are retrieved
+        in a background thread that stays up to `prefetch' pages ahead of
+        the consumer. This allows the next page to be requested as soon as
+        the current one has arrived.
         """
+        if prefetch is None:
+            prefetch = self._prefetch
         filter = self._fixup_filter(filter)
         base = self._fixup_base(base)
         scope = self._fixup_scope(scope)
@@ -402,16 +656,41 @@ class Client(object):
             if scope != ldap.SCOPE_BASE:
                 m = 'Search scope must be base when querying rootDSE'
                 raise ADError, m
-        conn = self._ldap_connection(base, server, scheme)
+        pool = self._ldap_pool(base, server, scheme)
         if base == '':
             # search rootDSE does not honour paged results
-            result = conn.search_s(base, scope, filter, attrs)
+            page = self._pooled(pool, 'search_s', base, scope, filter, attrs)
+            page = self._remove_empty_search_entries(page)
+            pages = [self._process_range_subtypes(page)]
         else:
-            result = self._search_with_paged_results(conn, filter, base,
-                                                     scope, attrs)
-        result = self._remove_empty_search_entries(result)
-        result = self._process_range_subtypes(result)
-        return result
+            pages = self._search_with_paged_results(pool, filter, base,
+                                                    scope, attrs)
+            pages.next()  # check out the connection now
+            if prefetch:
+                pages = self._prefetch_pages(pages, prefetch)
+        return self._iter_search_results(pages)
+
+    def search(self, filter=None, base=None, scope=None, attrs=None,
+               server=None, scheme=None):
+        """Search Active Directory and return a list of objects.
+
+        The `filter' argument specifies an RFC 2254 search filter. If it is
+        not provided, the default is '(objectClass=*)'.  `base' is the search
+        base and defaults to the base of the current domain.  `scope' is the
+        search scope and must be one of 'base', 'one' or 'subtree'. The
+        default scope is 'substree'. `attrs' is the attribute list to
+        retrieve. The default is to retrieve all attributes.
+        """
+        result = self.search_iter(filter, base, scope, attrs, server, scheme)
+        return list(result)
+
+    def compare(self, dn, attr, value, server=None):
+        """Compare the attribute `attr' of the object `dn' with `value'.
+        Return True if the object has that value, False otherwise."""
+        if not isinstance(attr, str) or not isinstance(value, str):
+            raise TypeError, 'Expecting string attribute and value.'
+        pool = self._ldap_pool(dn, server)
+        return bool(self._pooled(pool, 'compare_s', dn, attr, value))
 
     def _fixup_add_list(self, attrs):
         """Check the `attrs' arguments to add()."""
@@ -441,8 +720,8 @@ class Client(object):
         a list of strings.
         """
         attrs = self._fixup_add_list(attrs)
-        conn = self._ldap_connection(dn, server)
-        conn.add_s(dn, attrs)
+        pool = self._ldap_pool(dn, server)
+        self._pooled(pool, 'add_s', dn, attrs)
 
     def _fixup_modify_operation(self, op):
         """Fixup an ldap modify operation."""
@@ -486,13 +765,13 @@ class Client(object):
         value(s).
         """
         mods = self._fixup_modify_list(mods)
-        conn = self._ldap_connection(dn, server)
-        conn.modify_s(dn, mods)
+        pool = self._ldap_pool(dn, server)
+        self._pooled(pool, 'modify_s', dn, mods)
 
     def delete(self, dn, server=None):
         """Delete the LDAP object referenced by `dn'."""
-        conn = self._ldap_connection(dn, server)
-        conn.delete_s(dn)
+        pool = self._ldap_pool(dn, server)
+        self._pooled(pool, 'delete_s', dn)
 
     def modrdn(self, dn, newrdn, delold=True, server=None):
         """Change the RDN of an object in Active Direcotry.
@@ -509,8 +788,8 @@ class Client(object):
         modrdn(). If the `newsuperior' argument is specified, it must be a
         DN and the object is moved there.
         """
-        conn = self._ldap_connection(dn, server)
-        conn.rename_s(dn, newrdn, newsuperior, delold)
+        pool = self._ldap_pool(dn, server)
+        self._pooled(pool, 'rename_s', dn, newrdn, newsuperior, delold)
 
     def set_password(self, principal, password, server=None):
         """Set the password of `principal' to `password'."""
@@ -547,3 +826,407 @@ class Client(object):
             raise ADError, str(err)
         if server is not None:
             creds._resolve_servers_for_domain(domain, force=True)
+
+
+class AsyncOperation(object):
+    """An LDAP operation started by an AsyncClient."""
+
+    def __init__(self, client, pool, method, args, idempotent=False):
+        """Constructor."""
+        self.m_client = client
+        self.m_pool = pool
+        self.m_method = method
+        self.m_args = args
+        self.m_idempotent = idempotent
+        self.m_conn = None
+        self.m_msgid = None
+        self.m_attempt = 0
+        self.m_done = False
+        self.m_result = None
+        self.m_error = None
+
+    def done(self):
+        """Return True if the operation has completed."""
+        return self.m_done
+
+    def result(self, timeout=None):
+        """Return the result of the operation, waiting at most `timeout'
+        seconds for it to complete. Other outstanding operations of the
+        client are processed while waiting. If the operation failed, its
+        error is raised."""
+        self.m_client._wait(self, timeout)
+        if self.m_error is not None:
+            raise self.m_error[0], self.m_error[1], self.m_error[2]
+        return self.m_result
+
+    def _send(self, conn):
+        """Send the request on the LDAP connection `conn'."""
+        self.m_conn = conn
+        self.m_msgid = getattr(conn, self.m_method)(*self.m_args)
+
+    def _retryable(self):
+        """Return True if the operation may be sent again after its
+        connection has failed."""
+        return self.m_idempotent and \
+                self.m_attempt < self.m_client.m_client._retries
+
+    def _complete(self, type, data, ctrls):
+        """Handle the result of the operation."""
+        self.m_result = data
+        self.m_done = True
+
+    def _error(self, error):
+        """Handle the LDAP error `error', an exc_info() tuple, that the
+        server returned for the operation."""
+        self._fail(error)
+
+    def _fail(self, error):
+        """Fail the operation with `error', an exc_info() tuple."""
+        self.m_error = error
+        self.m_done = True
+
+
+class AsyncSearch(AsyncOperation):
+    """A search operation started by an AsyncClient. The results are
+    retrieved one page at a time."""
+
+    def __init__(self, client, pool, base, scope, filter, attrs):
+        """Constructor."""
+        if base == '':
+            ctrl = None
+            serverctrls = None
+        else:
+            ctrl = ldap.controls.SimplePagedResultsControl(
+                        ldap.LDAP_CONTROL_PAGE_OID, True,
+                        (client.m_client._pagesize, ''))
+            serverctrls = [ctrl]
+        args = (base, scope, filter, attrs, 0, serverctrls)
+        super(AsyncSearch, self).__init__(client, pool, 'search_ext', args,
+                                          idempotent=True)
+        self.m_ctrl = ctrl
+        self.m_entries = []
+        self.m_result = []
+        self.m_pages = 0
+
+    def pop(self):
+        """Return the objects that have been received since the last call,
+        without waiting."""
+        entries = self.m_entries
+        self.m_entries = []
+        return entries
+
+    def entries(self, timeout=None):
+        """Return an iterator that yields the objects as their pages arrive,
+        processing the outstanding operations of the client while waiting.
+        `timeout' is the maximum time to wait for each page."""
+        while True:
+            for entry in self.pop():
+                yield entry
+            if self.m_done:
+                break
+            self.m_client._wait(self, timeout, self.m_pages + 1)
+        if self.m_error is not None:
+            raise self.m_error[0], self.m_error[1], self.m_error[2]
+
+    def _retryable(self):
+        """A search can only be retried if no objects have been returned
+        yet."""
+        return self.m_pages == 0 and super(AsyncSearch, self)._retryable()
+
+    def _complete(self, type, data, ctrls):
+        """Handle a page of results, and request the next page if there is
+        one."""
+        client = self.m_client.m_client
+        data = client._remove_empty_search_entries(data)
+        data = client._process_range_subtypes(data, self.m_conn)
+        self.m_entries += data
+        self.m_result += data
+        self.m_pages += 1
+        if self.m_ctrl is None:
+            self.m_done = True
+            return
+        rctrls = [ c for c in ctrls
+                   if c.controlType == ldap.LDAP_CONTROL_PAGE_OID ]
+        if not rctrls:
+            m = 'Server does not honour paged results.'
+            raise ADError, m
+        est, cookie = rctrls[0].controlValue
+        if not cookie:
+            self.m_done = True
+            return
+        self.m_ctrl.controlValue = (client._pagesize, cookie)
+        self._send(self.m_conn)
+
+
+class AsyncCompare(AsyncOperation):
+    """A compare operation started by an AsyncClient."""
+
+    def _error(self, error):
+        """The outcome of a comparison is returned in the result code, which
+        python-ldap raises as COMPARE_TRUE or COMPARE_FALSE."""
+        if issubclass(error[0], ldap.COMPARE_TRUE):
+            self._complete(None, True, None)
+        elif issubclass(error[0], ldap.COMPARE_FALSE):
+            self._complete(None, False, None)
+        else:
+            self._fail(error)
+
+
+class AsyncClient(object):
+    """Asynchronous Active Directory client.
+
+    The LDAP operations of this class return immediately with an
+    AsyncOperation object, after sending the request to the server. Their
+    results are collected by process(), which does not block unless asked
+    to. This allows many operations to be outstanding at the same time
+    from a single thread, and allows an event loop to wait for the file
+    descriptors returned by filenos() with select() or poll().
+
+    Connections are taken from the connection pools of the synchronous
+    Client `client', which also provides the locator, credentials and
+    naming contexts. Concurrent operations on the same naming context
+    share a single connection. Opening a new connection, and retrieving
+    ranged multi-valued attributes, is still done synchronously.
+
+    An AsyncClient must be used from a single thread.
+    """
+
+    def __init__(self, client):
+        """Constructor."""
+        self.m_client = client
+        self.m_operations = []
+        self.m_connections = {}
+
+    def search(self, filter=None, base=None, scope=None, attrs=None,
+               server=None, scheme=None):
+        """Start a search. The arguments are as for Client.search(). The
+        result of the returned operation is the list of objects found. The
+        objects can also be obtained as they arrive with its pop() and
+        entries() methods."""
+        client = self.m_client
+        filter = client._fixup_filter(filter)
+        base = client._fixup_base(base)
+        scope = client._fixup_scope(scope)
+        attrs = client._fixup_attrs(attrs)
+        scheme = client._fixup_scheme(scheme)
+        if base == '':
+            if server is None:
+                m = 'A server must be specified when querying rootDSE'
+                raise ADError, m
+            if scope != ldap.SCOPE_BASE:
+                m = 'Search scope must be base when querying rootDSE'
+                raise ADError, m
+        pool = client._ldap_pool(base, server, scheme)
+        operation = AsyncSearch(self, pool, base, scope, filter, attrs)
+        return self._start(operation)
+
+    def search_iter(self, filter=None, base=None, scope=None, attrs=None,
+                    server=None, scheme=None):
+        """Start a search and return an iterator over the objects found.
+        See AsyncSearch.entries()."""
+        operation = self.search(filter, base, scope, attrs, server, scheme)
+        return operation.entries()
+
+    def compare(self, dn, attr, value, server=None):
+        """Start a comparison. The arguments are as for Client.compare().
+        The result of the operation is True or False."""
+        if not isinstance(attr, str) or not isinstance(value, str):
+            raise TypeError, 'Expecting string attribute and value.'
+        pool = self.m_client._ldap_pool(dn, server)
+        operation = AsyncCompare(self, pool, 'compare_ext',
+                                 (dn, attr, value), idempotent=True)
+        return self._start(operation)
+
+    def add(self, dn, attrs, server=None):
+        """Start adding an object. The arguments are as for Client.add()."""
+        attrs = self.m_client._fixup_add_list(attrs)
+        return self._update(dn, server, 'add_ext', (dn, attrs))
+
+    def modify(self, dn, mods, server=None):
+        """Start modifying an object. The arguments are as for
+        Client.modify()."""
+        mods = self.m_client._fixup_modify_list(mods)
+        return self._update(dn, server, 'modify_ext', (dn, mods))
+
+    def delete(self, dn, server=None):
+        """Start deleting an object. The arguments are as for
+        Client.delete()."""
+        return self._update(dn, server, 'delete_ext', (dn,))
+
+    def rename(self, dn, newrdn, newsuperior=None, delold=True, server=None):
+        """Start renaming an object. The arguments are as for
+        Client.rename()."""
+        return self._update(dn, server, 'rename',
+                            (dn, newrdn, newsuperior, delold))
+
+    def filenos(self):
+        """Return the file descriptors of the connections with outstanding
+        operations. They become readable when a result may be available."""
+        result = []
+        for conn in self.m_connections.values():
+            try:
+                result.append(conn.get_option(ldap.OPT_DESC))
+            except ldap.LDAPError:
+                pass
+        return result
+
+    def outstanding(self):
+        """Return the number of operations that have not completed yet."""
+        return len(self.m_operations)
+
+    def process(self, timeout=0):
+        """Wait up to `timeout' seconds for a result to arrive, and handle
+        all results that are available. Return the list of operations that
+        have completed."""
+        filenos = self.filenos()
+        if timeout and filenos:
+            try:
+                select.select(filenos, [], [], timeout)
+            except (select.error, ValueError):
+                pass
+        elif timeout and self.m_operations:
+            time.sleep(min(timeout, self._poll))
+        for operation in self.m_operations[:]:
+            if not operation.m_done:
+                self._poll_operation(operation)
+        completed = [ op for op in self.m_operations if op.m_done ]
+        self.m_operations = [ op for op in self.m_operations
+                              if not op.m_done ]
+        self._release_connections()
+        return completed
+
+    def close(self):
+        """Abandon all outstanding operations and return their connections
+        to the pool. The abandoned operations fail with an error."""
+        try:
+            raise ADError, 'LDAP operation abandoned.'
+        except ADError:
+            error = sys.exc_info()
+        for operation in self.m_operations:
+            try:
+                operation.m_conn.abandon(operation.m_msgid)
+            except ldap.LDAPError:
+                pass
+            operation._fail(error)
+        self.m_operations = []
+        self._release_connections()
+
+    _poll = 0.05
+
+    def _update(self, dn, server, method, args):
+        """Start the update operation `method'."""
+        pool = self.m_client._ldap_pool(dn, server)
+        operation = AsyncOperation(self, pool, method, args)
+        return self._start(operation)
+
+    def _start(self, operation):
+        """Send `operation' and register it as outstanding. If the request
+        cannot be sent because the connection has failed, it is sent again
+        on a new connection."""
+        while True:
+            conn = self._connection(operation.m_pool)
+            try:
+                operation._send(conn)
+                break
+            except self.m_client._server_errors:
+                error = sys.exc_info()
+            failed = self._connection_failed(operation.m_pool, conn, error[1])
+            for other in failed:
+                self._retry_or_fail(other, error)
+            if operation.m_attempt >= self.m_client._retries:
+                raise error[0], error[1], error[2]
+            operation.m_attempt += 1
+        self.m_operations.append(operation)
+        return operation
+
+    def _connection(self, pool):
+        """Return the connection used for operations on `pool'."""
+        conn = self.m_connections.get(pool)
+        if conn is None:
+            conn = self.m_client._checkout(pool)
+            self.m_connections[pool] = conn
+        return conn
+
+    def _release_connections(self):
+        """Return the connections without outstanding operations to their
+        pools."""
+        used = [ operation.m_pool for operation in self.m_operations ]
+        for pool, conn in self.m_connections.items():
+            if pool not in used:
+                del self.m_connections[pool]
+                pool.checkin(conn)
+
+    def _connection_failed(self, pool, conn, error):
+        """Close the connection `conn' of `pool' that failed with `error'.
+        Return the outstanding operations that were using it."""
+        if self.m_connections.get(pool) is conn:
+            del self.m_connections[pool]
+        self.m_client._connection_failed(pool, conn, error)
+        failed = [ operation for operation in self.m_operations
+                   if operation.m_conn is conn and not operation.m_done ]
+        return failed
+
+    def _retry_or_fail(self, operation, error):
+        """Send `operation' again on a new connection if it may be retried,
+        or fail it with `error'."""
+        if not operation._retryable():
+            operation._fail(error)
+            return
+        operation.m_attempt += 1
+        try:
+            operation._send(self._connection(operation.m_pool))
+        except (ldap.LDAPError, ADError):
+            operation._fail(sys.exc_info())
+
+    def _poll_operation(self, operation):
+        """Check if a result is available for `operation' and handle it,
+        reporting its success or failure to the health registry.
+
+        No latency is reported. The time until a result is polled depends
+        on how often the application calls process(), not on the server.
+        """
+        conn = operation.m_conn
+        server = self.m_client.m_servers.get(conn)
+        health = self.m_client._locator().health()
+        received = False
+        try:
+            type, data, msgid, ctrls = conn.result3(operation.m_msgid, 1, 0)
+            if type is None:
+                return
+            received = True
+            if server is not None:
+                health.success(server)
+            operation._complete(type, data, ctrls)
+        except self.m_client._server_errors:
+            error = sys.exc_info()
+            if server is not None:
+                health.failure(server)
+            failed = self._connection_failed(operation.m_pool, conn, error[1])
+            for other in failed:
+                self._retry_or_fail(other, error)
+        except ldap.LDAPError:
+            error = sys.exc_info()
+            if server is not None and not received:
+                health.success(server)
+            operation._error(error)
+        except ADError:
+            operation._fail(sys.exc_info())
+
+    def _wait(self, operation, timeout=None, pages=None):
+        """Process results until `operation' has completed, or until it has
+        received `pages' pages, waiting at most `timeout' seconds."""
+        if timeout is not None:
+            end = time.time() + timeout
+        while not operation.m_done:
+            if pages is not None and operation.m_pages >= pages:
+                break
+            if operation not in self.m_operations:
+                raise ADError, 'LDAP operation is not outstanding.'
+            if timeout is None:
+                self.process(1)
+                continue
+            timeleft = end - time.time()
+            if timeleft <= 0:
+                raise ADError, 'Timeout waiting for LDAP operation.'
+            self.process(min(timeleft, 1))
+
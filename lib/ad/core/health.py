@@ -0,0 +1,193 @@
+#
+# This file is part of Python-AD. Python-AD is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
+# "AUTHORS" for a complete overview.
+
+import time
+import threading
+
+
+class ServerHealth(object):
+    """Health statistics for a single server."""
+
+    def __init__(self):
+        """Constructor."""
+        self.latency = None
+        self.rtt = None
+        self.error_rate = 0.0
+        self.failures = 0
+        self.requests = 0
+        self.opened = None
+
+
+class HealthRegistry(object):
+    """Track the health of domain controllers.
+
+    For each server, the registry keeps an exponentially weighted moving
+    average (EWMA) of the latency of successful requests and of the error
+    rate. The round-trip time of netlogon pings is averaged separately,
+    because it does not depend on the kind of requests a server handles.
+    It is the measure that is used to order servers. It also implements a
+    circuit breaker: after `_threshold' consecutive failures, the server
+    is considered unavailable for `_cooldown' seconds. After that, it is
+    tried again. The circuit is closed on the first success, or opened
+    again on the next failure.
+
+    Server names are compared case insensitively and without a trailing
+    period.
+    """
+
+    _alpha = 0.3
+    _threshold = 3
+    _cooldown = 30
+
+    def __init__(self):
+        """Constructor."""
+        self.m_lock = threading.Lock()
+        self.m_servers = {}
+
+    def success(self, server, latency=None):
+        """Report a successful request to `server' that took `latency'
+        seconds, if known."""
+        self.m_lock.acquire()
+        try:
+            health = self._health(server)
+            if latency is not None:
+                health.latency = self._average(health.latency, latency)
+            self._succeeded(health)
+        finally:
+            self.m_lock.release()
+
+    def ping(self, server, rtt):
+        """Report a successful netlogon ping to `server' with round-trip time
+        `rtt' seconds."""
+        self.m_lock.acquire()
+        try:
+            health = self._health(server)
+            health.rtt = self._average(health.rtt, rtt)
+            self._succeeded(health)
+        finally:
+            self.m_lock.release()
+
+    def failure(self, server):
+        """Report a failed request to `server'."""
+        self.m_lock.acquire()
+        try:
+            health = self._health(server)
+            health.error_rate += self._alpha * (1.0 - health.error_rate)
+            health.failures += 1
+            health.requests += 1
+            if health.failures >= self._threshold:
+                health.opened = time.time()
+        finally:
+            self.m_lock.release()
+
+    def down(self, server):
+        """Report that `server' is unreachable. This opens the circuit
+        immediately."""
+        self.m_lock.acquire()
+        try:
+            health = self._health(server)
+            health.failures = max(health.failures, self._threshold)
+            health.opened = time.time()
+        finally:
+            self.m_lock.release()
+
+    def available(self, server):
+        """Return True if requests may be sent to `server'."""
+        self.m_lock.acquire()
+        try:
+            health = self.m_servers.get(self._key(server))
+            if health is None or health.opened is None:
+                return True
+            return time.time() - health.opened >= self._cooldown
+        finally:
+            self.m_lock.release()
+
+    def latency(self, server):
+        """Return the average request latency of `server', or None if it is
+        unknown."""
+        self.m_lock.acquire()
+        try:
+            health = self.m_servers.get(self._key(server))
+            if health is None:
+                return
+            return health.latency
+        finally:
+            self.m_lock.release()
+
+    def rtt(self, server):
+        """Return the average ping round-trip time of `server', or None if
+        it is unknown."""
+        self.m_lock.acquire()
+        try:
+            health = self.m_servers.get(self._key(server))
+            if health is None:
+                return
+            return health.rtt
+        finally:
+            self.m_lock.release()
+
+    def stats(self):
+        """Return a dictionary with the statistics of all servers. The
+        values are dictionaries with the keys 'latency', 'rtt',
+        'error_rate', 'failures', 'requests' and 'state'. The state is one
+        of 'closed', 'open' or 'half-open'."""
+        self.m_lock.acquire()
+        try:
+            now = time.time()
+            result = {}
+            for key, health in self.m_servers.items():
+                if health.opened is None:
+                    state = 'closed'
+                elif now - health.opened < self._cooldown:
+                    state = 'open'
+                else:
+                    state = 'half-open'
+                result[key] = { 'latency': health.latency,
+                                'rtt': health.rtt,
+                                'error_rate': health.error_rate,
+                                'failures': health.failures,
+                                'requests': health.requests,
+                                'state': state }
+            return result
+        finally:
+            self.m_lock.release()
+
+    def clear(self):
+        """Forget all statistics."""
+        self.m_lock.acquire()
+        try:
+            self.m_servers.clear()
+        finally:
+            self.m_lock.release()
+
+    def _average(self, average, value):
+        """Return the EWMA `average' updated with `value'."""
+        if average is None:
+            return value
+        return average + self._alpha * (value - average)
+
+    def _succeeded(self, health):
+        """Update `health' for a success. The lock must be held."""
+        health.error_rate -= self._alpha * health.error_rate
+        health.failures = 0
+        health.requests += 1
+        health.opened = None
+
+    def _key(self, server):
+        """Return the registry key for `server'."""
+        return server.lower().rstrip('.')
+
+    def _health(self, server):
+        """Return the statistics for `server', creating them if needed. The
+        lock must be held."""
+        key = self._key(server)
+        health = self.m_servers.get(key)
+        if health is None:
+            health = ServerHealth()
+            self.m_servers[key] = health
+        return health
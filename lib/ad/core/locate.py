@@ -6,19 +6,32 @@
 # Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
 # "AUTHORS" for a complete overview.
 
+import os
+import os.path
 import time
+import Queue
 import random
+import select
+import socket
+import urllib
+import marshal
 import logging
+import tempfile
+import threading
 
 import ldap
 import dns.resolver
+import dns.rdatatype
 import dns.reversename
 import dns.exception
 
 from ad.protocol import netlogon
 from ad.protocol.netlogon import Client as NetlogonClient
 from ad.core.exception import Error as ADError
+from ad.core.health import HealthRegistry
 from ad.util import compat
+from ad.util.lru import LRUCache
+from ad.util.workers import WorkerPool
 
 
 LDAP_PORT = 389
@@ -26,6 +39,71 @@ KERBEROS_PORT = 88
 KPASSWD_PORT = 464
 
 
+class FileCache(object):
+    """A cache of located domain controllers, stored in a directory.
+
+    Each entry is stored in a file of its own. A new entry is written to a
+    temporary file which is then renamed over the old one, so the cache can
+    be safely shared between the processes of one user. The cache is
+    private to that user: the directory is created with mode 0700 and the
+    files with mode 0600, because an entry written by another user could
+    redirect clients to a rogue server. Entries may contain only basic
+    Python types; they are serialized with marshal.
+    """
+
+    def __init__(self, directory):
+        """Constructor."""
+        self.m_directory = directory
+
+    def get(self, key):
+        """Return the entry stored under `key', or None if there is none."""
+        fname = self._filename(key)
+        try:
+            fin = file(fname, 'rb')
+            try:
+                data = fin.read()
+            finally:
+                fin.close()
+        except IOError:
+            return None
+        try:
+            entry = marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            return None
+        return entry
+
+    def put(self, key, entry):
+        """Store `entry' under `key'."""
+        data = marshal.dumps(entry)
+        if not os.path.isdir(self.m_directory):
+            os.makedirs(self.m_directory, 0700)
+        fd, tmpname = tempfile.mkstemp(prefix='.tmp', dir=self.m_directory)
+        try:
+            fout = os.fdopen(fd, 'wb')
+            try:
+                fout.write(data)
+            finally:
+                fout.close()
+            os.rename(tmpname, self._filename(key))
+        except:
+            os.unlink(tmpname)
+            raise
+
+    def _filename(self, key):
+        """Return the file name for `key', which must be a tuple."""
+        parts = [ urllib.quote(str(part or ''), safe='') for part in key ]
+        return os.path.join(self.m_directory, ','.join(parts))
+
+
+class DNSCache(LRUCache):
+    """A bounded, thread-safe LRU cache of DNS answers.
+
+    Each entry has an absolute expiration time. For an answer this is
+    derived from the TTLs of its records. Failed queries are cached as
+    well, as None, so that they are not retried for every candidate.
+    """
+
+
 class Locator(object):
     """Locate domain controllers.
     
@@ -49,18 +127,73 @@ class Locator(object):
 
     Both policies (selection and ordering) can be changed by subclassing this
     class.
+
+    Candidate domain controllers are pinged concurrently. By default all
+    candidates are pinged at once. If `_wave' is set, they are pinged in
+    waves of that many servers, each wave starting `_stagger' seconds after
+    the previous one, or as soon as the previous one has finished.
+
+    If a cache directory is given, located domain controllers are also
+    stored on disk, keyed by domain, role and site. Other processes using
+    the same directory reuse them as long as they are fresh.
+
+    DNS answers are cached for as long as their TTL allows. Names that do
+    not exist are cached for `_negative_timeout' seconds, and other failed
+    queries, such as timeouts, for `_error_timeout' seconds.
+
+    Cached domain controllers are refreshed in a background thread when a
+    cache entry is used less than `_refresh' seconds before it expires.
+    Until the refresh has finished, an expired entry continues to be used
+    for up to `_stale' seconds.
+
+    Domain controllers that reply are verified concurrently with the
+    pings, using up to `_checkers' threads.
+
+    The locator keeps a health registry, see health(). It is fed by the
+    netlogon pings and by the LDAP operations of ad.Client. Remote domain
+    controllers are ordered on their average ping round-trip time, and domain
+    controllers that are failing are skipped while other ones are
+    available.
     """
 
     _maxservers = 3
     _timeout = 300  # cache entries for 5 minutes
+    _wave = None
+    _stagger = 0.25
+    _cachedir = None
+    _negative_timeout = 60
+    _error_timeout = 5
+    _refresh = 30
+    _stale = 300
+    _checkers = 8
+    _poll = 0.05
+    _site_timeout = 3600
+    _address_check = 5
 
-    def __init__(self, site=None):
+    def __init__(self, site=None, cachedir=None):
         """Constructor."""
         self.m_site = site
-        self.m_site_detected = False
+        self.m_sites = {}
+        self.m_address_checks = {}
         self.m_logger = logging.getLogger('ad.core.locate')
         self.m_cache = {}
         self.m_timeout = self._timeout
+        if cachedir is None:
+            cachedir = self._cachedir
+        if cachedir is not None:
+            self.m_filecache = FileCache(cachedir)
+        else:
+            self.m_filecache = None
+        self.m_dnscache = DNSCache()
+        self.m_lock = threading.Lock()
+        self.m_refreshing = {}
+        self.m_health = HealthRegistry()
+        self.m_checkers = WorkerPool(self._checkers)
+
+    def health(self):
+        """Return the HealthRegistry with the statistics of the domain
+        controllers used."""
+        return self.m_health
 
     def locate(self, domain, role=None):
         """Locate one domain controller."""
@@ -90,44 +223,201 @@ class Locator(object):
         domain = domain.upper()
         self.m_logger.debug('locating domain controllers for %s (role %s)' %
                             (domain, role))
-        key = (domain, role)
+        site = self._site(domain)
+        key = (domain, role, site)
         if key in self.m_cache:
             stamp, nrequested, servers = self.m_cache[key]
-            now = time.time()
-            if now - stamp < self._timeout and nrequested >= maxservers:
+            age = time.time() - stamp
+            if age < self._timeout + self._stale and nrequested >= maxservers:
+                if age >= self._timeout - self._refresh:
+                    self._refresh_in_background(domain, role, maxservers,
+                                                site)
                 self.m_logger.debug('domain controllers found in cache')
-                return servers
+                return self._available_domain_controllers(servers)
+        servers = self._load_cache(key, maxservers)
+        if servers is not None:
+            self.m_logger.debug('domain controllers found in file cache')
+            return self._available_domain_controllers(servers)
         self.m_logger.debug('domain controllers not in cache, going to network')
+        servers = self._locate_from_network(domain, role, maxservers, site)
+        self._update_cache(key, maxservers, servers)
+        return servers
+
+    def _available_domain_controllers(self, servers):
+        """Return the domain controllers in `servers' that are available
+        according to the health registry. If none of them are, all of them
+        are returned."""
+        result = [ srv for srv in servers
+                   if self.m_health.available(srv.hostname) ]
+        if not result:
+            result = servers
+        return result
+
+    def _locate_from_network(self, domain, role, maxservers, site):
+        """Locate up to `maxservers' domain controllers for `domain' with
+        role `role' in site `site' using DNS and netlogon pings. This does
+        not use the cache."""
         servers = []
         candidates = []
-        if self.m_site is None and not self.m_site_detected:
-            self.m_site = self._detect_site(domain)
-            self.m_site_detected = True
-        if self.m_site and role != 'pdc':
+        hints = {}
+        if site and role != 'pdc':
             query = '_ldap._tcp.%s._sites.%s._msdcs.%s' % \
-                    (self.m_site, role, domain.lower())
+                    (site, role, domain.lower())
             answer = self._dns_query(query, 'SRV')
             candidates += self._order_dns_srv(answer)
+            hints.update(self._extract_hints_from_srv(answer))
         query = '_ldap._tcp.%s._msdcs.%s' % (role, domain.lower())
         answer = self._dns_query(query, 'SRV')
         candidates += self._order_dns_srv(answer)
+        hints.update(self._extract_hints_from_srv(answer))
         addresses = self._extract_addresses_from_srv(candidates)
         addresses = self._remove_duplicates(addresses)
-        replies = []
-        netlogon = NetlogonClient()
-        for i in range(0, len(addresses), maxservers):
-            for addr in addresses[i:i+maxservers]:
-                addr = (addr[0], LDAP_PORT)  # in case we queried for GC
-                netlogon.query(addr, domain)
-            replies += netlogon.call()
-            if self._sufficient_domain_controllers(replies, role, maxservers):
-                break
+        # in case we queried for GC
+        targets = [ (addr[0], LDAP_PORT) for addr in addresses ]
+        targets = self._remove_duplicates(targets)
+        def check(reply):
+            return self._checked_domain_controller(reply, role)
+        replies = self._ping_domain_controllers(targets, domain, hints,
+                                                maxservers, check)
         servers = self._select_domain_controllers(replies, role, maxservers,
-                                                  addresses)
+                                                  addresses, site)
         self.m_logger.debug('found %d domain controllers' % len(servers))
+        return servers
+
+    def _update_cache(self, key, maxservers, servers):
+        """Store the located domain controllers `servers' under `key' in
+        the in-memory cache and in the file cache. The key is a (domain,
+        role, site) tuple."""
         now = time.time()
         self.m_cache[key] = (now, maxservers, servers)
-        return servers
+        self._store_cache(key, (now, maxservers, servers))
+
+    def _refresh_in_background(self, domain, role, maxservers, site):
+        """Start a thread that refreshes the cache entry for `domain',
+        `role' and `site', unless one is running already."""
+        self.m_logger.debug('refreshing domain controllers for %s (role %s) '
+                            'in the background' % (domain, role))
+        self._run_in_background((domain, role, site), self._refresh_cache,
+                                domain, role, maxservers, site)
+
+    def _run_in_background(self, key, func, *args):
+        """Call func(*args) in a background thread, unless a thread for
+        `key' is running already."""
+        self.m_lock.acquire()
+        try:
+            if key in self.m_refreshing:
+                return
+            self.m_refreshing[key] = True
+        finally:
+            self.m_lock.release()
+        def run():
+            try:
+                try:
+                    func(*args)
+                except Exception, err:
+                    self.m_logger.error('background refresh failed: %s' %
+                                        str(err))
+            finally:
+                self.m_lock.acquire()
+                try:
+                    del self.m_refreshing[key]
+                finally:
+                    self.m_lock.release()
+        thread = threading.Thread(target=run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def _refresh_cache(self, domain, role, maxservers, site):
+        """Refresh the cache entry for `domain', `role' and `site'. If no
+        domain controllers are found, the current entry is kept."""
+        servers = self._locate_from_network(domain, role, maxservers, site)
+        if servers:
+            self._update_cache((domain, role, site), maxservers, servers)
+        else:
+            self.m_logger.error('no domain controllers found in background '
+                                'refresh, keeping cache entry')
+
+    def _ping_domain_controllers(self, addresses, domain, hints, want,
+                                 predicate):
+        """Ping the domain controllers in `addresses' for `domain'. Return
+        the replies as soon as `want' of them satisfy `predicate', or when
+        all pings have finished. The `hints' argument maps host names to
+        already known IP addresses.
+
+        Replies are checked with `predicate' in the checker threads while
+        the pings continue. Only replies that have been checked are
+        returned."""
+        wave = self._wave or len(addresses) or 1
+        waves = [ addresses[i:i+wave] for i in range(0, len(addresses), wave) ]
+        clients = []
+        replies = []
+        checks = Queue.Queue()
+        checked = {}
+        pending = 0
+        found = 0
+        begin = time.time()
+        next = begin
+        try:
+            while waves or clients or pending:
+                now = time.time()
+                if waves and (now >= next or not clients):
+                    client = NetlogonClient()
+                    for addr in waves.pop(0):
+                        client.query(addr, domain, hints.get(addr[0]))
+                    client.start()
+                    clients.append(client)
+                    next = now + self._stagger
+                results = []
+                if clients:
+                    timeout = min([ client.timeleft() for client in clients ])
+                    if waves:
+                        timeout = max(0, min(timeout, next - now))
+                    if pending:
+                        timeout = min(timeout, self._poll)
+                    try:
+                        select.select(clients, [], [], timeout)
+                    except select.error:
+                        pass  # interrupted by signal
+                    for client in clients[:]:
+                        for reply in client.process():
+                            self.m_health.ping(reply.q_hostname,
+                                               reply.q_timing)
+                            replies.append(reply)
+                            self.m_checkers.submit(checks, predicate, reply)
+                            pending += 1
+                        if client.done():
+                            for hostname, port in client.outstanding():
+                                self.m_health.failure(hostname)
+                            client.close()
+                            clients.remove(client)
+                else:
+                    results.append(checks.get())
+                while True:
+                    try:
+                        results.append(checks.get_nowait())
+                    except Queue.Empty:
+                        break
+                for (reply,), ok, error in results:
+                    pending -= 1
+                    if error is not None:
+                        raise error[0], error[1], error[2]
+                    checked[id(reply)] = True
+                    if not ok:
+                        continue
+                    found += 1
+                    if found == 1:
+                        self.m_logger.debug('first good domain controller '
+                                '%s after %.3f seconds' %
+                                (reply.q_hostname, time.time() - begin))
+                if found >= want:
+                    break
+        finally:
+            for client in clients:
+                client.close()
+        replies = [ reply for reply in replies if id(reply) in checked ]
+        self.m_logger.debug('%d replies, %d good, after %.3f seconds' %
+                            (len(replies), found, time.time() - begin))
+        return replies
 
     def check_domain_controller(self, server, domain, role):
         """Ensure that `server' is a domain controller for `domain' and has
@@ -143,38 +433,189 @@ class Locator(object):
         result = self._check_domain_controller(reply, role)
         return result
 
+    def _load_cache(self, key, maxservers):
+        """Return the domain controllers stored under `key' in the file
+        cache, or None if there is no fresh entry for at least `maxservers'
+        servers. A fresh entry is copied to the in-memory cache."""
+        if self.m_filecache is None:
+            return
+        try:
+            entry = self.m_filecache.get(key)
+        except (IOError, OSError), err:
+            self.m_logger.error('could not read file cache: %s' % str(err))
+            return
+        if entry is None:
+            return
+        try:
+            stamp, nrequested, servers = entry
+            servers = [ netlogon.Reply(**attrs) for attrs in servers ]
+        except (TypeError, ValueError):
+            return
+        if time.time() - stamp >= self._timeout or nrequested < maxservers:
+            return
+        self.m_cache[key] = (stamp, nrequested, servers)
+        return servers
+
+    def _store_cache(self, key, entry):
+        """Store `entry' under `key' in the file cache."""
+        if self.m_filecache is None:
+            return
+        stamp, nrequested, servers = entry
+        servers = [ reply.__dict__ for reply in servers ]
+        try:
+            self.m_filecache.put(key, (stamp, nrequested, servers))
+        except (IOError, OSError, ValueError), err:
+            self.m_logger.error('could not write file cache: %s' % str(err))
+
     def _dns_query(self, query, type):
-        """Perform a DNS query."""
+        """Perform a DNS query. Answers are cached."""
+        key = (str(query).lower(), type)
+        found, answer = self.m_dnscache.get(key)
+        if found:
+            self.m_logger.debug('DNS query %s type %s found in cache' %
+                                (query, type))
+            if answer is None:
+                answer = []
+            return answer
         self.m_logger.debug('DNS query %s type %s' % (query, type))
         try:
             answer = dns.resolver.query(query, type)
         except dns.exception.DNSException, err:
             answer = []
             self.m_logger.error('DNS query error: %s' % (str(err) or err.__doc__))
+            if isinstance(err, (dns.resolver.NXDOMAIN, dns.resolver.NoAnswer)):
+                timeout = self._negative_timeout
+            else:
+                timeout = self._error_timeout
+            self.m_dnscache.put(key, None, time.time() + timeout)
         else:
             self.m_logger.debug('DNS query returned %d results' % len(answer))
+            self.m_dnscache.put(key, answer, answer.expiration)
         return answer
 
+    def _site(self, domain):
+        """Return our site in `domain'. This is the site given to the
+        constructor, if any. Otherwise the site is detected.
+
+        A detected site is cached for `_site_timeout' seconds, also in the
+        file cache if there is one. After it has expired, or when the local
+        IP address has changed, the site is detected again in the
+        background while the cached site continues to be used. The local
+        address is checked at most every `_address_check' seconds. A failed
+        detection is cached in memory for `_negative_timeout' seconds.
+        Domain controllers are cached per site, so a new site uses its own
+        cache entries.
+        """
+        if self.m_site is not None:
+            return self.m_site
+        entry = self.m_sites.get(domain)
+        if entry is None:
+            entry = self._load_site(domain)
+        if entry is None:
+            return self._update_site(domain)
+        stamp, site, local, peer = entry
+        if site is None:
+            if time.time() - stamp < self._negative_timeout:
+                return
+            return self._update_site(domain)
+        if time.time() - stamp >= self._site_timeout:
+            self.m_logger.debug('site for %s expired' % domain)
+            self._run_in_background(('site', domain), self._update_site,
+                                    domain)
+        elif self._address_changed(domain, local, peer):
+            self.m_logger.debug('local address changed, detecting site again')
+            self._run_in_background(('site', domain), self._update_site,
+                                    domain)
+        return site
+
+    def _update_site(self, domain):
+        """Detect our site in `domain' and update the cache. Return the
+        site."""
+        site, peer = self._detect_site_ex(domain)
+        if site is None:
+            entry = self.m_sites.get(domain)
+            if entry is None or entry[1] is None:
+                self.m_sites[domain] = (time.time(), None, None, None)
+                return
+            # Keep using the previous site and try again later.
+            stamp = time.time() - self._site_timeout + self._negative_timeout
+            site, peer = entry[1], entry[3]
+            self.m_sites[domain] = (stamp, site, self._local_address(peer),
+                                    peer)
+            return
+        entry = (time.time(), site, self._local_address(peer), peer)
+        self.m_sites[domain] = entry
+        self.m_address_checks[domain] = entry[0]
+        if self.m_filecache is not None:
+            try:
+                self.m_filecache.put(('site', domain), entry)
+            except (IOError, OSError), err:
+                self.m_logger.error('could not write file cache: %s' %
+                                    str(err))
+        return site
+
+    def _load_site(self, domain):
+        """Load our site in `domain' from the file cache."""
+        if self.m_filecache is None:
+            return
+        try:
+            entry = self.m_filecache.get(('site', domain))
+        except (IOError, OSError), err:
+            self.m_logger.error('could not read file cache: %s' % str(err))
+            return
+        if not isinstance(entry, tuple) or len(entry) != 4:
+            return
+        self.m_sites[domain] = entry
+        return entry
+
+    def _address_changed(self, domain, local, peer):
+        """Return True if the local IP address that is used to reach `peer'
+        is no longer `local'. This is checked at most every
+        `_address_check' seconds for `domain'; in between, False is
+        returned."""
+        now = time.time()
+        if now - self.m_address_checks.get(domain, 0) < self._address_check:
+            return False
+        self.m_address_checks[domain] = now
+        return self._local_address(peer) != local
+
+    def _local_address(self, peer):
+        """Return the local IP address that is used to reach the IP address
+        `peer', or None if it is unknown. No packets are sent."""
+        if peer is None:
+            return
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            try:
+                sock.connect((peer, LDAP_PORT))
+                address = sock.getsockname()[0]
+            except socket.error:
+                address = None
+        finally:
+            sock.close()
+        return address
+
     def _detect_site(self, domain):
         """Detect our site using the netlogon protocol."""
+        site, peer = self._detect_site_ex(domain)
+        return site
+
+    def _detect_site_ex(self, domain):
+        """Detect our site using the netlogon protocol. Return a tuple
+        (site, address) with the IP address of one of the domain
+        controllers that replied."""
         self.m_logger.debug('detecting site')
         query = '_ldap._tcp.%s' % domain.lower()
         answer = self._dns_query(query, 'SRV')
         servers = self._order_dns_srv(answer)
         addresses = self._extract_addresses_from_srv(servers)
-        replies = []
-        netlogon = NetlogonClient()
-        for i in range(0, len(addresses), 3):
-            for addr in addresses[i:i+3]:
-                self.m_logger.debug('NetLogon query to %s' % addr[0])
-                netlogon.query(addr, domain)
-            replies += netlogon.call()
-            self.m_logger.debug('%d replies' % len(replies))
-            if replies >= 3:
-                break
+        hints = self._extract_hints_from_srv(answer)
+        replies = self._ping_domain_controllers(addresses, domain, hints, 3,
+                                                lambda reply: True)
+        self.m_logger.debug('%d replies' % len(replies))
         if not replies:
             self.m_logger.error('could not detect site')
-            return
+            return None, None
         sites = {}
         for reply in replies:
             try:
@@ -184,7 +625,7 @@ class Locator(object):
         sites = [ (value, key) for key,value in sites.items() ]
         sites.sort()
         self.m_logger.debug('site detected as %s' % sites[-1][1])
-        return sites[0][1]
+        return sites[-1][1], replies[0].q_address[0]
 
     def _order_dns_srv(self, answer):
         """Order the results of a DNS SRV query."""
@@ -226,6 +667,21 @@ class Locator(object):
         result = [ (a.target.to_text(), a.port) for a in answer ]
         return result
 
+    def _extract_hints_from_srv(self, answer):
+        """Return a dictionary mapping the targets of a DNS SRV query answer
+        to IP addresses, taken from the additional section of the reply."""
+        result = {}
+        response = getattr(answer, 'response', None)
+        if response is None:
+            return result
+        for rrset in response.additional:
+            if rrset.rdtype != dns.rdatatype.A:
+                continue
+            name = rrset.name.to_text()
+            for rr in rrset:
+                result.setdefault(name, rr.address)
+        return result
+
     def _remove_duplicates(self, servers):
         """Remove duplicates for `servers', keeping the order."""
         dict = {}
@@ -278,33 +734,53 @@ class Locator(object):
     def _sufficient_domain_controllers(self, replies, role, maxservers):
         """Return True if there are sufficient domain controllers in `replies'
         to satisfy `maxservers'."""
-        total = 0
-        for reply in replies:
-            if not hasattr(reply, 'checked'):
-                checked = self._check_domain_controller(reply, role)
-                reply.checked = checked
-            if reply.checked:
-                total += 1
+        def check(reply):
+            return self._checked_domain_controller(reply, role)
+        result = self.m_checkers.map(check, replies)
+        total = len(filter(None, result))
         return total >= maxservers
 
-    def _select_domain_controllers(self, replies, role, maxservers, addresses):
+    def _checked_domain_controller(self, reply, role):
+        """Like _check_domain_controller(), but remember the result in the
+        `checked' attribute of `reply' so that it is checked only once."""
+        if not hasattr(reply, 'checked'):
+            reply.checked = self._check_domain_controller(reply, role)
+        return reply.checked
+
+    def _latency(self, reply):
+        """Return the average ping round-trip time of the domain controller
+        that sent `reply', or the timing of the reply itself if it is
+        unknown. The latency of LDAP requests is not used, because it
+        depends on the kind of requests a server has handled."""
+        latency = self.m_health.rtt(reply.hostname)
+        if latency is None:
+            latency = reply.q_timing
+        return latency
+
+    def _select_domain_controllers(self, replies, role, maxservers, addresses,
+                                   site=None):
         """Select up to `maxservers' domain controllers from `replies'. The
         `addresses' argument is the ordered list of addresses from DNS SRV
-        resolution. It can be used to obtain SRV ordering information.
+        resolution. It can be used to obtain SRV ordering information. The
+        `site' argument is our site, and defaults to the site given to the
+        constructor.
         """
+        if site is None:
+            site = self.m_site
+        for reply in replies:
+            assert hasattr(reply, 'checked')
+        replies = [ reply for reply in replies if reply.checked ]
+        replies = self._available_domain_controllers(replies)
         local = []
         remote = []
         for reply in replies:
-            assert hasattr(reply, 'checked')
-            if not reply.checked:
-                continue
-            if self.m_site.lower() == reply.server_site.lower():
+            if site and site.lower() == reply.server_site.lower():
                 local.append(reply)
             else:
                 remote.append(reply)
         local.sort(lambda x,y: cmp(addresses.index((x.q_hostname, x.q_port)),
                                    addresses.index((y.q_hostname, y.q_port))))
-        remote.sort(lambda x,y: cmp(x.q_timing, y.q_timing))
+        remote.sort(lambda x,y: cmp(self._latency(x), self._latency(y)))
         self.m_logger.debug('Local DCs: %s' % ', '.join(['%s:%s' %
                                 (x.q_hostname, x.q_port) for x in local]))
         self.m_logger.debug('Remote DCs: %s' % ', '.join(['%s:%s' %
@@ -0,0 +1,291 @@
+#
+# This file is part of Python-AD. Python-AD is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
+# "AUTHORS" for a complete overview.
+
+import time
+import threading
+
+from ad.core.exception import Error as ADError
+
+
+class ConnectionPool(object):
+    """A bounded, thread-safe pool of connections.
+
+    Connections are created with the function `connect', which takes no
+    arguments, and closed with the function `close', which takes the
+    connection. They are taken from the pool with checkout() and must be
+    returned with checkin(). At most `maxsize' connections exist at the same
+    time. If all of them are in use, checkout() waits until one is returned.
+
+    The pool is filled with `minsize' connections by fill(). Connections
+    that have been idle for longer than `idle' seconds are closed by a
+    timer, except for the last `minsize' ones. A connection that has been
+    idle for longer than `_validate' seconds is passed to the function
+    `check' before it is handed out. If `check' returns False or raises an
+    exception, the connection is closed and another one is used.
+    """
+
+    _minsize = 0
+    _maxsize = 8
+    _idle = 300
+    _validate = 30
+    _timeout = 60
+
+    def __init__(self, connect, close, check=None, minsize=None,
+                 maxsize=None, idle=None):
+        """Constructor."""
+        self.m_connect = connect
+        self.m_close = close
+        self.m_check = check
+        if minsize is None:
+            minsize = self._minsize
+        if maxsize is None:
+            maxsize = self._maxsize
+        if idle is None:
+            idle = self._idle
+        if maxsize < 1 or minsize > maxsize:
+            raise ValueError, 'Illegal pool size: %s-%s' % (minsize, maxsize)
+        self.m_minsize = minsize
+        self.m_maxsize = maxsize
+        self.m_idletime = idle
+        self.m_lock = threading.Lock()
+        self.m_available = threading.Condition(self.m_lock)
+        self.m_idle = []
+        self.m_size = 0
+        self.m_closed = False
+        self.m_timer = None
+        self.m_checkouts = 0
+        self.m_waits = 0
+        self.m_wait_time = 0.0
+        self.m_max_wait = 0.0
+        self.m_created = 0
+        self.m_discarded = 0
+
+    def checkout(self, timeout=None):
+        """Take a connection from the pool. Wait at most `timeout' seconds
+        for one to become available. Raises an error if the pool has been
+        closed or if no connection became available in time."""
+        if timeout is None:
+            timeout = self._timeout
+        begin = time.time()
+        while True:
+            conn, stamp = self._take(begin, timeout)
+            if conn is None:
+                conn = self._create()
+            elif not self._alive(conn, stamp):
+                self._discard(conn)
+                continue
+            self.m_lock.acquire()
+            try:
+                self.m_checkouts += 1
+            finally:
+                self.m_lock.release()
+            return conn
+
+    def checkin(self, conn, discard=False):
+        """Return the connection `conn' to the pool. If `discard' is True,
+        the connection is closed instead, for example because it has
+        failed."""
+        self.m_lock.acquire()
+        try:
+            if not discard and not self.m_closed:
+                self.m_idle.append((conn, time.time()))
+                self.m_available.notify()
+                self._evict()
+                self._schedule()
+                return
+        finally:
+            self.m_lock.release()
+        self._discard(conn)
+
+    def fill(self):
+        """Open connections until the pool has `minsize' of them. Raises an
+        error if a connection cannot be opened."""
+        while True:
+            self.m_lock.acquire()
+            try:
+                if self.m_closed or self.m_size >= self.m_minsize:
+                    return
+                self.m_size += 1
+            finally:
+                self.m_lock.release()
+            conn = self._create()
+            self.checkin(conn)
+
+    def purge(self, predicate):
+        """Close the idle connections for which `predicate' returns True."""
+        self.m_lock.acquire()
+        try:
+            purged = [ conn for conn, stamp in self.m_idle if predicate(conn) ]
+            self.m_idle = [ (conn, stamp) for conn, stamp in self.m_idle
+                            if conn not in purged ]
+        finally:
+            self.m_lock.release()
+        for conn in purged:
+            self._discard(conn)
+
+    def close(self):
+        """Close all idle connections. Connections that are checked out are
+        closed when they are returned."""
+        self.m_lock.acquire()
+        try:
+            self.m_closed = True
+            idle = self.m_idle
+            self.m_idle = []
+            self.m_available.notifyAll()
+        finally:
+            self.m_lock.release()
+        for conn, stamp in idle:
+            self._discard(conn)
+
+    def stats(self):
+        """Return a dictionary with statistics. The keys are 'size', 'idle',
+        'in_use', 'checkouts', 'waits', 'wait_time', 'max_wait', 'created'
+        and 'discarded'. The wait time is the total time in seconds that
+        checkout() has waited for a connection to be returned."""
+        self.m_lock.acquire()
+        try:
+            return { 'size': self.m_size,
+                     'idle': len(self.m_idle),
+                     'in_use': self.m_size - len(self.m_idle),
+                     'checkouts': self.m_checkouts,
+                     'waits': self.m_waits,
+                     'wait_time': self.m_wait_time,
+                     'max_wait': self.m_max_wait,
+                     'created': self.m_created,
+                     'discarded': self.m_discarded }
+        finally:
+            self.m_lock.release()
+
+    def _take(self, begin, timeout):
+        """Reserve a connection. Return a tuple (conn, stamp) with an idle
+        connection and the time it was returned, or (None, None) if a new
+        connection may be created."""
+        waited = False
+        self.m_lock.acquire()
+        try:
+            try:
+                while True:
+                    if self.m_closed:
+                        raise ADError, 'Connection pool is closed.'
+                    self._evict()
+                    if self.m_idle:
+                        return self.m_idle.pop()
+                    if self.m_size < self.m_maxsize:
+                        self.m_size += 1
+                        return None, None
+                    remaining = begin + timeout - time.time()
+                    if remaining <= 0:
+                        m = 'Timeout waiting for an LDAP connection.'
+                        raise ADError, m
+                    waited = True
+                    self.m_available.wait(remaining)
+            finally:
+                if waited:
+                    elapsed = time.time() - begin
+                    self.m_waits += 1
+                    self.m_wait_time += elapsed
+                    self.m_max_wait = max(self.m_max_wait, elapsed)
+        finally:
+            self.m_lock.release()
+
+    def _evict(self):
+        """Close connections that have been idle for too long. The lock
+        must be held. The connections are closed in a separate thread so
+        that the lock is not held during network I/O."""
+        now = time.time()
+        expired = []
+        # Idle connections are ordered oldest first.
+        while self.m_idle and self.m_size - len(expired) > self.m_minsize:
+            conn, stamp = self.m_idle[0]
+            if now - stamp < self.m_idletime:
+                break
+            del self.m_idle[0]
+            expired.append(conn)
+        if not expired:
+            return
+        self.m_size -= len(expired)
+        self.m_discarded += len(expired)
+        thread = threading.Thread(target=self._close_all, args=(expired,))
+        thread.setDaemon(True)
+        thread.start()
+
+    def _schedule(self):
+        """Start a timer thread that evicts the oldest idle connection when
+        it expires, unless one is running already. The lock must be
+        held."""
+        if self.m_timer is not None or len(self.m_idle) == 0 or \
+                self.m_size <= self.m_minsize:
+            return
+        conn, stamp = self.m_idle[0]
+        delay = max(0, stamp + self.m_idletime - time.time())
+        self.m_timer = threading.Thread(target=self._expire, args=(delay,))
+        self.m_timer.setDaemon(True)
+        self.m_timer.start()
+
+    def _expire(self, delay):
+        """Timer thread: evict the expired idle connections after `delay'
+        seconds. This sleeps rather than waits on a condition, which would
+        poll."""
+        time.sleep(delay)
+        self.m_lock.acquire()
+        try:
+            self.m_timer = None
+            if self.m_closed:
+                return
+            self._evict()
+            self._schedule()
+        finally:
+            self.m_lock.release()
+
+    def _close_all(self, conns):
+        """Close the connections `conns'."""
+        for conn in conns:
+            try:
+                self.m_close(conn)
+            except Exception:
+                pass
+
+    def _create(self):
+        """Create a new connection. A slot must have been reserved."""
+        try:
+            conn = self.m_connect()
+        except:
+            self._release()
+            raise
+        self.m_lock.acquire()
+        try:
+            self.m_created += 1
+        finally:
+            self.m_lock.release()
+        return conn
+
+    def _alive(self, conn, stamp):
+        """Return True if the idle connection `conn', that was returned at
+        `stamp', can be used."""
+        if self.m_check is None or time.time() - stamp < self._validate:
+            return True
+        try:
+            return bool(self.m_check(conn))
+        except Exception:
+            return False
+
+    def _discard(self, conn):
+        """Close the connection `conn' and free its slot."""
+        self._release(discarded=True)
+        self._close_all([conn])
+
+    def _release(self, discarded=False):
+        """Free a connection slot."""
+        self.m_lock.acquire()
+        try:
+            self.m_size -= 1
+            if discarded:
+                self.m_discarded += 1
+            self.m_available.notify()
+        finally:
+            self.m_lock.release()
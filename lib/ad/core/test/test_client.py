@@ -6,11 +6,14 @@
 # Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
 # "AUTHORS" for a complete overview.
 
+import time
+import ldap
 from nose.tools import assert_raises
 
 from ad.test.base import BaseTest
+from ad.test.paged import PagedSearchServer, PagedConnection
 from ad.core.object import activate
-from ad.core.client import Client
+from ad.core.client import Client, AsyncClient
 from ad.core.locate import Locator
 from ad.core.constant import *
 from ad.core.creds import Creds
@@ -30,6 +33,411 @@ class TestADClient(BaseTest):
         result = client.search('(objectClass=user)')
         assert len(result) > 1
 
+    def test_search_iter(self):
+        self.require(ad_user=True)
+        domain = self.domain()
+        creds = Creds(domain)
+        creds.acquire(self.ad_user_account(), self.ad_user_password())
+        activate(creds)
+        client = Client(domain)
+        client._pagesize = 2
+        result = client.search_iter('(objectClass=user)')
+        dn, attrs = result.next()
+        assert isinstance(dn, str)
+        assert isinstance(attrs, dict)
+        result = [ dn ] + [ res[0] for res in result ]
+        assert len(result) > 2
+        expected = client.search('(objectClass=user)')
+        assert result == [ res[0] for res in expected ]
+
+    def test_prefetch_pages(self):
+        client = Client('freeadi.org')
+        pages = [ [('cn=%d' % i, {})] for i in range(10) ]
+        for depth in (1, 2, 20):
+            result = list(client._prefetch_pages(
+                    (page for page in pages), depth))
+            assert result == pages
+
+    def test_prefetch_pages_error(self):
+        client = Client('freeadi.org')
+        def pages():
+            yield [('cn=1', {})]
+            raise ADError, 'error'
+        result = client._prefetch_pages(pages(), 1)
+        assert result.next() == [('cn=1', {})]
+        assert_raises(ADError, result.next)
+
+    def test_prefetch_pages_abandon(self):
+        client = Client('freeadi.org')
+        def pages():
+            while True:
+                yield [('cn=1', {})]
+        result = client._prefetch_pages(pages(), 2)
+        assert result.next() == [('cn=1', {})]
+        result.close()
+
+    def _paged_client(self, server):
+        client = Client('freeadi.org')
+        client.m_locator = Locator()
+        client.m_naming_contexts = ['dc=freeadi,dc=org']
+        client._open_ldap_connection = \
+                lambda nc, srv, scheme: PagedConnection(server.address())
+        return client
+
+    def _wait_for(self, predicate):
+        for i in range(200):
+            if predicate():
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_prefetch_pages_stub_server(self):
+        pages, entries = 4, 10
+        server = PagedSearchServer(pages, entries)
+        server.start()
+        try:
+            client = self._paged_client(server)
+            result = client.search_iter(base='dc=freeadi,dc=org', prefetch=1)
+            ahead = []
+            count = 0
+            for dn, attrs in result:
+                page = count // entries
+                count += 1
+                if count % entries == 1 and page < pages - 1:
+                    # Page N+1 is requested while page N is processed.
+                    ahead.append(self._wait_for(lambda:
+                                                server.searches >= page + 2))
+            assert count == pages * entries
+            assert ahead == [True] * (pages - 1)
+            client.close()
+        finally:
+            server.stop()
+
+    def test_prefetch_pages_stub_server_abandon(self):
+        pages, entries = 10, 10
+        server = PagedSearchServer(pages, entries)
+        server.start()
+        try:
+            client = self._paged_client(server)
+            pool = client._ldap_pool('dc=freeadi,dc=org')
+            result = client.search_iter(base='dc=freeadi,dc=org', prefetch=1)
+            result.next()
+            assert self._wait_for(lambda: server.searches == 3)
+            result.close()
+            # The producer stops and returns the connection right away.
+            assert self._wait_for(lambda: pool.stats()['in_use'] == 0)
+            time.sleep(0.1)
+            assert server.searches == 3
+            client.close()
+        finally:
+            server.stop()
+
+    def test_timed(self):
+        class Connection(object):
+            def search_s(self, *args):
+                return [('cn=x', {})]
+            def add_s(self, *args):
+                raise LDAPError
+            def delete_s(self, *args):
+                raise ldap.SERVER_DOWN
+        client = Client('freeadi.org')
+        client.m_locator = Locator()
+        conn = Connection()
+        client.m_servers[conn] = 'dc1.freeadi.org'
+        assert client._timed(conn, 'search_s', '', 0) == [('cn=x', {})]
+        assert_raises(LDAPError, client._timed, conn, 'add_s', 'cn=x', [])
+        assert_raises(LDAPError, client._timed, conn, 'delete_s', 'cn=x')
+        stats = client.m_locator.health().stats()['dc1.freeadi.org']
+        assert stats['requests'] == 3
+        assert stats['failures'] == 1
+
+    def test_pooled(self):
+        class Connection(object):
+            def search_s(self, *args):
+                return [('cn=x', {})]
+            def delete_s(self, *args):
+                raise ldap.SERVER_DOWN
+            def unbind_s(self):
+                self.closed = True
+        client = Client('freeadi.org')
+        client.m_locator = Locator()
+        client.m_naming_contexts = ['dc=freeadi,dc=org']
+        client._open_ldap_connection = lambda nc, server, scheme: Connection()
+        pool = client._ldap_pool('cn=x,dc=freeadi,dc=org')
+        assert client._ldap_pool('cn=y,dc=freeadi,dc=org') is pool
+        assert client._pooled(pool, 'search_s', '', 0) == [('cn=x', {})]
+        assert client._pooled(pool, 'search_s', '', 0) == [('cn=x', {})]
+        stats = client.pool_stats()[('dc=freeadi,dc=org', None, 'ldap')]
+        assert stats['created'] == 1
+        assert stats['idle'] == 1
+        assert_raises(LDAPError, client._pooled, pool, 'delete_s', 'cn=x')
+        stats = pool.stats()
+        assert stats['size'] == 0
+        assert stats['discarded'] == 1
+        client.close()
+        assert client.pool_stats() == {}
+
+    def test_pool_filled(self):
+        class Connection(object):
+            def unbind_s(self):
+                pass
+        client = Client('freeadi.org')
+        client.m_locator = Locator()
+        client.m_naming_contexts = ['dc=freeadi,dc=org']
+        client._open_ldap_connection = lambda nc, server, scheme: Connection()
+        client._poolmin = 2
+        pool = client._ldap_pool('cn=x,dc=freeadi,dc=org')
+        stats = pool.stats()
+        assert stats['created'] == 2
+        assert stats['idle'] == 2
+        client.close()
+
+    def test_ranges_at_pool_maxsize(self):
+        class Connection(object):
+            """A fake connection that returns a ranged attribute."""
+            def search_ext(self, base, scope, filter, attrs, serverctrls):
+                cookie = serverctrls[0].controlValue[1]
+                page = cookie and int(cookie) or 0
+                self.result = [ ('cn=%d,%s' % (page, base),
+                                 {'member;range=0-0': ['m0']}) ]
+                cookie = page == 0 and '1' or ''
+                self.ctrls = [ ldap.controls.SimplePagedResultsControl(
+                                    ldap.LDAP_CONTROL_PAGE_OID, True,
+                                    (1, cookie)) ]
+                return 1
+            def result3(self, msgid):
+                return ldap.RES_SEARCH_RESULT, self.result, msgid, self.ctrls
+            def search_s(self, base, scope, filter, attrs):
+                dn = filter[len('(distinguishedName='):-1]
+                return [(dn, {'member;range=1-*': ['m1', 'm2']})]
+            def unbind_s(self):
+                pass
+        client = Client('freeadi.org')
+        client.m_locator = Locator()
+        client.m_naming_contexts = ['dc=freeadi,dc=org']
+        client._open_ldap_connection = lambda nc, server, scheme: Connection()
+        client._poolmax = 1
+        pool = client._ldap_pool('dc=freeadi,dc=org')
+        pool._timeout = 1
+        for prefetch in (0, 1):
+            result = client.search_iter(base='dc=freeadi,dc=org',
+                                        prefetch=prefetch)
+            result = list(result)
+            assert len(result) == 2
+            for dn, attrs in result:
+                assert attrs == {'member': ['m0', 'm1', 'm2']}
+        stats = pool.stats()
+        assert stats['created'] == 1
+        assert stats['waits'] == 0
+
+    def test_search_iter_checkout(self):
+        class Connection(object):
+            def unbind_s(self):
+                pass
+        client = Client('freeadi.org')
+        client.m_locator = Locator()
+        client.m_naming_contexts = ['dc=freeadi,dc=org']
+        client._open_ldap_connection = lambda nc, server, scheme: Connection()
+        pool = client._ldap_pool('dc=freeadi,dc=org')
+        for prefetch in (0, 1):
+            result = client.search_iter(base='dc=freeadi,dc=org',
+                                        prefetch=prefetch)
+            assert pool.stats()['in_use'] == 1
+            del result
+            assert pool.stats()['in_use'] == 0
+        client.close()
+
+    def _failover_client(self, broken):
+        class Connection(object):
+            def __init__(self, server):
+                self.server = server
+            def search_s(self, *args):
+                if self.server in broken:
+                    raise ldap.SERVER_DOWN
+                return [('cn=x', {})]
+            compare_s = search_s
+            delete_s = search_s
+            def unbind_s(self):
+                pass
+        client = Client('freeadi.org')
+        client._backoff = 0
+        client.m_locator = Locator()
+        client.m_naming_contexts = ['dc=freeadi,dc=org']
+        servers = ['dc1.freeadi.org', 'dc2.freeadi.org']
+        health = client.m_locator.health()
+        def open_connection(nc, server, scheme):
+            available = [ srv for srv in servers if health.available(srv) ]
+            conn = Connection(available[0])
+            client.m_servers[conn] = available[0]
+            return conn
+        client._open_ldap_connection = open_connection
+        pool = client._ldap_pool('dc=freeadi,dc=org')
+        return client, pool
+
+    def test_failover(self):
+        broken = []
+        client, pool = self._failover_client(broken)
+        conns = [ pool.checkout() for i in range(2) ]
+        for conn in conns:
+            pool.checkin(conn)
+        broken.append('dc1.freeadi.org')
+        result = client._pooled(pool, 'search_s', 'dc=freeadi,dc=org', 0)
+        assert result == [('cn=x', {})]
+        health = client.m_locator.health()
+        assert not health.available('dc1.freeadi.org')
+        stats = pool.stats()
+        assert stats['size'] == 1
+        assert stats['discarded'] == 2
+        assert client.compare('cn=x,dc=freeadi,dc=org', 'cn', 'x')
+
+    def test_failover_not_idempotent(self):
+        broken = ['dc1.freeadi.org']
+        client, pool = self._failover_client(broken)
+        assert_raises(LDAPError, client._pooled, pool, 'delete_s', 'cn=x')
+        result = client._pooled(pool, 'delete_s', 'cn=x')
+        assert result == [('cn=x', {})]
+
+    def test_failover_retries(self):
+        broken = ['dc1.freeadi.org', 'dc2.freeadi.org']
+        client, pool = self._failover_client(broken)
+        client.m_locator.health()._cooldown = 0
+        assert_raises(LDAPError, client._pooled, pool, 'search_s', '', 0)
+        assert pool.stats()['created'] == client._retries + 1
+
+    def _async_client(self, pages=2, fail=0):
+        class Connection(object):
+            """A fake python-ldap connection with asynchronous operations."""
+            def __init__(self):
+                self.msgid = 0
+                self.outstanding = {}
+            def _request(self, result):
+                if failures:
+                    failures.pop()
+                    raise ldap.SERVER_DOWN
+                self.msgid += 1
+                self.outstanding[self.msgid] = [2, result]
+                return self.msgid
+            def search_ext(self, base, scope, filter, attrs, attrsonly,
+                           serverctrls):
+                page = 0
+                if serverctrls:
+                    cookie = serverctrls[0].controlValue[1]
+                    page = cookie and int(cookie) or 0
+                entries = [ ('cn=%d-%d,%s' % (page, i, base), {})
+                            for i in range(2) ]
+                ctrls = []
+                if serverctrls:
+                    cookie = page + 1 < pages and str(page + 1) or ''
+                    ctrls = [ ldap.controls.SimplePagedResultsControl(
+                                ldap.LDAP_CONTROL_PAGE_OID, True,
+                                (2, cookie)) ]
+                return self._request((ldap.RES_SEARCH_RESULT, entries,
+                                      ctrls))
+            def add_ext(self, dn, attrs):
+                return self._request((ldap.RES_ADD, [], []))
+            def delete_ext(self, dn):
+                return self._request(ldap.NO_SUCH_OBJECT)
+            def compare_ext(self, dn, attr, value):
+                if value == 'x':
+                    return self._request(ldap.COMPARE_TRUE)
+                return self._request(ldap.COMPARE_FALSE)
+            def result3(self, msgid, all, timeout):
+                # Each result becomes available on the second poll.
+                entry = self.outstanding[msgid]
+                entry[0] -= 1
+                if entry[0]:
+                    return None, None, None, None
+                del self.outstanding[msgid]
+                if not isinstance(entry[1], tuple):
+                    raise entry[1]
+                type, data, ctrls = entry[1]
+                return type, data, msgid, ctrls
+            def abandon(self, msgid):
+                del self.outstanding[msgid]
+            def get_option(self, option):
+                raise ldap.LDAPError
+            def unbind_s(self):
+                pass
+        client = Client('freeadi.org')
+        client.m_locator = Locator()
+        client.m_naming_contexts = ['dc=freeadi,dc=org']
+        client._backoff = 0
+        failures = [None] * fail
+        connections = []
+        def open_connection(nc, server, scheme):
+            conn = Connection()
+            connections.append(conn)
+            client.m_servers[conn] = 'dc1.freeadi.org'
+            return conn
+        client._open_ldap_connection = open_connection
+        return AsyncClient(client), connections
+
+    def test_async_search(self):
+        aclient, connections = self._async_client(pages=3)
+        op1 = aclient.search(base='ou=a,dc=freeadi,dc=org')
+        op2 = aclient.search(base='ou=b,dc=freeadi,dc=org')
+        assert len(connections) == 1
+        assert len(connections[0].outstanding) == 2
+        assert not op1.done()
+        assert aclient.process() == []
+        assert op1.pop() == []
+        assert aclient.process() == []
+        assert [ dn for dn, attrs in op1.pop() ] == \
+                ['cn=0-0,ou=a,dc=freeadi,dc=org',
+                 'cn=0-1,ou=a,dc=freeadi,dc=org']
+        assert op1.pop() == []
+        result = op2.result(5)
+        assert len(result) == 6
+        assert result[-1][0] == 'cn=2-1,ou=b,dc=freeadi,dc=org'
+        assert op1.done()
+        assert aclient.outstanding() == 0
+        stats = aclient.m_client.pool_stats()
+        assert stats[('dc=freeadi,dc=org', None, 'ldap')]['idle'] == 1
+        health = aclient.m_client.m_locator.health()
+        stats = health.stats()['dc1.freeadi.org']
+        assert stats['requests'] == 6
+        assert stats['latency'] is None
+
+    def test_async_search_iter(self):
+        aclient, connections = self._async_client(pages=2)
+        result = aclient.search_iter(base='dc=freeadi,dc=org')
+        assert [ dn for dn, attrs in result ] == \
+                ['cn=0-0,dc=freeadi,dc=org', 'cn=0-1,dc=freeadi,dc=org',
+                 'cn=1-0,dc=freeadi,dc=org', 'cn=1-1,dc=freeadi,dc=org']
+
+    def test_async_update(self):
+        aclient, connections = self._async_client()
+        add = aclient.add('cn=x,dc=freeadi,dc=org', [('cn', ['x'])])
+        delete = aclient.delete('cn=x,dc=freeadi,dc=org')
+        true = aclient.compare('cn=x,dc=freeadi,dc=org', 'cn', 'x')
+        false = aclient.compare('cn=x,dc=freeadi,dc=org', 'cn', 'y')
+        assert add.result(5) == []
+        assert_raises(LDAPError, delete.result, 5)
+        assert true.result(5) is True
+        assert false.result(5) is False
+        assert len(connections) == 1
+
+    def test_async_retry(self):
+        aclient, connections = self._async_client(fail=1)
+        op = aclient.search(base='dc=freeadi,dc=org')
+        assert len(op.result(5)) == 4
+        assert len(connections) == 2
+        assert_raises(TypeError, aclient.compare, 'cn=x', 'cn', 1)
+
+    def test_async_close(self):
+        aclient, connections = self._async_client()
+        search = aclient.search(base='dc=freeadi,dc=org')
+        compare = aclient.compare('cn=x,dc=freeadi,dc=org', 'cn', 'x')
+        aclient.close()
+        assert connections[0].outstanding == {}
+        assert aclient.outstanding() == 0
+        assert search.done()
+        assert_raises(ADError, search.result, 5)
+        assert_raises(ADError, compare.result)
+        assert_raises(ADError, list, search.entries())
+        stats = aclient.m_client.pool_stats()
+        assert stats[('dc=freeadi,dc=org', None, 'ldap')]['idle'] == 1
+
     def _delete_user(self, client, name, server=None):
         # Delete any user that may conflict with a newly to be created user
         filter = '(|(cn=%s)(sAMAccountName=%s)(userPrincipalName=%s))' % \
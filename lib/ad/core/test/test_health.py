@@ -0,0 +1,83 @@
+#
+# This file is part of Python-AD. Python-AD is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
+# "AUTHORS" for a complete overview.
+
+from ad.test.base import BaseTest
+from ad.core.health import HealthRegistry
+
+
+class TestHealthRegistry(BaseTest):
+    """Test suite for HealthRegistry."""
+
+    def test_latency(self):
+        health = HealthRegistry()
+        assert health.latency('dc1.freeadi.org') is None
+        health.success('dc1.freeadi.org', 1.0)
+        assert health.latency('dc1.freeadi.org') == 1.0
+        health.success('DC1.freeadi.org.', 2.0)
+        latency = health.latency('dc1.freeadi.org')
+        assert abs(latency - (1.0 + health._alpha)) < 1e-9
+
+    def test_rtt(self):
+        health = HealthRegistry()
+        health.success('dc1.freeadi.org', 5.0)
+        assert health.rtt('dc1.freeadi.org') is None
+        health.ping('dc1.freeadi.org', 0.1)
+        health.success('dc1.freeadi.org')
+        assert health.rtt('dc1.freeadi.org') == 0.1
+        assert health.latency('dc1.freeadi.org') == 5.0
+        stats = health.stats()['dc1.freeadi.org']
+        assert stats['rtt'] == 0.1
+        assert stats['requests'] == 3
+
+    def test_error_rate(self):
+        health = HealthRegistry()
+        health.failure('dc1.freeadi.org')
+        stats = health.stats()['dc1.freeadi.org']
+        assert abs(stats['error_rate'] - health._alpha) < 1e-9
+        assert stats['failures'] == 1
+        assert stats['requests'] == 1
+        health.success('dc1.freeadi.org', 0.1)
+        stats = health.stats()['dc1.freeadi.org']
+        assert stats['error_rate'] < health._alpha
+        assert stats['failures'] == 0
+        assert stats['requests'] == 2
+
+    def test_circuit_breaker(self):
+        health = HealthRegistry()
+        health._threshold = 2
+        health.failure('dc1.freeadi.org')
+        assert health.available('dc1.freeadi.org')
+        assert health.stats()['dc1.freeadi.org']['state'] == 'closed'
+        health.failure('dc1.freeadi.org')
+        assert not health.available('dc1.freeadi.org')
+        assert health.stats()['dc1.freeadi.org']['state'] == 'open'
+        assert health.available('dc2.freeadi.org')
+        health._cooldown = 0
+        assert health.available('dc1.freeadi.org')
+        assert health.stats()['dc1.freeadi.org']['state'] == 'half-open'
+        health.success('dc1.freeadi.org', 0.1)
+        assert health.stats()['dc1.freeadi.org']['state'] == 'closed'
+
+    def test_down(self):
+        health = HealthRegistry()
+        health.down('dc1.freeadi.org')
+        assert not health.available('dc1.freeadi.org')
+        stats = health.stats()['dc1.freeadi.org']
+        assert stats['state'] == 'open'
+        assert stats['requests'] == 0
+        health._cooldown = 0
+        health.failure('dc1.freeadi.org')
+        assert health.stats()['dc1.freeadi.org']['state'] == 'half-open'
+        health.success('dc1.freeadi.org', 0.1)
+        assert health.stats()['dc1.freeadi.org']['state'] == 'closed'
+
+    def test_clear(self):
+        health = HealthRegistry()
+        health.success('dc1.freeadi.org', 0.1)
+        health.clear()
+        assert health.stats() == {}
@@ -7,10 +7,22 @@
 # "AUTHORS" for a complete overview.
 
 import math
+import time
+import threading
+import shutil
 import signal
+import socket
+import os.path
+import tempfile
+import dns.rrset
+import dns.resolver
+import dns.exception
 
+from nose.tools import assert_raises
 from ad.test.base import BaseTest
-from ad.core.locate import Locator
+from ad.test.cldap import FakeServer
+from ad.core.locate import Locator, FileCache, DNSCache
+from ad.protocol import netlogon
 from threading import Timer
 
 
@@ -24,6 +36,15 @@ class SRV(object):
         self.port = port
 
 
+class Answer(list):
+    """DNS answer for Locator testing."""
+
+    def __init__(self, additional):
+        list.__init__(self)
+        self.response = self
+        self.additional = additional
+
+
 class TestLocator(BaseTest):
     """Test suite for Locator."""
 
@@ -85,6 +106,454 @@ class TestLocator(BaseTest):
             # asserting an error here.
             assert abs(count[x] - n*p) < 6 * stddev(n, p)
 
+    def test_extract_hints_from_srv(self):
+        additional = [ dns.rrset.from_text('dc1.freeadi.org.', 300, 'IN', 'A',
+                                           '10.0.0.1', '10.0.0.2'),
+                       dns.rrset.from_text('dc2.freeadi.org.', 300, 'IN',
+                                           'AAAA', '::1'),
+                       dns.rrset.from_text('dc3.freeadi.org.', 300, 'IN', 'A',
+                                           '10.0.0.3') ]
+        loc = Locator()
+        hints = loc._extract_hints_from_srv(Answer(additional))
+        assert hints['dc1.freeadi.org.'] in ('10.0.0.1', '10.0.0.2')
+        assert 'dc2.freeadi.org.' not in hints
+        assert hints['dc3.freeadi.org.'] == '10.0.0.3'
+        assert loc._extract_hints_from_srv([]) == {}
+
+    def _start_server(self, nports):
+        fname = os.path.join(self.basedir(), 'lib/ad/protocol/test',
+                             'netlogon.bin')
+        fin = file(fname)
+        reply = fin.read()
+        fin.close()
+        server = FakeServer(reply, nports)
+        server.start()
+        return server
+
+    def test_ping_domain_controllers(self):
+        server = self._start_server(4)
+        addrs = server.addresses()
+        try:
+            loc = Locator()
+            replies = loc._ping_domain_controllers(addrs, 'FREEADI.ORG', {},
+                                                   4, lambda r: True)
+        finally:
+            server.stop()
+        assert len(replies) == 4
+
+    def test_ping_domain_controllers_staggered(self):
+        server = self._start_server(1)
+        silent = []
+        for i in range(3):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            silent.append(sock)
+        addrs = [ sock.getsockname() for sock in silent ] + server.addresses()
+        saved = netlogon.Client._timeout
+        netlogon.Client._timeout = 30
+        try:
+            loc = Locator()
+            loc._wave = 1
+            loc._stagger = 0.1
+            begin = time.time()
+            replies = loc._ping_domain_controllers(addrs, 'FREEADI.ORG', {},
+                                                   1, lambda r: True)
+            end = time.time()
+            # Each silent server was pinged once, in its own wave.
+            pings = []
+            for sock in silent:
+                sock.setblocking(False)
+                while True:
+                    try:
+                        sock.recv(4096)
+                    except socket.error:
+                        break
+                    pings.append(sock)
+        finally:
+            netlogon.Client._timeout = saved
+            server.stop()
+            for sock in silent:
+                sock.close()
+        assert len(replies) == 1
+        assert replies[0].q_port == addrs[-1][1]
+        assert pings == silent
+        # The last wave started after three staggers, and the reply was
+        # used without waiting for the silent servers to time out.
+        assert 0.3 <= end - begin < 10
+
+    def test_ping_domain_controllers_checked_concurrently(self):
+        server = self._start_server(4)
+        addrs = server.addresses()
+        lock = threading.Lock()
+        running = [0]
+        overlap = []
+        def check(reply):
+            lock.acquire()
+            running[0] += 1
+            overlap.append(running[0])
+            lock.release()
+            time.sleep(0.3)
+            lock.acquire()
+            running[0] -= 1
+            lock.release()
+            return True
+        try:
+            loc = Locator()
+            loc._wave = 1
+            loc._stagger = 0.1
+            replies = loc._ping_domain_controllers(addrs, 'FREEADI.ORG', {},
+                                                   4, check)
+        finally:
+            server.stop()
+        assert len(replies) == 4
+        # Later waves were started and checked while the first reply was
+        # still being checked.
+        assert len(overlap) == 4
+        assert max(overlap) > 1
+
+    def test_ping_domain_controllers_check_error(self):
+        server = self._start_server(2)
+        addrs = server.addresses()
+        def check(reply):
+            raise ValueError
+        try:
+            loc = Locator()
+            assert_raises(ValueError, loc._ping_domain_controllers, addrs,
+                          'FREEADI.ORG', {}, 2, check)
+        finally:
+            server.stop()
+
+    def test_file_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            cache = FileCache(os.path.join(tmpdir, 'locator'))
+            assert cache.get(('FREEADI.ORG', 'dc', None)) is None
+            cache.put(('FREEADI.ORG', 'dc', None), (1, 2, [{'a': 'b'}]))
+            cache.put(('FREEADI.ORG', 'dc', 'Site/1'), (3, 4, []))
+            assert cache.get(('FREEADI.ORG', 'dc', None)) == \
+                    (1, 2, [{'a': 'b'}])
+            assert cache.get(('FREEADI.ORG', 'dc', 'Site/1')) == (3, 4, [])
+            assert cache.get(('FREEADI.ORG', 'gc', None)) is None
+            directory = os.path.join(tmpdir, 'locator')
+            assert len(os.listdir(directory)) == 2
+            # The cache is private to the user.
+            assert os.stat(directory).st_mode & 0777 == 0700
+            for fname in os.listdir(directory):
+                fname = os.path.join(directory, fname)
+                assert os.stat(fname).st_mode & 0777 == 0600
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_locate_from_file_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            reply = { 'hostname': 'dc1.freeadi.org', 'q_hostname':
+                      'dc1.freeadi.org.', 'q_port': 389, 'q_timing': 0.01,
+                      'checked': True }
+            cache = FileCache(tmpdir)
+            cache.put(('FREEADI.ORG', 'dc', 'Test-Site'),
+                      (time.time(), 3, [reply]))
+            cache.put(('FREEADI.ORG', 'gc', 'Test-Site'),
+                      (time.time() - 3600, 3, [reply]))
+            loc = Locator(site='Test-Site', cachedir=tmpdir)
+            assert loc.locate_many('freeadi.org') == ['dc1.freeadi.org']
+            result = loc.locate_many_ex('freeadi.org')
+            assert result[0].q_timing == 0.01
+            assert loc._load_cache(('FREEADI.ORG', 'gc', 'Test-Site'), 1) \
+                    is None
+            assert loc._load_cache(('FREEADI.ORG', 'dc', 'Test-Site'), 5) \
+                    is None
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def test_dns_cache(self):
+        cache = DNSCache(maxsize=2)
+        now = time.time()
+        cache.put('a', 1, now + 60)
+        cache.put('b', 2, now - 1)
+        assert cache.get('a') == (True, 1)
+        assert cache.get('b') == (False, None)
+        cache.put('c', None, now + 60)
+        cache.put('d', 4, now + 60)
+        assert cache.get('a') == (False, None)
+        assert cache.get('c') == (True, None)
+        assert cache.get('d') == (True, 4)
+        cache.clear()
+        assert cache.get('d') == (False, None)
+
+    def test_dns_query_cached(self):
+        queries = []
+        def query(qname, rdtype):
+            queries.append((qname, rdtype))
+            if qname == 'nonexistent.freeadi.org':
+                raise dns.resolver.NXDOMAIN
+            answer = Answer([])
+            answer.expiration = time.time() + 60
+            return answer
+        saved = dns.resolver.query
+        dns.resolver.query = query
+        try:
+            loc = Locator()
+            answer = loc._dns_query('dc1.freeadi.org', 'A')
+            assert loc._dns_query('DC1.freeadi.org', 'A') is answer
+            assert loc._dns_query('nonexistent.freeadi.org', 'A') == []
+            assert loc._dns_query('nonexistent.freeadi.org', 'A') == []
+            loc._dns_query('dc1.freeadi.org', 'PTR')
+        finally:
+            dns.resolver.query = saved
+        assert len(queries) == 3
+
+    def test_dns_query_error_not_cached(self):
+        queries = []
+        def query(qname, rdtype):
+            queries.append((qname, rdtype))
+            if qname == 'nonexistent.freeadi.org':
+                raise dns.resolver.NXDOMAIN
+            raise dns.exception.Timeout
+        saved = dns.resolver.query
+        dns.resolver.query = query
+        try:
+            loc = Locator()
+            loc._error_timeout = 0
+            assert loc._dns_query('dc1.freeadi.org', 'A') == []
+            assert loc._dns_query('dc1.freeadi.org', 'A') == []
+            assert len(queries) == 2
+            assert loc._dns_query('nonexistent.freeadi.org', 'A') == []
+            assert loc._dns_query('nonexistent.freeadi.org', 'A') == []
+            assert len(queries) == 3
+        finally:
+            dns.resolver.query = saved
+
+    def test_stale_while_revalidate(self):
+        loc = Locator(site='Test-Site')
+        old = netlogon.Reply(hostname='dc1.freeadi.org')
+        new = netlogon.Reply(hostname='dc2.freeadi.org')
+        refreshed = threading.Event()
+        def locate_from_network(domain, role, maxservers, site):
+            refreshed.wait(5)
+            return [new]
+        loc._locate_from_network = locate_from_network
+        stamp = time.time() - loc._timeout - 1
+        loc.m_cache[('FREEADI.ORG', 'dc', 'Test-Site')] = (stamp, 3, [old])
+        assert loc.locate_many('freeadi.org') == ['dc1.freeadi.org']
+        assert loc.locate_many('freeadi.org') == ['dc1.freeadi.org']
+        assert len(loc.m_refreshing) == 1
+        refreshed.set()
+        for i in range(50):
+            if not loc.m_refreshing:
+                break
+            time.sleep(0.1)
+        assert loc.locate_many('freeadi.org') == ['dc2.freeadi.org']
+        assert not loc.m_refreshing
+
+    def test_stale_entry_expired(self):
+        loc = Locator(site='Test-Site')
+        loc._locate_from_network = lambda domain, role, maxservers, site: []
+        stamp = time.time() - loc._timeout - loc._stale - 1
+        reply = netlogon.Reply(hostname='dc1.freeadi.org')
+        loc.m_cache[('FREEADI.ORG', 'dc', 'Test-Site')] = (stamp, 3, [reply])
+        assert loc.locate_many('freeadi.org') == []
+
+    def _reply(self, hostname, site, timing):
+        return netlogon.Reply(hostname=hostname, server_site=site,
+                              q_hostname=hostname + '.', q_port=389,
+                              q_timing=timing, checked=True)
+
+    def test_select_domain_controllers_health(self):
+        loc = Locator(site='Test-Site')
+        replies = [ self._reply('dc1.freeadi.org', 'Other-Site', 0.1),
+                    self._reply('dc2.freeadi.org', 'Other-Site', 0.2),
+                    self._reply('dc3.freeadi.org', 'Test-Site', 0.3) ]
+        addresses = [ (r.q_hostname, r.q_port) for r in replies ]
+        health = loc.health()
+        health.ping('dc1.freeadi.org', 0.5)
+        health.ping('dc2.freeadi.org', 0.2)
+        # Request latencies do not affect the order.
+        health.success('dc2.freeadi.org', 10.0)
+        result = loc._select_domain_controllers(replies, 'dc', 3, addresses)
+        names = [ r.hostname for r in result ]
+        assert names == ['dc3.freeadi.org', 'dc2.freeadi.org',
+                         'dc1.freeadi.org']
+        for i in range(health._threshold):
+            health.failure('dc3.freeadi.org')
+        result = loc._select_domain_controllers(replies, 'dc', 3, addresses)
+        names = [ r.hostname for r in result ]
+        assert names == ['dc2.freeadi.org', 'dc1.freeadi.org']
+        for i in range(health._threshold):
+            health.failure('dc1.freeadi.org')
+            health.failure('dc2.freeadi.org')
+        result = loc._select_domain_controllers(replies, 'dc', 3, addresses)
+        assert len(result) == 3
+
+    def test_ping_domain_controllers_health(self):
+        server = self._start_server(1)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        addrs = server.addresses() + [sock.getsockname()]
+        saved = netlogon.Client._timeout
+        netlogon.Client._timeout = 0.1
+        try:
+            loc = Locator()
+            loc._ping_domain_controllers(addrs, 'FREEADI.ORG', {}, 2,
+                                         lambda r: True)
+        finally:
+            netlogon.Client._timeout = saved
+            server.stop()
+            sock.close()
+        stats = loc.health().stats()
+        assert stats['127.0.0.1']['requests'] == 2
+        assert stats['127.0.0.1']['failures'] == 1
+        assert stats['127.0.0.1']['rtt'] is not None
+        assert stats['127.0.0.1']['latency'] is None
+
+    def test_sufficient_domain_controllers_concurrent(self):
+        loc = Locator()
+        lock = threading.Lock()
+        running = [0]
+        overlap = []
+        def check_domain_controller(reply, role):
+            lock.acquire()
+            running[0] += 1
+            overlap.append(running[0])
+            lock.release()
+            time.sleep(0.2)
+            lock.acquire()
+            running[0] -= 1
+            lock.release()
+            return reply.hostname != 'dc0.freeadi.org'
+        loc._check_domain_controller = check_domain_controller
+        replies = [ netlogon.Reply(hostname='dc%d.freeadi.org' % i)
+                    for i in range(8) ]
+        assert loc._sufficient_domain_controllers(replies, 'dc', 7)
+        assert len(overlap) == 8
+        assert max(overlap) > 1
+        assert [ r.checked for r in replies ] == [False] + [True] * 7
+        assert not loc._sufficient_domain_controllers(replies, 'dc', 8)
+
+    def test_checkers_map(self):
+        loc = Locator()
+        assert loc.m_checkers.map(lambda x: 2*x, range(20)) == \
+                range(0, 40, 2)
+        assert loc.m_checkers.map(lambda x: x, []) == []
+        def fail(x):
+            if x == 3:
+                raise ValueError
+            return x
+        assert_raises(ValueError, loc.m_checkers.map, fail, range(5))
+
+    def test_site_cached(self):
+        loc = Locator()
+        calls = []
+        def detect_site_ex(domain):
+            calls.append(domain)
+            return 'Test-Site', '127.0.0.1'
+        loc._detect_site_ex = detect_site_ex
+        assert loc._site('FREEADI.ORG') == 'Test-Site'
+        assert loc._site('FREEADI.ORG') == 'Test-Site'
+        assert calls == ['FREEADI.ORG']
+        assert loc.m_sites['FREEADI.ORG'][2] == '127.0.0.1'
+        loc = Locator(site='Other-Site')
+        loc._detect_site_ex = detect_site_ex
+        assert loc._site('FREEADI.ORG') == 'Other-Site'
+        assert len(calls) == 1
+
+    def test_site_from_file_cache(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            loc = Locator(cachedir=tmpdir)
+            loc._detect_site_ex = lambda domain: ('Test-Site', '127.0.0.1')
+            assert loc._site('FREEADI.ORG') == 'Test-Site'
+            loc = Locator(cachedir=tmpdir)
+            loc._detect_site_ex = lambda domain: ('Other-Site', '127.0.0.1')
+            assert loc._site('FREEADI.ORG') == 'Test-Site'
+        finally:
+            shutil.rmtree(tmpdir)
+
+    def _wait_refreshed(self, loc):
+        for i in range(50):
+            if not loc.m_refreshing:
+                break
+            time.sleep(0.1)
+        assert not loc.m_refreshing
+
+    def test_site_refreshed_when_address_changes(self):
+        loc = Locator()
+        loc._detect_site_ex = lambda domain: ('Other-Site', '127.0.0.1')
+        entry = (time.time(), 'Test-Site', '10.255.255.1', '127.0.0.1')
+        loc.m_sites['FREEADI.ORG'] = entry
+        assert loc._site('FREEADI.ORG') == 'Test-Site'
+        self._wait_refreshed(loc)
+        assert loc._site('FREEADI.ORG') == 'Other-Site'
+        assert loc.m_sites['FREEADI.ORG'][2] == '127.0.0.1'
+
+    def test_site_address_check_rate_limited(self):
+        loc = Locator()
+        loc._detect_site_ex = lambda domain: ('Test-Site', '127.0.0.1')
+        assert loc._site('FREEADI.ORG') == 'Test-Site'
+        calls = []
+        def local_address(peer):
+            calls.append(peer)
+            return '127.0.0.1'
+        loc._local_address = local_address
+        for i in range(10):
+            assert loc._site('FREEADI.ORG') == 'Test-Site'
+        assert calls == []
+        loc.m_address_checks['FREEADI.ORG'] -= loc._address_check
+        for i in range(10):
+            assert loc._site('FREEADI.ORG') == 'Test-Site'
+        assert calls == ['127.0.0.1']
+
+    def test_site_refreshed_when_expired(self):
+        loc = Locator()
+        loc._detect_site_ex = lambda domain: ('Other-Site', '127.0.0.1')
+        stamp = time.time() - loc._site_timeout - 1
+        loc.m_sites['FREEADI.ORG'] = (stamp, 'Test-Site', '127.0.0.1',
+                                      '127.0.0.1')
+        assert loc._site('FREEADI.ORG') == 'Test-Site'
+        self._wait_refreshed(loc)
+        assert loc._site('FREEADI.ORG') == 'Other-Site'
+
+    def test_cache_keyed_by_site(self):
+        loc = Locator()
+        sites = ['Test-Site']
+        loc._detect_site_ex = lambda domain: (sites[0], '127.0.0.1')
+        def locate_from_network(domain, role, maxservers, site):
+            return [ netlogon.Reply(hostname='dc.%s' % site.lower()) ]
+        loc._locate_from_network = locate_from_network
+        assert loc.locate_many('freeadi.org') == ['dc.test-site']
+        sites[0] = 'Other-Site'
+        stamp = time.time() - loc._site_timeout - 1
+        loc.m_sites['FREEADI.ORG'] = (stamp,) + loc.m_sites['FREEADI.ORG'][1:]
+        assert loc.locate_many('freeadi.org') == ['dc.test-site']
+        self._wait_refreshed(loc)
+        assert loc.locate_many('freeadi.org') == ['dc.other-site']
+
+    def test_site_detection_failure_cached(self):
+        loc = Locator()
+        calls = []
+        def detect_site_ex(domain):
+            calls.append(domain)
+            return None, None
+        loc._detect_site_ex = detect_site_ex
+        assert loc._site('FREEADI.ORG') is None
+        assert loc._site('FREEADI.ORG') is None
+        assert len(calls) == 1
+        stamp = time.time() - loc._negative_timeout - 1
+        loc.m_sites['FREEADI.ORG'] = (stamp, None, None, None)
+        loc._detect_site_ex = lambda domain: ('Test-Site', '127.0.0.1')
+        assert loc._site('FREEADI.ORG') == 'Test-Site'
+
+    def test_site_kept_when_detection_fails(self):
+        loc = Locator()
+        stamp = time.time() - loc._site_timeout - 1
+        loc.m_sites['FREEADI.ORG'] = (stamp, 'Test-Site', '127.0.0.1',
+                                      '127.0.0.1')
+        loc._detect_site_ex = lambda domain: (None, None)
+        assert loc._site('FREEADI.ORG') == 'Test-Site'
+        self._wait_refreshed(loc)
+        assert loc._site('FREEADI.ORG') == 'Test-Site'
+        assert not loc.m_refreshing
+
     def test_detect_site(self):
         self.require(ad_user=True)
         loc = Locator()
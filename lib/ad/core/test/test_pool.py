@@ -0,0 +1,198 @@
+#
+# This file is part of Python-AD. Python-AD is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
+# "AUTHORS" for a complete overview.
+
+import time
+import threading
+
+from nose.tools import assert_raises
+from ad.test.base import BaseTest
+from ad.core.pool import ConnectionPool
+from ad.core.exception import Error as ADError
+
+
+class Connection(object):
+    """A fake connection."""
+
+    def __init__(self, ident):
+        self.ident = ident
+        self.closed = False
+        self.alive = True
+
+
+class TestConnectionPool(BaseTest):
+    """Test suite for ConnectionPool."""
+
+    def _pool(self, **kwargs):
+        created = []
+        def connect():
+            conn = Connection(len(created))
+            created.append(conn)
+            return conn
+        def close(conn):
+            conn.closed = True
+        def check(conn):
+            return conn.alive
+        pool = ConnectionPool(connect, close, check, **kwargs)
+        return pool, created
+
+    def _wait_closed(self, conn):
+        for i in range(50):
+            if conn.closed:
+                break
+            time.sleep(0.01)
+        return conn.closed
+
+    def test_reuse(self):
+        pool, created = self._pool()
+        conn = pool.checkout()
+        pool.checkin(conn)
+        assert pool.checkout() is conn
+        conn2 = pool.checkout()
+        assert conn2 is not conn
+        assert len(created) == 2
+        stats = pool.stats()
+        assert stats['size'] == 2
+        assert stats['in_use'] == 2
+        assert stats['checkouts'] == 3
+        assert stats['created'] == 2
+
+    def test_concurrent_checkouts(self):
+        pool, created = self._pool(maxsize=4)
+        barrier = threading.Semaphore(0)
+        used = []
+        def worker():
+            conn = pool.checkout()
+            used.append(conn)
+            barrier.acquire()
+            pool.checkin(conn)
+        threads = [ threading.Thread(target=worker) for i in range(4) ]
+        for thread in threads:
+            thread.start()
+        for i in range(50):
+            if len(used) == 4:
+                break
+            time.sleep(0.01)
+        assert len(set(used)) == 4
+        for thread in threads:
+            barrier.release()
+        for thread in threads:
+            thread.join()
+        assert pool.stats()['idle'] == 4
+
+    def test_wait_for_connection(self):
+        pool, created = self._pool(maxsize=1)
+        conn = pool.checkout()
+        timer = threading.Timer(0.2, pool.checkin, (conn,))
+        timer.start()
+        assert pool.checkout(timeout=5) is conn
+        stats = pool.stats()
+        assert stats['waits'] == 1
+        assert 0.1 < stats['max_wait'] < 5
+        assert stats['wait_time'] == stats['max_wait']
+
+    def test_timeout(self):
+        pool, created = self._pool(maxsize=1)
+        pool.checkout()
+        assert_raises(ADError, pool.checkout, 0.1)
+
+    def test_discard(self):
+        pool, created = self._pool(maxsize=1)
+        conn = pool.checkout()
+        pool.checkin(conn, discard=True)
+        assert conn.closed
+        conn2 = pool.checkout(timeout=0)
+        assert conn2 is not conn
+        assert pool.stats()['discarded'] == 1
+
+    def test_connect_error(self):
+        def connect():
+            raise ADError, 'error'
+        pool = ConnectionPool(connect, lambda conn: None, maxsize=1)
+        assert_raises(ADError, pool.checkout)
+        assert_raises(ADError, pool.checkout, 0)
+        stats = pool.stats()
+        assert stats['size'] == 0
+        assert stats['checkouts'] == 0
+
+    def test_liveness_check(self):
+        pool, created = self._pool()
+        pool._validate = 0
+        conn = pool.checkout()
+        pool.checkin(conn)
+        conn.alive = False
+        conn2 = pool.checkout()
+        assert conn2 is not conn
+        assert conn.closed
+        stats = pool.stats()
+        assert stats['size'] == 1
+        assert stats['checkouts'] == 2
+
+    def test_idle_eviction(self):
+        pool, created = self._pool(minsize=1, idle=0)
+        conns = [ pool.checkout() for i in range(3) ]
+        for conn in conns:
+            pool.checkin(conn)
+        assert self._wait_closed(conns[0])
+        assert self._wait_closed(conns[1])
+        assert not conns[2].closed
+        stats = pool.stats()
+        assert stats['size'] == 1
+        assert stats['discarded'] == 2
+
+    def test_idle_eviction_timer(self):
+        pool, created = self._pool(idle=0.1)
+        conn = pool.checkout()
+        pool.checkin(conn)
+        assert not conn.closed
+        time.sleep(0.2)
+        assert self._wait_closed(conn)
+        assert pool.stats()['size'] == 0
+
+    def test_fill(self):
+        pool, created = self._pool(minsize=2, idle=0)
+        pool.fill()
+        stats = pool.stats()
+        assert stats['size'] == 2
+        assert stats['idle'] == 2
+        conn = pool.checkout()
+        pool.checkin(conn, discard=True)
+        pool.fill()
+        assert len(created) == 3
+        assert [ conn.closed for conn in created ] == [False, True, False]
+        assert pool.stats()['size'] == 2
+
+    def test_purge(self):
+        pool, created = self._pool()
+        conns = [ pool.checkout() for i in range(3) ]
+        pool.checkin(conns[0])
+        pool.checkin(conns[1])
+        pool.purge(lambda conn: conn.ident in (1, 2))
+        assert conns[1].closed
+        assert not conns[0].closed
+        assert not conns[2].closed
+        stats = pool.stats()
+        assert stats['size'] == 2
+        assert stats['idle'] == 1
+
+    def test_close(self):
+        pool, created = self._pool()
+        conn1 = pool.checkout()
+        conn2 = pool.checkout()
+        pool.checkin(conn1)
+        pool.close()
+        assert conn1.closed
+        assert not conn2.closed
+        pool.checkin(conn2)
+        assert conn2.closed
+        assert pool.stats()['size'] == 0
+        assert_raises(ADError, pool.checkout)
+
+    def test_illegal_size(self):
+        assert_raises(ValueError, ConnectionPool, None, None, maxsize=0)
+        assert_raises(ValueError, ConnectionPool, None, None, minsize=2,
+                      maxsize=1)
@@ -24,14 +24,55 @@ ClassContext = 0x80
 ClassPrivate = 0xc0
 
 import re
+import binascii
 
 
 class Error(Exception):
     """ASN1 error"""
 
 
+def encode_length(length):
+    """Return the encoded form of the length `length'."""
+    if length < 128:
+        return chr(length)
+    values = '%x' % length
+    if len(values) % 2:
+        values = '0' + values
+    values = binascii.unhexlify(values)
+    # really for correctness as this should not happen anytime soon
+    assert len(values) < 127
+    return chr(0x80 | len(values)) + values
+
+
+def _encode_tag_long(nr, typ, cls):
+    """Return the encoded form of a long (>= 31) tag."""
+    values = [ chr(nr & 0x7f) ]
+    nr >>= 7
+    while nr:
+        values.append(chr((nr & 0x7f) | 0x80))
+        nr >>= 7
+    values.append(chr(typ | cls | 0x1f))
+    values.reverse()
+    return ''.join(values)
+
+# Encoded short tags, indexed by (nr | typ | cls).
+_short_tags = [ chr(i) for i in range(256) ]
+
+def _encode_tag(nr, typ, cls):
+    """Return the encoded form of a tag."""
+    if nr < 31:
+        return _short_tags[nr | typ | cls]
+    return _encode_tag_long(nr, typ, cls)
+
+
 class Encoder(object):
-    """A ASN.1 encoder. Uses DER encoding."""
+    """A ASN.1 encoder. Uses DER encoding.
+
+    The output is kept as a flat list of strings. Entering a constructed
+    value reserves a slot in this list for its length, which is filled in
+    when the value is left. This way each byte is copied only once, when
+    the output is joined.
+    """
 
     def __init__(self):
         """Constructor."""
@@ -39,7 +80,9 @@ class Encoder(object):
 
     def start(self):
         """Start encoding."""
-        self.m_stack = [[]]
+        self.m_output = []
+        self.m_size = 0
+        self.m_stack = []
 
     def enter(self, nr, cls=None):
         """Start a constructed data value."""
@@ -47,19 +90,23 @@ class Encoder(object):
             raise Error, 'Encoder not initialized. Call start() first.'
         if cls is None:
             cls = ClassUniversal
-        self._emit_tag(nr, TypeConstructed, cls)
-        self.m_stack.append([])
+        output = self.m_output
+        tag = _encode_tag(nr, TypeConstructed, cls)
+        output.append(tag)
+        output.append(None)
+        self.m_size += len(tag)
+        self.m_stack.append((len(output) - 1, self.m_size))
 
     def leave(self):
         """Finish a constructed data value."""
         if self.m_stack is None:
             raise Error, 'Encoder not initialized. Call start() first.'
-        if len(self.m_stack) == 1:
+        if not self.m_stack:
             raise Error, 'Tag stack is empty.'
-        value = ''.join(self.m_stack[-1])
-        del self.m_stack[-1]
-        self._emit_length(len(value))
-        self._emit(value)
+        slot, start = self.m_stack.pop()
+        length = encode_length(self.m_size - start)
+        self.m_output[slot] = length
+        self.m_size += len(length)
 
     def write(self, value, nr=None, typ=None, cls=None):
         """Write a primitive data value."""
@@ -76,85 +123,46 @@ class Encoder(object):
             typ = TypePrimitive
         if cls is None:
             cls = ClassUniversal
-        value = self._encode_value(nr, value)
-        self._emit_tag(nr, typ, cls)
-        self._emit_length(len(value))
-        self._emit(value)
+        if cls == ClassUniversal:
+            value = self._encode_value(nr, value)
+        else:
+            value = self._encode_implicit_value(value)
+        length = len(value)
+        if length < 128:
+            length = chr(length)
+        else:
+            length = encode_length(length)
+        data = _encode_tag(nr, typ, cls) + length + value
+        self.m_output.append(data)
+        self.m_size += len(data)
+
+    def append(self, data):
+        """Append the already encoded data value(s) `data'."""
+        if self.m_stack is None:
+            raise Error, 'Encoder not initialized. Call start() first.'
+        self._emit(data)
 
     def output(self):
         """Return the encoded output."""
         if self.m_stack is None:
             raise Error, 'Encoder not initialized. Call start() first.'
-        if len(self.m_stack) != 1:
+        if self.m_stack:
             raise Error, 'Stack is not empty.'
-        output = ''.join(self.m_stack[0])
+        output = ''.join(self.m_output)
         return output
 
-    def _emit_tag(self, nr, typ, cls):
-        """Emit a tag."""
-        if nr < 31:
-            self._emit_tag_short(nr, typ, cls)
-        else:
-            self._emit_tag_long(nr, typ, cls)
-
-    def _emit_tag_short(self, nr, typ, cls):
-        """Emit a short (< 31 bytes) tag."""
-        assert nr < 31
-        self._emit(chr(nr | typ | cls))
-
-    def _emit_tag_long(self, nr, typ, cls):
-        """Emit a long (>= 31 bytes) tag."""
-        head = chr(typ | cls | 0x1f)
-        self._emit(head)
-        values = []
-        values.append((nr & 0x7f))
-        nr >>= 7
-        while nr:
-            values.append((nr & 0x7f) | 0x80)
-            nr >>= 7
-        values.reverse()
-        values = map(chr, values)
-        for val in values:
-            self._emit(val)
-
-    def _emit_length(self, length):
-        """Emit length octects."""
-        if length < 128:
-            self._emit_length_short(length)
-        else:
-            self._emit_length_long(length)
-
-    def _emit_length_short(self, length):
-        """Emit the short length form (< 128 octets)."""
-        assert length < 128
-        self._emit(chr(length))
-
-    def _emit_length_long(self, length):
-        """Emit the long length form (>= 128 octets)."""
-        values = []
-        while length:
-            values.append(length & 0xff)
-            length >>= 8
-        values.reverse()
-        values = map(chr, values)
-        # really for correctness as this should not happen anytime soon
-        assert len(values) < 127
-        head = chr(0x80 | len(values))
-        self._emit(head)
-        for val in values:
-            self._emit(val)
-
     def _emit(self, s):
         """Emit raw bytes."""
         assert isinstance(s, str)
-        self.m_stack[-1].append(s)
+        self.m_output.append(s)
+        self.m_size += len(s)
 
     def _encode_value(self, nr, value):
         """Encode a value."""
-        if nr in (Integer, Enumerated):
-            value = self._encode_integer(value)
-        elif nr == OctetString:
+        if nr == OctetString:
             value = self._encode_octet_string(value)
+        elif nr in (Integer, Enumerated):
+            value = self._encode_integer(value)
         elif nr == Boolean:
             value = self._encode_boolean(value)
         elif nr == Null:
@@ -163,37 +171,38 @@ class Encoder(object):
             value = self._encode_object_identifier(value)
         return value
 
+    def _encode_implicit_value(self, value):
+        """Encode a value with a non-universal tag. The encoding is selected
+        based on the Python type of the value."""
+        if isinstance(value, bool):
+            value = self._encode_boolean(value)
+        elif isinstance(value, int) or isinstance(value, long):
+            value = self._encode_integer(value)
+        elif value is None:
+            value = self._encode_null()
+        return value
+
     def _encode_boolean(self, value):
         """Encode a boolean."""
         return value and '\xff' or '\x00'
 
     def _encode_integer(self, value):
         """Encode an integer."""
+        if -0x80 <= value < 0x80:
+            return chr(value & 0xff)
         if value < 0:
-            value = -value
-            negative = True
-            limit = 0x80
+            magnitude = ~value
         else:
-            negative = False
-            limit = 0x7f
-        values = []
-        while value > limit:
-            values.append(value & 0xff)
-            value >>= 8
-        values.append(value & 0xff)
-        if negative:
+            magnitude = value
+        values = '%x' % magnitude
+        if len(values) % 2:
+            values = '0' + values
+        if values[0] in '89abcdef':
+            values = '00' + values
+        if value < 0:
             # create two's complement
-            for i in range(len(values)):
-                values[i] = 0xff - values[i]
-            for i in range(len(values)):
-                values[i] += 1
-                if values[i] <= 0xff:
-                    break
-                assert i != len(values)-1
-                values[i] = 0x00
-        values.reverse()
-        values = map(chr, values)
-        return ''.join(values)
+            values = '%x' % (value + (1 << (4 * len(values))))
+        return binascii.unhexlify(values)
 
     def _encode_octet_string(self, value):
         """Encode an octetstring."""
@@ -227,18 +236,26 @@ class Encoder(object):
 
 
 class Decoder(object):
-    """A ASN.1 decoder. Understands BER (and DER which is a subset)."""
+    """A ASN.1 decoder. Understands BER (and DER which is a subset).
+
+    The decoder walks its input by offset only. Entering a constructed value
+    pushes the (index, end) bounds of its contents on a stack and does not
+    copy any data, so nested values are never copied more than once.
+    """
 
     def __init__(self):
         """Constructor."""
+        self.m_input = None
         self.m_stack = None
         self.m_tag = None
 
     def start(self, data):
-        """Start processing `data'."""
-        if not isinstance(data, str):
-            raise Error, 'Expecting string instance.'
-        self.m_stack = [[0, data]]
+        """Start processing `data'. The input can be a string or a buffer
+        object."""
+        if not isinstance(data, str) and not isinstance(data, buffer):
+            raise Error, 'Expecting string or buffer instance.'
+        self.m_input = data
+        self.m_stack = [[0, len(data)]]
         self.m_tag = None
 
     def peek(self):
@@ -260,7 +277,11 @@ class Decoder(object):
             return None
         tag = self.peek()
         length = self._read_length()
-        value = self._read_value(tag[0], length)
+        if tag[2] == ClassUniversal:
+            value = self._read_value(tag[0], length)
+        else:
+            # Implicitly tagged: the type is not known here.
+            value = self._read_bytes(length)
         self.m_tag = None
         return (tag, value)
 
@@ -276,8 +297,11 @@ class Decoder(object):
         if typ != TypeConstructed:
             raise Error, 'Cannot enter a non-constructed tag.'
         length = self._read_length()
-        bytes = self._read_bytes(length)
-        self.m_stack.append([0, bytes])
+        index, end = self.m_stack[-1]
+        if index + length > end:
+            raise Error, 'Premature end of input.'
+        self.m_stack[-1][0] += length
+        self.m_stack.append([index, index + length])
         self.m_tag = None
 
     def leave(self):
@@ -351,29 +375,28 @@ class Decoder(object):
 
     def _read_byte(self):
         """Return the next input byte, or raise an error on end-of-input."""
-        index, input = self.m_stack[-1]
-        try:
-            byte = ord(input[index])
-        except IndexError:
+        index, end = self.m_stack[-1]
+        if index >= end:
             raise Error, 'Premature end of input.'
+        byte = ord(self.m_input[index])
         self.m_stack[-1][0] += 1
         return byte
 
     def _read_bytes(self, count):
         """Return the next `count' bytes of input. Raise error on
         end-of-input."""
-        index, input = self.m_stack[-1]
-        bytes = input[index:index+count]
-        if len(bytes) != count:
+        index, end = self.m_stack[-1]
+        if index + count > end:
             raise Error, 'Premature end of input.'
+        bytes = self.m_input[index:index+count]
         self.m_stack[-1][0] += count
         return bytes
 
     def _end_of_input(self):
         """Return True if we are at the end of input."""
-        index, input = self.m_stack[-1]
-        assert not index > len(input)
-        return index == len(input)
+        index, end = self.m_stack[-1]
+        assert not index > end
+        return index == end
 
     def _decode_integer(self, bytes):
         """Decode an integer value."""
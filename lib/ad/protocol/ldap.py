@@ -6,6 +6,13 @@
 # Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
 # "AUTHORS" for a complete overview.
 
+import time
+import errno
+import socket
+import select
+import weakref
+import threading
+
 from ad.protocol import asn1
 from ad.protocol import ldapfilter
 
@@ -19,11 +26,190 @@ DEREF_IN_SEARCHING = 1
 DEREF_FINDING_BASE_OBJ = 2
 DEREF_ALWAYS = 3
 
+MOD_ADD = 0
+MOD_DELETE = 1
+MOD_REPLACE = 2
+
+# Protocol operations
+BIND_REQUEST = 0
+BIND_RESPONSE = 1
+UNBIND_REQUEST = 2
+SEARCH_REQUEST = 3
+SEARCH_RESULT_ENTRY = 4
+SEARCH_RESULT_DONE = 5
+MODIFY_REQUEST = 6
+MODIFY_RESPONSE = 7
+ADD_REQUEST = 8
+ADD_RESPONSE = 9
+DEL_REQUEST = 10
+DEL_RESPONSE = 11
+MODDN_REQUEST = 12
+MODDN_RESPONSE = 13
+COMPARE_REQUEST = 14
+COMPARE_RESPONSE = 15
+ABANDON_REQUEST = 16
+SEARCH_RESULT_REFERENCE = 19
+EXTENDED_REQUEST = 23
+EXTENDED_RESPONSE = 24
+INTERMEDIATE_RESPONSE = 25
+
+# Result codes
+SUCCESS = 0
+OPERATIONS_ERROR = 1
+PROTOCOL_ERROR = 2
+TIME_LIMIT_EXCEEDED = 3
+SIZE_LIMIT_EXCEEDED = 4
+COMPARE_FALSE = 5
+COMPARE_TRUE = 6
+REFERRAL = 10
+SASL_BIND_IN_PROGRESS = 14
+NO_SUCH_OBJECT = 32
+INVALID_CREDENTIALS = 49
+BUSY = 51
+UNAVAILABLE = 52
+UNWILLING_TO_PERFORM = 53
+OTHER = 80
+
+NOTICE_OF_DISCONNECTION = '1.3.6.1.4.1.1466.20036'
+
 
 class Error(Exception):
     """LDAP Error"""
 
 
+class ResultError(Error):
+    """An LDAP operation completed with an error result code."""
+
+    def __init__(self, code, matcheddn='', message='', referrals=None):
+        """Constructor."""
+        Error.__init__(self, code, message)
+        self.code = code
+        self.matcheddn = matcheddn
+        self.message = message
+        self.referrals = referrals or []
+
+    def __str__(self):
+        """Return a string representation."""
+        if self.message:
+            return 'LDAP result code %d: %s' % (self.code, self.message)
+        return 'LDAP result code %d' % self.code
+
+
+class Message(object):
+    """A decoded LDAP response message.
+
+    Every message has the attributes `msgid', `op' and `controls'. The
+    controls are a list of (oid, critical, value) tuples. Depending on the
+    protocol operation, the following attributes are set as well:
+
+     * search result entries: `dn' and `attrs'
+     * search result references: `urls'
+     * responses: `code', `matcheddn', `message' and `referrals'
+     * bind responses: `creds', the server SASL credentials or None
+     * extended and intermediate responses: `name' and `value'
+    """
+
+    def __init__(self, **kwargs):
+        """Constructor."""
+        for key in kwargs:
+            setattr(self, key, kwargs[key])
+
+
+# Compiled filter templates and parsed filters, see
+# Client.encode_filter_template() and Client.create_search_request().
+_skeletons = weakref.WeakKeyDictionary()
+
+
+class StreamDecoder(object):
+    """Incremental decoder for a stream of LDAP messages.
+
+    Data is passed to feed() as it arrives, for example from partial socket
+    reads. The decoder keeps track of the length of the LDAPMessage that is
+    currently outstanding and only buffers data until that message is
+    complete.
+    """
+
+    _maxsize = 16 * 1024 * 1024
+
+    def __init__(self, maxsize=None):
+        """Constructor."""
+        if maxsize is None:
+            maxsize = self._maxsize
+        self.m_maxsize = maxsize
+        self.m_chunks = []
+        self.m_available = 0
+        self.m_needed = None
+
+    def feed(self, data):
+        """Feed `data' to the decoder. Return a list of the complete
+        LDAPMessage encodings that are available, in order. Each of these
+        can be passed to Client.parse_message_header() and
+        Client.parse_search_result()."""
+        if data:
+            self.m_chunks.append(data)
+            self.m_available += len(data)
+        messages = []
+        if self.m_needed is not None and self.m_available < self.m_needed:
+            return messages
+        # Join the buffered data once, and split off the complete messages
+        # by offset, so that a large read is not copied for every message.
+        if len(self.m_chunks) == 1:
+            buffer = self.m_chunks[0]
+        else:
+            buffer = ''.join(self.m_chunks)
+        offset = 0
+        while True:
+            if self.m_needed is None:
+                self.m_needed = self._message_length(buffer, offset)
+                if self.m_needed is None:
+                    break
+            if len(buffer) - offset < self.m_needed:
+                break
+            messages.append(buffer[offset:offset+self.m_needed])
+            offset += self.m_needed
+            self.m_needed = None
+        if offset:
+            buffer = buffer[offset:]
+        if buffer:
+            self.m_chunks = [buffer]
+        else:
+            self.m_chunks = []
+        self.m_available = len(buffer)
+        return messages
+
+    def pending(self):
+        """Return the number of bytes buffered for an incomplete
+        message."""
+        return self.m_available
+
+    def _message_length(self, buffer, offset):
+        """Return the total length of the message that starts at `offset'
+        in `buffer', or None if not enough data is available to determine
+        it."""
+        if offset >= len(buffer):
+            return
+        if ord(buffer[offset]) != asn1.Sequence | asn1.TypeConstructed:
+            raise Error, 'LDAP syntax error'
+        if len(buffer) - offset < 2:
+            return
+        byte = ord(buffer[offset+1])
+        if byte & 0x80:
+            count = byte & 0x7f
+            if count == 0 or count > 4:
+                raise Error, 'LDAP syntax error'
+            if len(buffer) - offset < 2 + count:
+                return
+            length = 0
+            for byte in buffer[offset+2:offset+2+count]:
+                length = (length << 8) | ord(byte)
+            length += 2 + count
+        else:
+            length = byte + 2
+        if length > self.m_maxsize:
+            raise Error, 'LDAP message too large.'
+        return length
+
+
 class Client(object):
     """LDAP client."""
 
@@ -41,38 +227,310 @@ class Client(object):
             encoder.leave()
         elif isinstance(filter, ldapfilter.NOT):
             encoder.enter(2, asn1.ClassContext)
-            self._encode_filter(encoder, term)
+            self._encode_filter(encoder, filter.term)
             encoder.leave()
         elif isinstance(filter, ldapfilter.EQUALS):
             encoder.enter(3, asn1.ClassContext)
             encoder.write(filter.type)
             encoder.write(filter.value)
             encoder.leave()
-        elif isinstance(filter, ldapfilter.LTE):
+        elif isinstance(filter, ldapfilter.GTE):
             encoder.enter(5, asn1.ClassContext)
             encoder.write(filter.type)
             encoder.write(filter.value)
             encoder.leave()
-        elif isinstance(filter, ldapfilter.GTE):
+        elif isinstance(filter, ldapfilter.LTE):
             encoder.enter(6, asn1.ClassContext)
             encoder.write(filter.type)
             encoder.write(filter.value)
             encoder.leave()
         elif isinstance(filter, ldapfilter.PRESENT):
-            encoder.enter(7, asn1.ClassContext)
-            encoder.write(filter.type)
-            encoder.leave()
+            encoder.write(filter.type, 7, asn1.TypePrimitive,
+                          asn1.ClassContext)
         elif isinstance(filter, ldapfilter.APPROX):
             encoder.enter(8, asn1.ClassContext)
             encoder.write(filter.type)
             encoder.write(filter.value)
             encoder.leave()
+        elif isinstance(filter, ldapfilter.SUBSTRING):
+            encoder.enter(4, asn1.ClassContext)
+            encoder.write(filter.type)
+            encoder.enter(asn1.Sequence)
+            if filter.initial:
+                encoder.write(filter.initial, 0, asn1.TypePrimitive,
+                              asn1.ClassContext)
+            for value in filter.any:
+                encoder.write(value, 1, asn1.TypePrimitive, asn1.ClassContext)
+            if filter.final:
+                encoder.write(filter.final, 2, asn1.TypePrimitive,
+                              asn1.ClassContext)
+            encoder.leave()
+            encoder.leave()
+        elif isinstance(filter, ldapfilter.EXTENSIBLE):
+            encoder.enter(9, asn1.ClassContext)
+            self._encode_extensible_match(encoder, filter)
+            encoder.leave()
+
+    def _encode_extensible_match(self, encoder, filter):
+        """Encode the MatchingRuleAssertion of an extensible match. The
+        matchValue is omitted if it is None."""
+        if filter.rule:
+            encoder.write(filter.rule, 1, asn1.TypePrimitive,
+                          asn1.ClassContext)
+        if filter.type:
+            encoder.write(filter.type, 2, asn1.TypePrimitive,
+                          asn1.ClassContext)
+        if filter.value is not None:
+            encoder.write(filter.value, 3, asn1.TypePrimitive,
+                          asn1.ClassContext)
+        if filter.dnattrs:
+            encoder.write(True, 4, asn1.TypePrimitive, asn1.ClassContext)
+
+    _filter_tags = { ldapfilter.AND: 0, ldapfilter.OR: 1, ldapfilter.NOT: 2,
+                     ldapfilter.EQUALS: 3, ldapfilter.GTE: 5,
+                     ldapfilter.LTE: 6, ldapfilter.APPROX: 8,
+                     ldapfilter.EXTENSIBLE: 9 }
+
+    def _compile_filter(self, filter):
+        """Compile a parsed filter containing ldapfilter.PARAM values into
+        a skeleton. A skeleton is either a string with a constant encoding,
+        a (tag, index) tuple for a parameter, or a (tag, parts) tuple for a
+        constructed value whose length depends on a parameter."""
+        if isinstance(filter, ldapfilter.AND) or \
+                isinstance(filter, ldapfilter.OR):
+            parts = [ self._compile_filter(term) for term in filter.terms ]
+        elif isinstance(filter, ldapfilter.NOT):
+            parts = [ self._compile_filter(filter.term) ]
+        elif isinstance(filter, ldapfilter.PRESENT) or \
+                isinstance(filter, ldapfilter.SUBSTRING) or \
+                not isinstance(filter.value, ldapfilter.PARAM):
+            parts = []
+        elif isinstance(filter, ldapfilter.EXTENSIBLE):
+            head = ldapfilter.EXTENSIBLE(filter.type, filter.rule, None,
+                                         False)
+            encoder = asn1.Encoder()
+            encoder.start()
+            self._encode_extensible_match(encoder, head)
+            parts = [ encoder.output(),
+                      (chr(3 | asn1.ClassContext), filter.value.index) ]
+            if filter.dnattrs:
+                encoder.start()
+                encoder.write(True, 4, asn1.TypePrimitive, asn1.ClassContext)
+                parts.append(encoder.output())
+        else:
+            encoder = asn1.Encoder()
+            encoder.start()
+            encoder.write(filter.type)
+            parts = [ encoder.output(),
+                      (chr(asn1.OctetString), filter.value.index) ]
+        for part in parts:
+            if not isinstance(part, str):
+                break
+        else:
+            encoder = asn1.Encoder()
+            encoder.start()
+            self._encode_filter(encoder, filter)
+            return encoder.output()
+        tag = chr(self._filter_tags[type(filter)] | asn1.TypeConstructed |
+                  asn1.ClassContext)
+        return (tag, parts)
+
+    def _bind_filter(self, skeleton, params):
+        """Return the encoding of the filter skeleton `skeleton' with
+        `params' bound to its parameters."""
+        if isinstance(skeleton, str):
+            return skeleton
+        tag, parts = skeleton
+        if isinstance(parts, int):
+            value = params[parts]
+        else:
+            value = ''.join([ self._bind_filter(part, params)
+                              for part in parts ])
+        return tag + asn1.encode_length(len(value)) + value
+
+    def encode_filter_template(self, template, params):
+        """Return the BER encoding of the ldapfilter.Template `template'
+        with `params' bound to its parameters.
+
+        The template is compiled into a skeleton on first use. Afterwards,
+        only the encoded parameters need to be spliced in.
+        """
+        template._check_params(params)
+        skeleton = _skeletons.get(template)
+        if skeleton is None:
+            skeleton = self._compile_filter(template.filter())
+            _skeletons[template] = skeleton
+        return self._bind_filter(skeleton, params)
+
+    def _enter_message(self, encoder, msgid):
+        """Start encoding an LDAPMessage with message ID `msgid'."""
+        if msgid is None:
+            msgid = 1
+        encoder.start()
+        encoder.enter(asn1.Sequence)  # LDAPMessage
+        encoder.write(msgid)
+
+    def _leave_message(self, encoder, controls):
+        """Finish encoding an LDAPMessage, adding the (oid, critical, value)
+        tuples in `controls', and return the encoding."""
+        if controls:
+            encoder.enter(0, asn1.ClassContext)  # controls
+            for oid, critical, value in controls:
+                encoder.enter(asn1.Sequence)
+                encoder.write(oid)
+                if critical:
+                    encoder.write(True, asn1.Boolean)
+                if value is not None:
+                    encoder.write(value)
+                encoder.leave()
+            encoder.leave()  # end of controls
+        encoder.leave()  # end of LDAPMessage
+        return encoder.output()
+
+    def _encode_attributes(self, encoder, attrs):
+        """Encode a list of (type, values) tuples as a sequence of
+        attributes."""
+        encoder.enter(asn1.Sequence)
+        for type, values in attrs:
+            encoder.enter(asn1.Sequence)
+            encoder.write(type)
+            encoder.enter(asn1.Set)
+            for value in values:
+                encoder.write(value)
+            encoder.leave()
+            encoder.leave()
+        encoder.leave()
+
+    def create_bind_request(self, dn='', password='', msgid=None,
+                            controls=None, mechanism=None, credentials=None):
+        """Create a bind request. If `mechanism' is given, this is a SASL
+        bind with optional `credentials', and `password' is ignored.
+        Otherwise this is a simple bind."""
+        encoder = asn1.Encoder()
+        self._enter_message(encoder, msgid)
+        encoder.enter(BIND_REQUEST, asn1.ClassApplication)
+        encoder.write(3)  # version
+        encoder.write(dn)
+        if mechanism is None:
+            encoder.write(password, 0, asn1.TypePrimitive, asn1.ClassContext)
+        else:
+            encoder.enter(3, asn1.ClassContext)  # SaslCredentials
+            encoder.write(mechanism)
+            if credentials is not None:
+                encoder.write(credentials)
+            encoder.leave()
+        encoder.leave()  # end of BindRequest
+        return self._leave_message(encoder, controls)
+
+    def create_unbind_request(self, msgid=None):
+        """Create an unbind request."""
+        encoder = asn1.Encoder()
+        self._enter_message(encoder, msgid)
+        encoder.write(None, UNBIND_REQUEST, asn1.TypePrimitive,
+                      asn1.ClassApplication)
+        return self._leave_message(encoder, None)
+
+    def create_add_request(self, dn, attrs, msgid=None, controls=None):
+        """Create an add request. `attrs' is a list of (type, values)
+        tuples."""
+        encoder = asn1.Encoder()
+        self._enter_message(encoder, msgid)
+        encoder.enter(ADD_REQUEST, asn1.ClassApplication)
+        encoder.write(dn)
+        self._encode_attributes(encoder, attrs)
+        encoder.leave()  # end of AddRequest
+        return self._leave_message(encoder, controls)
+
+    def create_modify_request(self, dn, mods, msgid=None, controls=None):
+        """Create a modify request. `mods' is a list of (op, type, values)
+        tuples, with op one of MOD_ADD, MOD_DELETE or MOD_REPLACE."""
+        encoder = asn1.Encoder()
+        self._enter_message(encoder, msgid)
+        encoder.enter(MODIFY_REQUEST, asn1.ClassApplication)
+        encoder.write(dn)
+        encoder.enter(asn1.Sequence)  # changes
+        for op, type, values in mods:
+            encoder.enter(asn1.Sequence)
+            encoder.write(op, asn1.Enumerated)
+            encoder.enter(asn1.Sequence)  # modification
+            encoder.write(type)
+            encoder.enter(asn1.Set)
+            for value in values:
+                encoder.write(value)
+            encoder.leave()
+            encoder.leave()  # end of modification
+            encoder.leave()
+        encoder.leave()  # end of changes
+        encoder.leave()  # end of ModifyRequest
+        return self._leave_message(encoder, controls)
+
+    def create_delete_request(self, dn, msgid=None, controls=None):
+        """Create a delete request."""
+        encoder = asn1.Encoder()
+        self._enter_message(encoder, msgid)
+        encoder.write(dn, DEL_REQUEST, asn1.TypePrimitive,
+                      asn1.ClassApplication)
+        return self._leave_message(encoder, controls)
+
+    def create_modrdn_request(self, dn, newrdn, delold=True,
+                              newsuperior=None, msgid=None, controls=None):
+        """Create a modify DN request."""
+        encoder = asn1.Encoder()
+        self._enter_message(encoder, msgid)
+        encoder.enter(MODDN_REQUEST, asn1.ClassApplication)
+        encoder.write(dn)
+        encoder.write(newrdn)
+        encoder.write(bool(delold), asn1.Boolean)
+        if newsuperior is not None:
+            encoder.write(newsuperior, 0, asn1.TypePrimitive,
+                          asn1.ClassContext)
+        encoder.leave()  # end of ModifyDNRequest
+        return self._leave_message(encoder, controls)
+
+    def create_compare_request(self, dn, attr, value, msgid=None,
+                               controls=None):
+        """Create a compare request."""
+        encoder = asn1.Encoder()
+        self._enter_message(encoder, msgid)
+        encoder.enter(COMPARE_REQUEST, asn1.ClassApplication)
+        encoder.write(dn)
+        encoder.enter(asn1.Sequence)  # ava
+        encoder.write(attr)
+        encoder.write(value)
+        encoder.leave()
+        encoder.leave()  # end of CompareRequest
+        return self._leave_message(encoder, controls)
+
+    def create_abandon_request(self, abandon, msgid=None, controls=None):
+        """Create a request to abandon the operation with message ID
+        `abandon'."""
+        encoder = asn1.Encoder()
+        self._enter_message(encoder, msgid)
+        encoder.write(abandon, ABANDON_REQUEST, asn1.TypePrimitive,
+                      asn1.ClassApplication)
+        return self._leave_message(encoder, controls)
+
+    def create_extended_request(self, name, value=None, msgid=None,
+                                controls=None):
+        """Create an extended request with OID `name'."""
+        encoder = asn1.Encoder()
+        self._enter_message(encoder, msgid)
+        encoder.enter(EXTENDED_REQUEST, asn1.ClassApplication)
+        encoder.write(name, 0, asn1.TypePrimitive, asn1.ClassContext)
+        if value is not None:
+            encoder.write(value, 1, asn1.TypePrimitive, asn1.ClassContext)
+        encoder.leave()  # end of ExtendedRequest
+        return self._leave_message(encoder, controls)
 
     def create_search_request(self, dn, filter=None, attrs=None, scope=None,
                               sizelimit=None, timelimit=None, deref=None,
-                              typesonly=None, msgid=None):
-        """Create a search request. This only supports a very simple AND
-        filter."""
+                              typesonly=None, msgid=None, params=None,
+                              controls=None):
+        """Create a search request.
+
+        The `filter' argument can be a string or an ldapfilter.Template. In
+        the latter case, `params' are the values to bind to the template.
+        """
         if filter is None:
             filter = '(objectClass=*)'
         if attrs is None:
@@ -87,30 +545,32 @@ class Client(object):
             deref = DEREF_NEVER
         if typesonly is None:
             typesonly = False
-        if msgid is None:
-            msgid = 1
-        parser = ldapfilter.Parser()
-        parsed =  parser.parse(filter)
+        if isinstance(filter, ldapfilter.Template):
+            if params is None:
+                params = ()
+            encoded = self.encode_filter_template(filter, params)
+        else:
+            parsed = ldapfilter.parse(filter)
+            encoded = _skeletons.get(parsed)
+            if encoded is None:
+                encoded = self._compile_filter(parsed)
+                _skeletons[parsed] = encoded
         encoder = asn1.Encoder()
-        encoder.start()
-        encoder.enter(asn1.Sequence)  # LDAPMessage
-        encoder.write(msgid)
-        encoder.enter(3, asn1.ClassApplication)  # SearchRequest
+        self._enter_message(encoder, msgid)
+        encoder.enter(SEARCH_REQUEST, asn1.ClassApplication)
         encoder.write(dn)
         encoder.write(scope, asn1.Enumerated)
         encoder.write(deref, asn1.Enumerated)
         encoder.write(sizelimit)
         encoder.write(timelimit)
         encoder.write(typesonly, asn1.Boolean)
-        self._encode_filter(encoder, parsed)
+        encoder.append(encoded)
         encoder.enter(asn1.Sequence)  # attributes
         for attr in attrs:
             encoder.write(attr)
         encoder.leave()  # end of attributes
         encoder.leave()  # end of SearchRequest
-        encoder.leave()  # end of LDAPMessage
-        result = encoder.output()
-        return result
+        return self._leave_message(encoder, controls)
 
     def parse_message_header(self, buffer):
         """Parse an LDAP header and return the tuple (messageid,
@@ -126,6 +586,142 @@ class Client(object):
         op = tag[0]
         return (msgid, op)
 
+    def parse_message(self, buffer):
+        """Parse a single LDAP response message and return it as a Message
+        instance."""
+        try:
+            return self._parse_message(buffer)
+        except asn1.Error, err:
+            raise Error, 'LDAP syntax error: %s' % str(err)
+
+    def _parse_message(self, buffer):
+        """Parse a single LDAP response message. See parse_message()."""
+        decoder = asn1.Decoder()
+        decoder.start(buffer)
+        self._check_tag(decoder.peek(), asn1.Sequence)
+        decoder.enter()  # enter LDAPMessage
+        self._check_tag(decoder.peek(), asn1.Integer)
+        msgid = decoder.read()[1]
+        tag = decoder.peek()
+        if tag is None:
+            raise Error, 'LDAP syntax error'
+        op = tag[0]
+        message = Message(msgid=msgid, op=op, controls=[])
+        if op == SEARCH_RESULT_ENTRY:
+            self._check_tag(tag, op, asn1.TypeConstructed,
+                            asn1.ClassApplication)
+            decoder.enter()
+            message.dn, message.attrs = self._parse_entry(decoder)
+            decoder.leave()
+        elif op == SEARCH_RESULT_REFERENCE:
+            self._check_tag(tag, op, asn1.TypeConstructed,
+                            asn1.ClassApplication)
+            decoder.enter()
+            message.urls = self._parse_strings(decoder)
+            decoder.leave()
+        elif op == INTERMEDIATE_RESPONSE:
+            self._check_tag(tag, op, asn1.TypeConstructed,
+                            asn1.ClassApplication)
+            decoder.enter()
+            message.name = self._parse_optional(decoder, 0)
+            message.value = self._parse_optional(decoder, 1)
+            decoder.leave()
+        elif op in (BIND_RESPONSE, SEARCH_RESULT_DONE, MODIFY_RESPONSE,
+                    ADD_RESPONSE, DEL_RESPONSE, MODDN_RESPONSE,
+                    COMPARE_RESPONSE, EXTENDED_RESPONSE):
+            self._check_tag(tag, op, asn1.TypeConstructed,
+                            asn1.ClassApplication)
+            decoder.enter()
+            self._parse_result(decoder, message)
+            if op == BIND_RESPONSE:
+                message.creds = self._parse_optional(decoder, 7)
+            elif op == EXTENDED_RESPONSE:
+                message.name = self._parse_optional(decoder, 10)
+                message.value = self._parse_optional(decoder, 11)
+            decoder.leave()
+        else:
+            raise Error, 'Unknown LDAP protocol operation: %d' % op
+        tag = decoder.peek()
+        if tag is not None:
+            self._check_tag(tag, 0, asn1.TypeConstructed, asn1.ClassContext)
+            decoder.enter()  # controls
+            message.controls = self._parse_controls(decoder)
+            decoder.leave()
+        return message
+
+    def _parse_entry(self, decoder):
+        """Parse the contents of a SearchResultEntry and return a (dn,
+        attrs) tuple."""
+        self._check_tag(decoder.peek(), asn1.OctetString)
+        dn = decoder.read()[1]
+        self._check_tag(decoder.peek(), asn1.Sequence)
+        decoder.enter()  # enter attributes
+        attrs = {}
+        while not decoder.eof():
+            self._check_tag(decoder.peek(), asn1.Sequence)
+            decoder.enter()  # one attribute
+            self._check_tag(decoder.peek(), asn1.OctetString)
+            name = decoder.read()[1]
+            self._check_tag(decoder.peek(), asn1.Set)
+            decoder.enter()  # vals
+            attrs[name] = self._parse_strings(decoder)
+            decoder.leave()
+            decoder.leave()
+        decoder.leave()  # leave attributes
+        return dn, attrs
+
+    def _parse_strings(self, decoder):
+        """Parse octet strings until the end of the current constructed
+        value."""
+        values = []
+        while not decoder.eof():
+            self._check_tag(decoder.peek(), asn1.OctetString)
+            values.append(decoder.read()[1])
+        return values
+
+    def _parse_result(self, decoder, message):
+        """Parse the LDAPResult components into `message'."""
+        self._check_tag(decoder.peek(), asn1.Enumerated)
+        message.code = decoder.read()[1]
+        self._check_tag(decoder.peek(), asn1.OctetString)
+        message.matcheddn = decoder.read()[1]
+        self._check_tag(decoder.peek(), asn1.OctetString)
+        message.message = decoder.read()[1]
+        message.referrals = []
+        tag = decoder.peek()
+        if tag == (3, asn1.TypeConstructed, asn1.ClassContext):
+            decoder.enter()
+            message.referrals = self._parse_strings(decoder)
+            decoder.leave()
+
+    def _parse_optional(self, decoder, nr):
+        """Parse an optional primitive value with context tag `nr'. Return
+        None if it is not present."""
+        tag = decoder.peek()
+        if tag != (nr, asn1.TypePrimitive, asn1.ClassContext):
+            return
+        return decoder.read()[1]
+
+    def _parse_controls(self, decoder):
+        """Parse a list of controls into (oid, critical, value) tuples."""
+        controls = []
+        while not decoder.eof():
+            self._check_tag(decoder.peek(), asn1.Sequence)
+            decoder.enter()
+            self._check_tag(decoder.peek(), asn1.OctetString)
+            oid = decoder.read()[1]
+            critical = False
+            value = None
+            if decoder.peek() == (asn1.Boolean, asn1.TypePrimitive,
+                                  asn1.ClassUniversal):
+                critical = decoder.read()[1]
+            if not decoder.eof():
+                self._check_tag(decoder.peek(), asn1.OctetString)
+                value = decoder.read()[1]
+            decoder.leave()
+            controls.append((oid, critical, value))
+        return controls
+
     def parse_search_result(self, buffer):
         """Parse an LDAP search result.
 
@@ -175,11 +771,15 @@ class Client(object):
                 decoder.leave()  # leave vals
                 decoder.leave()  # leave attribute
             decoder.leave()  # leave attributes
+            decoder.leave()  # leave SearchResultEntry
+            decoder.leave()  # leave LDAPMessage
             messages.append((msgid, dn, attrs))
         return messages
 
     def _check_tag(self, tag, id, typ=None, cls=None):
         """Ensure that `tag' matches with `id', `typ' and `syntax'."""
+        if tag is None:
+            raise Error, 'LDAP syntax error'
         if cls is None:
             cls = asn1.ClassUniversal
         if typ is None:
@@ -195,3 +795,640 @@ class Client(object):
                 raise Error, 'LDAP syntax error'
         if tag[1] != typ or tag[2] != cls:
             raise Error, 'LDAP syntax error'
+
+
+class Operation(object):
+    """An LDAP operation that is outstanding on a Connection.
+
+    Search result entries are collected in `entries' as (dn, attrs) tuples
+    and search result references in `references'. Intermediate responses
+    are collected in `intermediate'. The final response is available as
+    `response' when the operation is done.
+    """
+
+    def __init__(self, connection, msgid, op):
+        """Constructor."""
+        self.m_connection = connection
+        if op == COMPARE_REQUEST:
+            self.m_success = (COMPARE_FALSE, COMPARE_TRUE)
+        elif op == BIND_REQUEST:
+            self.m_success = (SUCCESS, SASL_BIND_IN_PROGRESS)
+        else:
+            self.m_success = (SUCCESS,)
+        self.msgid = msgid
+        self.op = op
+        self.entries = []
+        self.references = []
+        self.intermediate = []
+        self.response = None
+        self.error = None
+
+    def done(self):
+        """Return True if the operation has completed."""
+        return self.response is not None or self.error is not None
+
+    def result(self, timeout=None):
+        """Wait at most `timeout' seconds for the operation to complete,
+        processing the other outstanding operations of the connection as
+        well, and return its result.
+
+        The result of a search is the list of entries, the result of a
+        compare is True or False, the result of an extended operation is a
+        (name, value) tuple, and the result of a bind is the SASL
+        credentials returned by the server, if any. A ResultError is raised
+        if the operation failed.
+        """
+        self.m_connection.wait(self, timeout)
+        if self.error is not None:
+            raise self.error
+        response = self.response
+        if response.code not in self.m_success:
+            raise ResultError(response.code, response.matcheddn,
+                              response.message, response.referrals)
+        if self.op == SEARCH_REQUEST:
+            return self.entries
+        elif self.op == COMPARE_REQUEST:
+            return response.code == COMPARE_TRUE
+        elif self.op == EXTENDED_REQUEST:
+            return (response.name, response.value)
+        elif self.op == BIND_REQUEST:
+            return response.creds
+
+    def _handle(self, message):
+        """Handle the response message `message'."""
+        if message.op == SEARCH_RESULT_ENTRY:
+            self.entries.append((message.dn, message.attrs))
+        elif message.op == SEARCH_RESULT_REFERENCE:
+            self.references.append(message.urls)
+        elif message.op == INTERMEDIATE_RESPONSE:
+            self.intermediate.append(message)
+        else:
+            self.response = message
+
+
+class Connection(object):
+    """An LDAPv3 connection over TCP.
+
+    The request methods send a request and return an Operation without
+    waiting for the response. Many operations can be outstanding on the
+    connection at the same time. Their responses are matched on message
+    ID by process(), which reads all data that is available and does not
+    block unless asked to. An event loop can wait for fileno() to become
+    readable before calling it. Alternatively, Operation.result() waits
+    for a single operation.
+
+    Requests may be sent from several threads at the same time, but
+    responses must be processed by only one thread. See Dispatcher for a
+    way to share connections between threads.
+    """
+
+    _timeout = 30
+    _bufsize = 65536
+    _maxmsgid = 0x7fffffff
+
+    def __init__(self, host, port=389, timeout=None):
+        """Constructor. The connection is opened by connect()."""
+        if timeout is None:
+            timeout = self._timeout
+        self.m_host = host
+        self.m_port = port
+        self.m_timeout = timeout
+        self.m_socket = None
+        self.m_client = Client()
+        self.m_decoder = None
+        self.m_msgid = 0
+        self.m_operations = {}
+        self.m_lock = threading.Lock()
+        self.m_send_lock = threading.Lock()
+
+    def connect(self):
+        """Open the TCP connection."""
+        if self.m_socket is not None:
+            raise Error, 'Connection is already open.'
+        try:
+            sock = socket.create_connection((self.m_host, self.m_port),
+                                            self.m_timeout)
+        except socket.error, err:
+            raise Error, 'Could not connect to %s:%d: %s' % \
+                        (self.m_host, self.m_port, str(err))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.m_socket = sock
+        self.m_decoder = StreamDecoder()
+
+    def fileno(self):
+        """Return the file descriptor of the socket. It becomes readable
+        when a response may be available."""
+        self._check_open()
+        return self.m_socket.fileno()
+
+    def outstanding(self):
+        """Return the number of operations that have not completed."""
+        return len(self.m_operations)
+
+    def close(self):
+        """Unbind and close the connection. Outstanding operations fail."""
+        if self.m_socket is None:
+            return
+        self.m_lock.acquire()
+        try:
+            msgid = self._next_msgid()
+        finally:
+            self.m_lock.release()
+        try:
+            self._send(self.m_client.create_unbind_request(msgid))
+        except Error:
+            pass
+        self._disconnect(Error('Connection closed.'))
+
+    def bind(self, dn='', password='', controls=None):
+        """Start a simple bind."""
+        return self._request(BIND_REQUEST, self.m_client.create_bind_request,
+                             dn, password, controls=controls)
+
+    def sasl_bind(self, mechanism, credentials=None, dn='', controls=None):
+        """Start a SASL bind step with `mechanism' and `credentials'. The
+        result of the operation is the server credentials. A multi-step
+        mechanism needs one bind per step, until the result code is no
+        longer SASL_BIND_IN_PROGRESS."""
+        return self._request(BIND_REQUEST, self.m_client.create_bind_request,
+                             dn, controls=controls, mechanism=mechanism,
+                             credentials=credentials)
+
+    def search(self, base, scope=None, filter=None, attrs=None,
+               sizelimit=None, timelimit=None, controls=None, params=None):
+        """Start a search. The arguments are as for
+        Client.create_search_request()."""
+        return self._request(SEARCH_REQUEST,
+                             self.m_client.create_search_request, base,
+                             filter, attrs, scope, sizelimit, timelimit,
+                             params=params, controls=controls)
+
+    def add(self, dn, attrs, controls=None):
+        """Start adding an object. `attrs' is a list of (type, values)
+        tuples."""
+        return self._request(ADD_REQUEST, self.m_client.create_add_request,
+                             dn, attrs, controls=controls)
+
+    def modify(self, dn, mods, controls=None):
+        """Start modifying an object. `mods' is a list of (op, type, values)
+        tuples."""
+        return self._request(MODIFY_REQUEST,
+                             self.m_client.create_modify_request, dn, mods,
+                             controls=controls)
+
+    def delete(self, dn, controls=None):
+        """Start deleting an object."""
+        return self._request(DEL_REQUEST, self.m_client.create_delete_request,
+                             dn, controls=controls)
+
+    def modrdn(self, dn, newrdn, delold=True, newsuperior=None,
+               controls=None):
+        """Start renaming an object, and optionally moving it to
+        `newsuperior'."""
+        return self._request(MODDN_REQUEST,
+                             self.m_client.create_modrdn_request, dn, newrdn,
+                             delold, newsuperior, controls=controls)
+
+    def compare(self, dn, attr, value, controls=None):
+        """Start comparing an attribute value."""
+        return self._request(COMPARE_REQUEST,
+                             self.m_client.create_compare_request, dn, attr,
+                             value, controls=controls)
+
+    def extended(self, name, value=None, controls=None):
+        """Start an extended operation."""
+        return self._request(EXTENDED_REQUEST,
+                             self.m_client.create_extended_request, name,
+                             value, controls=controls)
+
+    def abandon(self, operation):
+        """Abandon the outstanding operation `operation'. It fails
+        immediately; the server does not respond to an abandon request."""
+        self._check_open()
+        self.m_lock.acquire()
+        try:
+            if self.m_operations.pop(operation.msgid, None) is None:
+                return
+            operation.error = Error('Operation abandoned.')
+            msgid = self._next_msgid()
+        finally:
+            self.m_lock.release()
+        request = self.m_client.create_abandon_request(operation.msgid, msgid)
+        self._send(request)
+
+    def process(self, timeout=0):
+        """Wait up to `timeout' seconds for data to arrive, and handle all
+        responses that are available. Return the list of operations that
+        have completed."""
+        self._check_open()
+        if timeout:
+            try:
+                select.select([self.m_socket], [], [], timeout)
+            except select.error, err:
+                if err.args[0] != errno.EINTR:
+                    raise
+        data = self._receive()
+        messages = []
+        error = None
+        try:
+            for buffer in self.m_decoder.feed(data):
+                messages.append(self.m_client.parse_message(buffer))
+        except Error, err:
+            error = err
+        completed, notice = self._route(messages)
+        if notice is not None:
+            self._unsolicited(notice)
+        elif error is not None:
+            # The stream cannot be resynchronized after a protocol error.
+            self._disconnect(error)
+            raise error
+        elif data == '':
+            self._disconnect(Error('Connection closed by server.'))
+        return completed
+
+    def wait(self, operation, timeout=None):
+        """Process responses until `operation' has completed, waiting at
+        most `timeout' seconds. On timeout, the operation is abandoned."""
+        if timeout is None:
+            timeout = self.m_timeout
+        end = time.time() + timeout
+        while not operation.done():
+            timeleft = end - time.time()
+            if timeleft <= 0:
+                try:
+                    self.abandon(operation)
+                except Error:
+                    pass
+                raise Error, 'Timeout waiting for LDAP response.'
+            self.process(timeleft)
+
+    def _check_open(self):
+        """Raise an error if the connection is not open."""
+        if self.m_socket is None:
+            raise Error, 'Connection is not open. Call connect() first.'
+
+    def _route(self, messages):
+        """Pass the response messages `messages' to their operations.
+        Return a tuple (completed, notice) with the list of operations that
+        have completed and the unsolicited notification that was received,
+        if any. Messages after a notification are ignored."""
+        completed = []
+        self.m_lock.acquire()
+        try:
+            for message in messages:
+                if message.msgid == 0:
+                    return completed, message
+                operation = self.m_operations.get(message.msgid)
+                if operation is None:
+                    continue  # abandoned
+                operation._handle(message)
+                if operation.done():
+                    del self.m_operations[message.msgid]
+                    completed.append(operation)
+        finally:
+            self.m_lock.release()
+        return completed, None
+
+    def _next_msgid(self):
+        """Allocate a message ID that is not in use. The lock must be
+        held."""
+        while True:
+            self.m_msgid += 1
+            if self.m_msgid > self._maxmsgid:
+                self.m_msgid = 1
+            if self.m_msgid not in self.m_operations:
+                return self.m_msgid
+
+    def _request(self, op, create, *args, **kwargs):
+        """Encode a request with `create' and send it."""
+        self._check_open()
+        self.m_lock.acquire()
+        try:
+            msgid = self._next_msgid()
+            operation = Operation(self, msgid, op)
+            self.m_operations[msgid] = operation
+        finally:
+            self.m_lock.release()
+        kwargs['msgid'] = msgid
+        try:
+            self._send(create(*args, **kwargs))
+        except:
+            self.m_lock.acquire()
+            try:
+                self.m_operations.pop(msgid, None)
+            finally:
+                self.m_lock.release()
+            raise
+        return operation
+
+    def _send(self, data):
+        """Send `data' on the socket. Requests from different threads are
+        sent one after the other."""
+        self.m_send_lock.acquire()
+        try:
+            sock = self.m_socket
+            if sock is None:
+                raise Error, 'Connection is not open.'
+            try:
+                sock.sendall(data)
+            except socket.error, err:
+                error = Error('Could not send LDAP request: %s' % str(err))
+            else:
+                return
+        finally:
+            self.m_send_lock.release()
+        self._disconnect(error)
+        raise error
+
+    def _receive(self):
+        """Read the data that is available on the socket. Return None if
+        there is none, or '' if the server closed the connection.
+
+        The socket stays in blocking mode, because other threads may be
+        sending on it. It is only read when select() reports it readable.
+        """
+        sock = self.m_socket
+        if sock is None:
+            raise Error, 'Connection is not open.'
+        result = []
+        while True:
+            try:
+                if not select.select([sock], [], [], 0)[0]:
+                    break
+                data = sock.recv(self._bufsize)
+            except (select.error, socket.error, ValueError), err:
+                if err.args and err.args[0] == errno.EINTR:
+                    continue
+                if self.m_socket is None:
+                    raise Error, 'Connection is not open.'
+                error = Error('Could not receive LDAP response: %s' %
+                              str(err))
+                self._disconnect(error)
+                raise error
+            if not data:
+                if not result:
+                    return ''
+                break
+            result.append(data)
+        if not result:
+            return
+        return ''.join(result)
+
+    def _unsolicited(self, message):
+        """Handle an unsolicited notification. The only one defined is the
+        notice of disconnection, after which the connection is unusable."""
+        code = getattr(message, 'code', OTHER)
+        text = getattr(message, 'message', '') or 'Notice of disconnection.'
+        self._disconnect(ResultError(code, '', text))
+
+    def _disconnect(self, error):
+        """Close the socket and fail the outstanding operations with
+        `error'."""
+        self.m_lock.acquire()
+        try:
+            sock = self.m_socket
+            self.m_socket = None
+            operations = self.m_operations
+            self.m_operations = {}
+            for operation in operations.values():
+                operation.error = error
+        finally:
+            self.m_lock.release()
+        if sock is None:
+            return
+        try:
+            # Wake up a thread that is blocked sending on the socket.
+            sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        sock.close()
+
+
+class Dispatcher(object):
+    """Share LDAP connections between threads.
+
+    The dispatcher multiplexes the operations of any number of threads
+    over the Connection objects in `connections', which must be open. Each
+    operation is sent on the connection with the fewest outstanding
+    operations, without waiting for the operations of other threads. A
+    reader thread routes the responses back by message ID, and
+    Operation.result() waits only for the operation itself.
+
+    At most `maxinflight' operations are outstanding on each connection.
+    When all connections are at that limit, new requests wait until an
+    operation completes. An operation that times out in result() is
+    abandoned, which frees its slot.
+
+    The lock of the dispatcher only protects the selection of a
+    connection. Requests are sent, and responses are decoded, without
+    holding it, so a slow connection does not hold up the others.
+    """
+
+    _maxinflight = 64
+    _poll = 0.05
+    _timeout = 30
+
+    def __init__(self, connections, maxinflight=None, timeout=None):
+        """Constructor."""
+        if maxinflight is None:
+            maxinflight = self._maxinflight
+        if timeout is None:
+            timeout = self._timeout
+        if not connections:
+            raise Error, 'No connections given.'
+        self.m_connections = list(connections)
+        self.m_maxinflight = maxinflight
+        self.m_timeout = timeout
+        self.m_peak = [0] * len(self.m_connections)
+        self.m_sending = [0] * len(self.m_connections)
+        self.m_lock = threading.Lock()
+        self.m_changed = threading.Condition(self.m_lock)
+        self.m_closed = False
+        self.m_thread = threading.Thread(target=self._run)
+        self.m_thread.setDaemon(True)
+        self.m_thread.start()
+
+    def bind(self, *args, **kwargs):
+        """Start a bind. See Connection.bind()."""
+        return self._request('bind', args, kwargs)
+
+    def sasl_bind(self, *args, **kwargs):
+        """Start a SASL bind step. See Connection.sasl_bind()."""
+        return self._request('sasl_bind', args, kwargs)
+
+    def search(self, *args, **kwargs):
+        """Start a search. See Connection.search()."""
+        return self._request('search', args, kwargs)
+
+    def add(self, *args, **kwargs):
+        """Start adding an object. See Connection.add()."""
+        return self._request('add', args, kwargs)
+
+    def modify(self, *args, **kwargs):
+        """Start modifying an object. See Connection.modify()."""
+        return self._request('modify', args, kwargs)
+
+    def delete(self, *args, **kwargs):
+        """Start deleting an object. See Connection.delete()."""
+        return self._request('delete', args, kwargs)
+
+    def modrdn(self, *args, **kwargs):
+        """Start renaming an object. See Connection.modrdn()."""
+        return self._request('modrdn', args, kwargs)
+
+    def compare(self, *args, **kwargs):
+        """Start comparing an attribute value. See Connection.compare()."""
+        return self._request('compare', args, kwargs)
+
+    def extended(self, *args, **kwargs):
+        """Start an extended operation. See Connection.extended()."""
+        return self._request('extended', args, kwargs)
+
+    def abandon(self, operation):
+        """Abandon the outstanding operation `operation'."""
+        for conn in self.m_connections:
+            if conn.m_operations.get(operation.msgid) is operation:
+                try:
+                    conn.abandon(operation)
+                except Error:
+                    pass
+                break
+        self._notify()
+
+    def outstanding(self):
+        """Return the number of outstanding operations."""
+        return sum([ conn.outstanding() for conn in self.m_connections ])
+
+    def stats(self):
+        """Return a list with a dictionary for each connection, with the
+        keys 'outstanding' and 'peak': the number of operations outstanding
+        now and at most."""
+        self.m_lock.acquire()
+        try:
+            return [ { 'outstanding': conn.outstanding(), 'peak': peak }
+                     for conn, peak in zip(self.m_connections, self.m_peak) ]
+        finally:
+            self.m_lock.release()
+
+    def wait(self, operation, timeout=None):
+        """Wait at most `timeout' seconds for `operation' to complete. On
+        timeout, the operation is abandoned."""
+        if timeout is None:
+            timeout = self.m_timeout
+        end = time.time() + timeout
+        self.m_lock.acquire()
+        try:
+            while not operation.done():
+                timeleft = end - time.time()
+                if timeleft <= 0:
+                    break
+                self.m_changed.wait(timeleft)
+        finally:
+            self.m_lock.release()
+        if operation.done():
+            return
+        self.abandon(operation)
+        raise Error, 'Timeout waiting for LDAP response.'
+
+    def close(self):
+        """Close all connections. Outstanding operations fail."""
+        self.m_lock.acquire()
+        try:
+            self.m_closed = True
+            self.m_changed.notifyAll()
+        finally:
+            self.m_lock.release()
+        for conn in self.m_connections:
+            conn.close()
+        self._notify()
+        if threading.currentThread() is not self.m_thread:
+            self.m_thread.join()
+
+    def _request(self, method, args, kwargs):
+        """Send a request with the Connection method `method' on the least
+        loaded connection, waiting for a slot if needed."""
+        end = time.time() + self.m_timeout
+        self.m_lock.acquire()
+        try:
+            while True:
+                if self.m_closed:
+                    raise Error, 'Dispatcher is closed.'
+                index = self._select_connection()
+                if index is not None:
+                    break
+                timeleft = end - time.time()
+                if timeleft <= 0:
+                    raise Error, 'Timeout waiting for an LDAP connection.'
+                self.m_changed.wait(timeleft)
+            # Reserve the slot while the request is being sent.
+            self.m_sending[index] += 1
+        finally:
+            self.m_lock.release()
+        conn = self.m_connections[index]
+        try:
+            operation = getattr(conn, method)(*args, **kwargs)
+            operation.m_connection = self
+        finally:
+            self.m_lock.acquire()
+            try:
+                self.m_peak[index] = max(self.m_peak[index],
+                                         conn.outstanding())
+                self.m_sending[index] -= 1
+                self.m_changed.notifyAll()
+            finally:
+                self.m_lock.release()
+        return operation
+
+    def _select_connection(self):
+        """Return the index of the open connection with the fewest
+        outstanding operations that is below the limit, or None if there
+        is none. The lock must be held."""
+        best = None
+        for i, conn in enumerate(self.m_connections):
+            if conn.m_socket is None:
+                continue
+            count = conn.outstanding() + self.m_sending[i]
+            if count >= self.m_maxinflight:
+                continue
+            if best is None or count < bestcount:
+                best = i
+                bestcount = count
+        if best is None and not [ conn for conn in self.m_connections
+                                  if conn.m_socket is not None ]:
+            raise Error, 'All connections are closed.'
+        return best
+
+    def _notify(self):
+        """Wake up the threads that wait for an operation or a slot."""
+        self.m_lock.acquire()
+        try:
+            self.m_changed.notifyAll()
+        finally:
+            self.m_lock.release()
+
+    def _run(self):
+        """Reader thread: wait for data on any connection and route the
+        responses."""
+        while not self.m_closed:
+            sockets = [ conn.m_socket for conn in self.m_connections ]
+            sockets = [ sock for sock in sockets if sock is not None ]
+            if not sockets:
+                return
+            try:
+                readable = select.select(sockets, [], [], self._poll)[0]
+            except (select.error, socket.error, ValueError):
+                readable = sockets  # a socket was closed; recheck
+            if not readable:
+                continue
+            for conn in self.m_connections:
+                if conn.m_socket is None or conn.m_socket not in readable:
+                    continue
+                try:
+                    conn.process()
+                except Error:
+                    pass  # the connection has been closed
+                except Exception, err:
+                    # Keep the reader alive for the other connections.
+                    conn._disconnect(Error('Could not process LDAP '
+                                           'response: %s' % err))
+            self._notify()
@@ -8,62 +8,125 @@
 
 import re
 from ad.util.parser import Parser as PLYParser
+from ad.util.lru import LRUCache
 
 
 class Error(Exception):
     """LDAP Filter exception"""
 
 
-class AND(object):
+class Node(object):
+    """Base class for filter nodes. Nodes are immutable and hashable, so
+    that parsed filters can be shared."""
+
+    __slots__ = ('_hash', '__weakref__')
+
+    def __init__(self, *args):
+        for name, value in zip(self.__slots__, args):
+            object.__setattr__(self, name, value)
+        object.__setattr__(self, '_hash', hash(self._key()))
+
+    def __setattr__(self, name, value):
+        raise AttributeError, 'Filter nodes are immutable.'
+
+    def _key(self):
+        return (type(self),) + tuple([ getattr(self, name)
+                                       for name in self.__slots__ ])
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if not isinstance(other, Node):
+            return NotImplemented
+        return self._key() == other._key()
+
+    def __ne__(self, other):
+        if not isinstance(other, Node):
+            return NotImplemented
+        return self._key() != other._key()
+
+    def __hash__(self):
+        return self._hash
+
+class AND(Node):
+
+    __slots__ = ('terms',)
 
     def __init__(self, *terms):
-        self.terms = terms
+        Node.__init__(self, terms)
+
+class OR(Node):
 
-class OR(object):
+    __slots__ = ('terms',)
 
     def __init__(self, *terms):
-        self.terms = terms
+        Node.__init__(self, terms)
+
+class NOT(Node):
+
+    __slots__ = ('term',)
+
+class EQUALS(Node):
 
-class NOT(object):
+    __slots__ = ('type', 'value')
 
-    def __init__(self, term):
-        self.term = term
+class LTE(Node):
 
-class EQUALS(object):
+    __slots__ = ('type', 'value')
 
-    def __init__(self, type, value):
-        self.type = type
-        self.value = value
+class GTE(Node):
 
-class LTE(object):
+    __slots__ = ('type', 'value')
 
-    def __init__(self, type, value):
-        self.type = type
-        self.value = value
+class APPROX(Node):
 
-class GTE(object):
+    __slots__ = ('type', 'value')
 
-    def __init__(self, type, value):
-        self.type = type
-        self.value = value
+class PRESENT(Node):
 
-class APPROX(object):
+    __slots__ = ('type',)
 
-    def __init__(self, type, value):
-        self.type = type
-        self.value = value
+class SUBSTRING(Node):
+    """A substring match. `initial' and `final' are None if absent, `any'
+    is a tuple of the middle components."""
 
-class PRESENT(object):
+    __slots__ = ('type', 'initial', 'any', 'final')
 
-    def __init__(self, type):
-        self.type = type
+class EXTENSIBLE(Node):
+    """An extensible match. `type' and `rule' are None if absent."""
+
+    __slots__ = ('type', 'rule', 'value', 'dnattrs')
+
+class PARAM(Node):
+    """A placeholder for a value in a Template."""
+
+    __slots__ = ('index',)
+
+
+re_escape = re.compile(r'\\([0-9a-fA-F]{2})')
+
+def unescape(value):
+    """Unescape a hex encoded string."""
+    pos = 0
+    parts = []
+    while True:
+        mobj = re_escape.search(value, pos)
+        if not mobj:
+            parts.append(value[pos:])
+            break
+        parts.append(value[pos:mobj.start()])
+        ch = chr(int(mobj.group(1), 16))
+        parts.append(ch)
+        pos = mobj.end()
+    result = ''.join(parts)
+    return result
 
 
 class Parser(PLYParser):
     """A parser for LDAP filters (see RFC2254).
 
     The parser is pretty complete. Currently lacking are substring matches and
-    extensible matches.
+    extensible matches. These are supported by DescentParser.
     """
 
     exception = Error
@@ -81,23 +144,9 @@ class Parser(PLYParser):
     t_APPROX = r'~='
     t_PRESENT = r'=\*'
 
-    re_escape = re.compile(r'\\([0-9a-fA-F]{2})')
-
     def _unescape(self, value):
         """Unescape a hex encoded string."""
-        pos = 0
-        parts = []
-        while True:
-            mobj = self.re_escape.search(value, pos)
-            if not mobj:
-                parts.append(value[pos:])
-                break
-            parts.append(value[pos:mobj.start()])
-            ch = chr(int(mobj.group(1), 16))
-            parts.append(ch)
-            pos = mobj.end()
-        result = ''.join(parts)
-        return result
+        return unescape(value)
 
     def t_STRING(self, t):
         r'[^()=&|!<>~*]+'
@@ -150,3 +199,281 @@ class Parser(PLYParser):
             p[0] = APPROX(p[1], p[3])
         elif p[2] == '=*':
             p[0] = PRESENT(p[1])
+
+
+class DescentParser(object):
+    """A recursive descent parser for LDAP filters (see RFC4515).
+
+    This parser accepts the same language as Parser and produces the same
+    result. In addition it supports substring and extensible matches, and
+    allows empty values and all characters that RFC4515 allows in unescaped
+    values. It does not use PLY, is faster, and is the parser that is used
+    by Cache and Template. It keeps no state between calls and can be used
+    by multiple threads at the same time.
+
+    Filters can be nested at most `_maxdepth' levels deep.
+    """
+
+    exception = Error
+    re_string = re.compile(r'[^()=&|!<>~*]+')
+    re_value = re.compile(r'[^()*]*')
+    re_substring = re.compile(r'[^()]*')
+    _maxdepth = 100
+
+    def parse(self, input, fname=None):
+        """Parse the LDAP filter `input'."""
+        if hasattr(input, 'read'):
+            input = input.read()
+        filter, pos = self._parse_filter(input, 0, fname)
+        if pos != len(input):
+            self._error(input, pos, fname)
+        return filter
+
+    def _error(self, input, pos, fname, msg='syntax error'):
+        """Raise a syntax error at position `pos'."""
+        msg = '%s at position %d' % (msg, pos)
+        err = self.exception()
+        if fname:
+            err.fname = fname
+            msg += ' in file %s' % fname
+        err.message = msg
+        raise err
+
+    def _parse_filter(self, input, pos, fname=None, depth=0):
+        """filter : '(' (and | or | not | item) ')'"""
+        if input[pos:pos+1] != '(':
+            self._error(input, pos, fname)
+        if depth >= self._maxdepth:
+            self._error(input, pos, fname, 'filter nested too deeply')
+        pos += 1
+        char = input[pos:pos+1]
+        if char == '&':
+            terms, pos = self._parse_filterlist(input, pos+1, fname, depth+1)
+            filter = AND(*terms)
+        elif char == '|':
+            terms, pos = self._parse_filterlist(input, pos+1, fname, depth+1)
+            filter = OR(*terms)
+        elif char == '!':
+            term, pos = self._parse_filter(input, pos+1, fname, depth+1)
+            filter = NOT(term)
+        else:
+            filter, pos = self._parse_item(input, pos, fname)
+        if input[pos:pos+1] != ')':
+            self._error(input, pos, fname)
+        return filter, pos+1
+
+    def _parse_filterlist(self, input, pos, fname, depth):
+        """filterlist : filter+"""
+        terms = []
+        while True:
+            term, pos = self._parse_filter(input, pos, fname, depth)
+            terms.append(term)
+            if input[pos:pos+1] != '(':
+                break
+        return terms, pos
+
+    def _parse_item(self, input, pos, fname):
+        """item : STRING ('=' | '<=' | '>=' | '~=') STRING
+                | STRING '=' substring
+                | STRING '=*'
+                | extensible
+        """
+        start = pos
+        type, pos = self._parse_string(input, pos, fname)
+        if input.startswith(':=', pos - 1):
+            return self._parse_extensible(input, start, pos, fname)
+        elif input.startswith('=', pos):
+            return self._parse_equals(type, input, pos+1, fname)
+        elif input.startswith('<=', pos):
+            cls = LTE
+        elif input.startswith('>=', pos):
+            cls = GTE
+        elif input.startswith('~=', pos):
+            cls = APPROX
+        else:
+            self._error(input, pos, fname)
+        value, pos = self._parse_value(input, pos+2, fname)
+        return cls(type, value), pos
+
+    def _parse_equals(self, type, input, pos, fname):
+        """Parse the value of an equality, presence or substring match."""
+        mobj = self.re_substring.match(input, pos)
+        if not mobj:
+            self._error(input, pos, fname)
+        value = mobj.group(0)
+        if value == '*':
+            return PRESENT(type), mobj.end()
+        elif '*' not in value:
+            return EQUALS(type, unescape(value)), mobj.end()
+        parts = value.split('*')
+        for part in parts[1:-1]:
+            if not part:
+                self._error(input, pos + value.index('**'), fname)
+        parts = [ unescape(part) for part in parts ]
+        initial = parts[0] or None
+        final = parts[-1] or None
+        return SUBSTRING(type, initial, tuple(parts[1:-1]), final), \
+                mobj.end()
+
+    def _parse_extensible(self, input, start, pos, fname):
+        """extensible : [STRING] [':dn'] [':' rule] ':=' STRING"""
+        components = input[start:pos-1].split(':')
+        type = unescape(components[0]) or None
+        dnattrs = len(components) > 1 and components[1].lower() == 'dn'
+        if dnattrs:
+            del components[1]
+        if len(components) == 2 and components[1]:
+            rule = components[1]
+        elif len(components) == 1 and type:
+            rule = None
+        else:
+            self._error(input, start, fname)
+        value, pos = self._parse_value(input, pos+1, fname)
+        return EXTENSIBLE(type, rule, value, dnattrs), pos
+
+    def _parse_string(self, input, pos, fname):
+        """Parse a STRING token."""
+        mobj = self.re_string.match(input, pos)
+        if not mobj:
+            self._error(input, pos, fname)
+        return unescape(mobj.group(0)), mobj.end()
+
+    def _parse_value(self, input, pos, fname):
+        """Parse an assertion value."""
+        mobj = self.re_value.match(input, pos)
+        if not mobj:
+            self._error(input, pos, fname)
+        return unescape(mobj.group(0)), mobj.end()
+
+
+class Cache(LRUCache):
+    """A bounded, thread-safe LRU cache of parsed filters, keyed by the
+    filter string."""
+
+    def parse(self, filter):
+        """Return the parsed form of `filter'."""
+        found, parsed = self.get(filter)
+        if found:
+            return parsed
+        parsed = DescentParser().parse(filter)
+        self.put(filter, parsed)
+        return parsed
+
+
+_cache = Cache()
+
+def parse(filter):
+    """Parse `filter' using the shared filter cache."""
+    return _cache.parse(filter)
+
+def cache_info():
+    """Return statistics for the shared filter cache."""
+    return _cache.info()
+
+
+re_special = re.compile(r'[\\()=&|!<>~*\x00]')
+
+def escape(value):
+    """Escape `value' for use as a value in an LDAP filter.
+
+    All characters that are special in a filter are hex escaped. This is a
+    superset of what RFC4515 requires.
+    """
+    return re_special.sub(lambda m: '\\%02x' % ord(m.group(0)), value)
+
+
+def _substitute(filter, func):
+    """Return a copy of `filter' in which all values have been replaced by
+    the result of calling `func' on them."""
+    if isinstance(filter, AND) or isinstance(filter, OR):
+        terms = [ _substitute(term, func) for term in filter.terms ]
+        return type(filter)(*terms)
+    elif isinstance(filter, NOT):
+        return NOT(_substitute(filter.term, func))
+    elif isinstance(filter, PRESENT) or isinstance(filter, SUBSTRING):
+        return filter
+    elif isinstance(filter, EXTENSIBLE):
+        return EXTENSIBLE(filter.type, filter.rule, func(filter.value),
+                          filter.dnattrs)
+    else:
+        return type(filter)(filter.type, func(filter.value))
+
+
+class Template(object):
+    """A parameterized LDAP filter.
+
+    A template is a filter in which some of the values are given as a
+    single question mark, for example "(&(objectClass=user)(cn=?))". The
+    template is parsed once. Values are bound to the parameters in order,
+    and are escaped automatically. A value consisting of a literal question
+    mark must be written as "\\3f".
+    """
+
+    re_param = re.compile(r'(?<==)\?(?=\))')
+    _marker = '\x00param%d\x00'
+
+    def __init__(self, template):
+        """Constructor."""
+        self.m_template = template
+        self.m_parts = self.re_param.split(template)
+        self.m_nparams = len(self.m_parts) - 1
+        markers = {}
+        filter = [self.m_parts[0]]
+        for i in range(self.m_nparams):
+            marker = self._marker % i
+            markers[marker] = i
+            filter.append(escape(marker))
+            filter.append(self.m_parts[i+1])
+        parsed = DescentParser().parse(''.join(filter))
+        found = []
+        def replace(value):
+            if value not in markers:
+                return value
+            found.append(markers[value])
+            return PARAM(markers[value])
+        self.m_filter = _substitute(parsed, replace)
+        found.sort()
+        if found != range(self.m_nparams):
+            raise Error, 'Illegal filter template.'
+
+    def template(self):
+        """Return the template string."""
+        return self.m_template
+
+    def nparams(self):
+        """Return the number of parameters in the template."""
+        return self.m_nparams
+
+    def filter(self):
+        """Return the parsed template. Parameters are represented by PARAM
+        nodes."""
+        return self.m_filter
+
+    def _check_params(self, params):
+        """Check that `params' can be bound to this template."""
+        if len(params) != self.m_nparams:
+            m = 'Template requires %d parameters (%d given).'
+            raise Error, m % (self.m_nparams, len(params))
+        for value in params:
+            if not isinstance(value, str):
+                raise Error, 'Template parameters must be strings.'
+
+    def format(self, *params):
+        """Return the filter string with `params' bound to the
+        parameters."""
+        self._check_params(params)
+        result = [self.m_parts[0]]
+        for i in range(self.m_nparams):
+            result.append(escape(params[i]))
+            result.append(self.m_parts[i+1])
+        return ''.join(result)
+
+    def bind(self, *params):
+        """Return the parsed filter with `params' bound to the
+        parameters."""
+        self._check_params(params)
+        def replace(value):
+            if isinstance(value, PARAM):
+                return params[value.index]
+            return value
+        return _substitute(self.m_filter, replace)
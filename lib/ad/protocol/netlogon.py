@@ -11,9 +11,11 @@ import errno
 import socket
 import select
 import random
+import Queue
 
 from ad.util import misc
-from ad.protocol import asn1, ldap
+from ad.util.workers import WorkerPool
+from ad.protocol import asn1, ldap, ldapfilter
 
 
 SERVER_PDC = 0x1
@@ -31,6 +33,9 @@ class Error(Exception):
     """Netlogon error."""
 
 
+_netlogon_filter = ldapfilter.Template('(&(DnsDomain=?)(Host=?)(NtVer=?))')
+
+
 class Reply(object):
     """The result of a NetLogon RPC."""
 
@@ -165,45 +170,172 @@ class Decoder(object):
 class Client(object):
     """A client for the netlogon service.
 
-    This client can make multiple simultaneous netlogon calls.
+    This client can make multiple simultaneous netlogon calls. All calls
+    share a single UDP socket.
+
+    The client can be used in two ways. The call() method blocks until all
+    replies have been received or the timeout has expired. Alternatively,
+    the client can be driven by an external event loop. In that case,
+    start() sends out the queries, after which the loop waits until either
+    fileno() is readable or timeleft() seconds have passed, and then calls
+    process(). This is repeated until done() returns True, after which
+    close() should be called.
+
+    Host names are resolved by a pool of threads once the call is started.
+    A query is sent as soon as its host name has been resolved, so a slow
+    DNS lookup for one host does not delay the queries to the others.
     """
 
     _timeout = 2
     _retries = 3
     _bufsize = 8192
+    _rcvbuf = 4 * 1024 * 1024
+    _resolvers = 8
+    _poll = 0.05
 
     def __init__(self):
         """Constructor."""
         self.m_socket = None
         self.m_queries = {}
+        self.m_unresolved = []
+        self.m_resolvers = WorkerPool(self._resolvers)
+        self.m_resolved = None
+        self.m_pending = 0
         self.m_offset = None
-
-    def query(self, addr, domain):
-        """Add the Netlogon query to `addr' for `domain'."""
+        self.m_timeout = None
+        self.m_retries = None
+        self.m_tries = None
+        self.m_begin = None
+
+    def query(self, addr, domain, address=None):
+        """Add the Netlogon query to `addr' for `domain'.
+
+        The host name in `addr' is resolved when the call is started. If its
+        IP address is already known, for example from the additional section
+        of a DNS SRV reply, it can be passed as `address' instead. Hosts
+        that cannot be resolved are skipped.
+        """
         hostname, port = addr
-        addr = (socket.gethostbyname(hostname), port)
-        self.m_queries[addr] = [hostname, port, domain, None]
+        if address is None and _is_address(hostname):
+            address = hostname
+        if address is None:
+            self.m_unresolved.append((hostname, port, domain))
+        else:
+            self.m_queries[(address, port)] = [hostname, port, domain, None,
+                                               None]
+
+    def call(self, timeout=None, retries=None, want=None, predicate=None):
+        """Wait for results for `timeout' seconds.
+
+        If `want' is given, return as soon as `want' replies have arrived
+        for which `predicate' returns True, or any `want' replies if no
+        predicate is given. Queries that are still outstanding at that point
+        are discarded. All replies received are returned, including the
+        ones that do not satisfy the predicate.
+        """
+        result = []
+        found = 0
+        self.start(timeout, retries)
+        try:
+            while not self.done():
+                if want is not None and found >= want:
+                    break
+                self._wait_readable(self.timeleft())
+                replies = self.process()
+                for reply in replies:
+                    if predicate is None or predicate(reply):
+                        found += 1
+                result += replies
+        finally:
+            self.close()
+        return result
 
-    def call(self, timeout=None, retries=None):
-        """Wait for results for `timeout' seconds."""
+    def start(self, timeout=None, retries=None):
+        """Send out all queries. Each query is tried up to `retries' times,
+        waiting `timeout' seconds for a reply each time."""
         if timeout is None:
             timeout = self._timeout
         if retries is None:
             retries = self._retries
-        result = []
+        self.m_timeout = timeout
+        self.m_retries = retries
+        self.m_tries = 0
         self._create_socket()
-        for i in range(retries):
-            if not self.m_queries:
-                break
+        if retries > 0:
+            self._start_resolvers()
             self._send_all_requests()
-            result += self._wait_for_replies(timeout)
-        self._close_socket()
-        self.m_queries = {}
+
+    def fileno(self):
+        """Return the file descriptor of the socket. The socket becomes
+        readable when a reply may be available."""
+        if self.m_socket is None:
+            raise Error, 'Client not started. Call start() first.'
+        return self.m_socket.fileno()
+
+    def timeleft(self):
+        """Return the number of seconds after which process() needs to be
+        called to handle a retry or timeout, even if no data arrived."""
+        if self.m_socket is None:
+            raise Error, 'Client not started. Call start() first.'
+        if self.done():
+            return 0
+        timeleft = max(0, self.m_begin + self.m_timeout - time.time())
+        if self.m_pending:
+            # Resolved host names are only picked up by process()
+            timeleft = min(timeleft, self._poll)
+        return timeleft
+
+    def done(self):
+        """Return True if there are no more replies to wait for."""
+        if self.m_socket is None:
+            raise Error, 'Client not started. Call start() first.'
+        if self.m_tries == 0:
+            return True
+        if not self.m_queries and not self.m_pending:
+            return True
+        return self.m_tries >= self.m_retries and \
+                time.time() >= self.m_begin + self.m_timeout
+
+    def process(self):
+        """Read all available replies and resend the outstanding queries
+        if the current try has timed out. Return a list of the new
+        replies. This method does not block."""
+        if self.m_socket is None:
+            raise Error, 'Client not started. Call start() first.'
+        self._add_resolved()
+        replies = self._read_replies()
+        if (self.m_queries or self.m_pending) and \
+                self.m_tries < self.m_retries and \
+                time.time() >= self.m_begin + self.m_timeout:
+            self._send_all_requests()
+        return replies
+
+    def outstanding(self):
+        """Return a list of (hostname, port) tuples for the queries that
+        have not been answered yet."""
+        result = [ (query[0], query[1]) for query in self.m_queries.values() ]
+        result += [ (query[0], query[1]) for query in self.m_unresolved ]
         return result
 
+    def close(self):
+        """Close the client. Queries that are still outstanding are
+        discarded."""
+        if self.m_socket is not None:
+            self._close_socket()
+        self.m_queries = {}
+        self.m_unresolved = []
+        self.m_resolved = None
+        self.m_pending = 0
+
     def _create_socket(self):
         """Create an UDP socket for `server':`port'."""
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        # Many replies can arrive at the same time. Make sure they are not
+        # dropped before we get to read them. The kernel may cap this.
+        try:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, self._rcvbuf)
+        except socket.error:
+            pass
         sock.bind(('', 0))
         self.m_socket = sock
 
@@ -222,87 +354,115 @@ class Client(object):
             self.m_offset = 0
         return msgid
 
+    def _start_resolvers(self):
+        """Start resolving the host names of the queries that do not have an
+        address yet."""
+        if not self.m_unresolved:
+            return
+        self.m_resolved = Queue.Queue()
+        for hostname, port, domain in self.m_unresolved:
+            self.m_resolvers.submit(self.m_resolved, _resolve, hostname,
+                                    port, domain)
+        self.m_pending = len(self.m_unresolved)
+        self.m_unresolved = []
+
+    def _add_resolved(self):
+        """Send requests to the hosts that have been resolved since the last
+        call."""
+        while self.m_pending:
+            try:
+                query, address, error = self.m_resolved.get_nowait()
+            except Queue.Empty:
+                break
+            self.m_pending -= 1
+            if address is None:
+                continue
+            hostname, port, domain = query
+            addr = (address, port)
+            if addr in self.m_queries:
+                continue
+            self.m_queries[addr] = [hostname, port, domain, None, None]
+            self._send_request(addr)
+
     def _send_all_requests(self):
         """Send requests to all hosts."""
         for addr in self.m_queries:
-            domain = self.m_queries[addr][2]
-            msgid = self._create_message_id()
-            self.m_queries[addr][3] = msgid
-            packet = self._create_netlogon_query(domain, msgid)
-            self.m_socket.sendto(packet, 0, addr)
-
-    def _wait_for_replies(self, timeout):
-        """Wait one single timeout on all the sockets."""
-        begin = time.time()
-        end = begin + timeout
+            self._send_request(addr)
+        self.m_tries += 1
+        self.m_begin = time.time()
+
+    def _send_request(self, addr):
+        """Send a request to the host with address `addr'."""
+        query = self.m_queries[addr]
+        msgid = self._create_message_id()
+        query[3] = msgid
+        query[4] = time.time()
+        packet = self._create_netlogon_query(query[2], msgid)
+        self.m_socket.sendto(packet, 0, addr)
+
+    def _wait_readable(self, timeout):
+        """Wait up to `timeout' seconds for the socket to become
+        readable."""
+        fds = [ self.m_socket.fileno() ]
+        try:
+            select.select(fds, [], [], timeout)
+        except select.error, err:
+            error = err.args[0]
+            if error != errno.EINTR:
+                raise Error, str(err)  # unrecoverable
+
+    def _read_replies(self):
+        """Read all replies that are available without blocking."""
         replies = []
         while True:
             if not self.m_queries:
                 break
-            timeleft = end - time.time()
-            if timeleft <= 0:
-                break
-            fds = [ self.m_socket.fileno() ]
             try:
-                result = select.select(fds, [], [], timeleft)
-            except select.error, err:
+                data, addr = self.m_socket.recvfrom(self._bufsize,
+                                                    socket.MSG_DONTWAIT)
+            except socket.error, err:
                 error = err.args[0]
                 if error == errno.EINTR:
-                    continue  # interrupted by signal
+                    continue  # signal interrupt
+                elif error == errno.EAGAIN:
+                    break  # no data available now
                 else:
                     raise Error, str(err)  # unrecoverable
-            if not result[0]:
-                continue  # timeout
-            assert fds == result[0]
-            while True:
-                if not self.m_queries:
-                    break
-                try:
-                    data, addr = self.m_socket.recvfrom(self._bufsize,  
-                                                        socket.MSG_DONTWAIT)
-                except socket.error, err:
-                    error = err.args[0]
-                    if error == errno.EINTR:
-                        continue  # signal interrupt
-                    elif error == errno.EAGAIN:
-                        break  # no data available now
-                    else:
-                        raise Error, str(err)  # unrecoverable
-                try:
-                    hostname, port, domain, msgid = self.m_queries[addr]
-                except KeyError:
-                    continue  # someone sent us an erroneous datagram?
-                try:
-                    id, opcode = self._parse_message_header(data)
-                except (asn1.Error, ldap.Error, Error):
-                    continue
-                if id != msgid:
-                    continue
-                del self.m_queries[addr]
-                try:
-                    reply = self._parse_netlogon_reply(data)
-                except (asn1.Error, ldap.Error, Error):
-                    continue
-                if not reply:
-                    continue
-                reply.q_hostname = hostname
-                reply.q_port = port
-                reply.q_domain = domain
-                reply.q_msgid = msgid
-                reply.q_address = addr
-                timing = time.time() - begin
-                reply.q_timing = timing
-                replies.append(reply)
+            try:
+                hostname, port, domain, msgid, sent = self.m_queries[addr]
+            except KeyError:
+                continue  # someone sent us an erroneous datagram?
+            try:
+                id, opcode = self._parse_message_header(data)
+            except (asn1.Error, ldap.Error, Error):
+                continue
+            if id != msgid:
+                continue
+            del self.m_queries[addr]
+            try:
+                reply = self._parse_netlogon_reply(data)
+            except (asn1.Error, ldap.Error, Error):
+                continue
+            if not reply:
+                continue
+            reply.q_hostname = hostname
+            reply.q_port = port
+            reply.q_domain = domain
+            reply.q_msgid = msgid
+            reply.q_address = addr
+            timing = time.time() - sent
+            reply.q_timing = timing
+            replies.append(reply)
         return replies
 
     def _create_netlogon_query(self, domain, msgid):
         """Create a netlogon query for `domain'."""
         client = ldap.Client()
         hostname = misc.hostname()
-        filter = '(&(DnsDomain=%s)(Host=%s)(NtVer=\\06\\00\\00\\00))' % \
-                 (domain, hostname)
+        params = (domain, hostname, '\x06\x00\x00\x00')
         attrs = ('NetLogon',)
-        query = client.create_search_request('', filter, attrs=attrs,
+        query = client.create_search_request('', _netlogon_filter,
+                                             attrs=attrs, params=params,
                                              scope=ldap.SCOPE_BASE, msgid=msgid)
         return query
 
@@ -326,3 +486,33 @@ class Client(object):
         decoder.start(data)
         result = decoder.parse()
         return result
+
+
+def _is_address(hostname):
+    """Return True if `hostname' is an IPv4 address."""
+    try:
+        socket.inet_pton(socket.AF_INET, hostname)
+    except (socket.error, ValueError):
+        return False
+    return True
+
+def _resolve(hostname, port, domain):
+    """Return the IP address of `hostname' for a query, or None if it
+    could not be resolved."""
+    try:
+        return socket.gethostbyname(hostname)
+    except socket.error:
+        return
+
+def ping_many(addrs, domain, timeout=None, retries=None, want=None,
+              predicate=None):
+    """Send a Netlogon query for `domain' to each (hostname, port) tuple in
+    `addrs' and return the replies.
+
+    All queries are outstanding at the same time on a single socket. The
+    `want' and `predicate' arguments are as for Client.call().
+    """
+    client = Client()
+    for addr in addrs:
+        client.query(addr, domain)
+    return client.call(timeout, retries, want, predicate)
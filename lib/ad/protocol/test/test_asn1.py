@@ -200,6 +200,19 @@ class TestEncoder(object):
         res = enc.output()
         assert res == '\x04\x82\xff\xff' + 'x' * 0xffff
 
+    def test_nested_long_length(self):
+        enc = asn1.Encoder()
+        enc.start()
+        enc.enter(asn1.Sequence)
+        enc.enter(asn1.Sequence)
+        enc.write('x' * 0x100)
+        enc.leave()
+        enc.write(1)
+        enc.leave()
+        res = enc.output()
+        assert res == '\x30\x82\x01\x0b\x30\x82\x01\x04\x04\x82\x01\x00' + \
+                      'x' * 0x100 + '\x02\x01\x01'
+
     def test_error_init(self):
         enc = asn1.Encoder()
         assert_raises(asn1.Error, enc.enter, asn1.Sequence)
@@ -227,6 +240,15 @@ class TestEncoder(object):
         assert_raises(asn1.Error, enc.write, 'foo', asn1.ObjectIdentifier)
         assert_raises(asn1.Error, enc.write, 'foo.bar', asn1.ObjectIdentifier)
 
+    def test_implicit_context(self):
+        enc = asn1.Encoder()
+        enc.start()
+        enc.write('foo', 1, asn1.TypePrimitive, asn1.ClassContext)
+        enc.write(True, 4, asn1.TypePrimitive, asn1.ClassContext)
+        enc.write(1, 0, asn1.TypePrimitive, asn1.ClassContext)
+        res = enc.output()
+        assert res == '\x81\x03foo\x84\x01\xff\x80\x01\x01'
+
 
 class TestDecoder(object):
     """Test suite for ASN1 Decoder."""
@@ -457,6 +479,35 @@ class TestDecoder(object):
         tag, val = dec.read()
         assert val == 'x' * 0xffff
 
+    def test_buffer_input(self):
+        buf = buffer('xx\x30\x08\x02\x01\x01\x04\x03foo', 2)
+        dec = asn1.Decoder()
+        dec.start(buf)
+        dec.enter()
+        tag, val = dec.read()
+        assert val == 1
+        tag, val = dec.read()
+        assert isinstance(val, str)
+        assert val == 'foo'
+
+    def test_leave_nested(self):
+        buf = '\x30\x08\x30\x03\x02\x01\x01\x02\x01\x02\x02\x01\x03'
+        dec = asn1.Decoder()
+        dec.start(buf)
+        dec.enter()
+        dec.enter()
+        tag, val = dec.read()
+        assert val == 1
+        assert dec.eof()
+        dec.leave()
+        tag, val = dec.read()
+        assert val == 2
+        assert dec.eof()
+        dec.leave()
+        tag, val = dec.read()
+        assert val == 3
+        assert dec.eof()
+
     def test_read_multiple(self):
         buf = '\x02\x01\x01\x02\x01\x02'
         dec = asn1.Decoder()
@@ -534,6 +585,19 @@ class TestDecoder(object):
         dec.start(buf)
         assert_raises(asn1.Error, dec.read)
 
+    def test_error_constructed_length(self):
+        buf = '\x30\x09\x02\x01\x01\x04\x03foo'
+        dec = asn1.Decoder()
+        dec.start(buf)
+        assert_raises(asn1.Error, dec.enter)
+
+    def test_error_value_exceeds_constructed(self):
+        buf = '\x30\x03\x04\x03foo'
+        dec = asn1.Decoder()
+        dec.start(buf)
+        dec.enter()
+        assert_raises(asn1.Error, dec.read)
+
     def test_error_no_value_bytes(self):
         buf = '\x02\x01'
         dec = asn1.Decoder()
@@ -6,9 +6,14 @@
 # Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
 # "AUTHORS" for a complete overview.
 
+import time
+import socket
 import os.path
+import threading
+from nose.tools import assert_raises
 from ad.test.base import BaseTest
-from ad.protocol import ldap
+from ad.test.ldapserver import FakeServer, encode_entry, encode_result
+from ad.protocol import asn1, ldap, ldapfilter
 
 
 class TestLDAP(BaseTest):
@@ -26,6 +31,18 @@ class TestLDAP(BaseTest):
         fin.close()
         assert req == buf
 
+    def test_encode_search_request_cached(self):
+        client = ldap.Client()
+        filter = '(&(objectClass=user)(sAMAccountName=test))'
+        req1 = client.create_search_request('dc=freeadi,dc=org', filter,
+                                            ('cn',), msgid=1)
+        req2 = client.create_search_request('dc=freeadi,dc=org', filter,
+                                            ('cn',), msgid=0x1234)
+        assert req1[2:5] == '\x02\x01\x01'
+        assert req2[2:6] == '\x02\x02\x12\x34'
+        assert req1[5:] == req2[6:]
+        assert self._encode_filter(filter) in req1
+
     def test_decode_real_search_reply(self):
         client = ldap.Client()
         fname = os.path.join(self.basedir(), 'lib/ad/protocol/test',
@@ -46,3 +63,550 @@ class TestLDAP(BaseTest):
         netlogon = fin.read()
         fin.close()
         assert attrs == { 'netlogon': [netlogon] }
+
+    def _encode_search_entry(self, encoder, msgid, dn, attrs):
+        encoder.enter(asn1.Sequence)  # LDAPMessage
+        encoder.write(msgid)
+        encoder.enter(4, asn1.ClassApplication)  # SearchResultEntry
+        encoder.write(dn)
+        encoder.enter(asn1.Sequence)  # attributes
+        for name, values in attrs:
+            encoder.enter(asn1.Sequence)
+            encoder.write(name)
+            encoder.enter(asn1.Set)
+            for value in values:
+                encoder.write(value)
+            encoder.leave()
+            encoder.leave()
+        encoder.leave()
+        encoder.leave()
+        encoder.leave()
+
+    def _encode_search_done(self, encoder, msgid):
+        encoder.enter(asn1.Sequence)  # LDAPMessage
+        encoder.write(msgid)
+        encoder.enter(5, asn1.ClassApplication)  # SearchResultDone
+        encoder.write(0, asn1.Enumerated)
+        encoder.write('')
+        encoder.write('')
+        encoder.leave()
+        encoder.leave()
+
+    def test_decode_multiple_entries(self):
+        client = ldap.Client()
+        encoder = asn1.Encoder()
+        encoder.start()
+        self._encode_search_entry(encoder, 2, 'cn=foo',
+                                  [('cn', ['foo']), ('x', ['1', '2'])])
+        self._encode_search_entry(encoder, 2, 'cn=bar', [('cn', ['bar'])])
+        self._encode_search_done(encoder, 2)
+        buf = encoder.output()
+        reply = client.parse_search_result(buf)
+        assert len(reply) == 2
+        assert reply[0] == (2, 'cn=foo', { 'cn': ['foo'], 'x': ['1', '2'] })
+        assert reply[1] == (2, 'cn=bar', { 'cn': ['bar'] })
+
+    def test_stream_decoder(self):
+        client = ldap.Client()
+        encoder = asn1.Encoder()
+        encoder.start()
+        self._encode_search_entry(encoder, 3, 'cn=foo', [('cn', ['foo'])])
+        self._encode_search_entry(encoder, 3, 'cn=bar', [('x', ['y' * 300])])
+        self._encode_search_done(encoder, 3)
+        buf = encoder.output()
+        decoder = ldap.StreamDecoder()
+        messages = []
+        for i in range(len(buf)):
+            messages += decoder.feed(buf[i])
+        assert decoder.pending() == 0
+        assert len(messages) == 3
+        assert ''.join(messages) == buf
+        assert client.parse_message_header(messages[0]) == (3, 4)
+        assert client.parse_message_header(messages[2]) == (3, 5)
+        reply = client.parse_search_result(messages[1])
+        assert reply == [(3, 'cn=bar', { 'x': ['y' * 300] })]
+        messages = decoder.feed(buf)
+        assert ''.join(messages) == buf
+
+    def test_stream_decoder_partial(self):
+        encoder = asn1.Encoder()
+        encoder.start()
+        self._encode_search_done(encoder, 1)
+        buf = encoder.output()
+        decoder = ldap.StreamDecoder()
+        assert decoder.feed(buf[:4]) == []
+        assert decoder.feed(buf[4:] + buf[:1]) == [buf]
+        assert decoder.pending() == 1
+
+    def test_stream_decoder_many_messages(self):
+        messages = [ encode_result(i, ldap.ADD_RESPONSE)
+                     for i in range(1, 10001) ]
+        buf = ''.join(messages)
+        decoder = ldap.StreamDecoder()
+        assert decoder.feed(buf) == messages
+        result = []
+        for i in range(0, len(buf), 1000):
+            result += decoder.feed(buf[i:i+1000])
+        assert result == messages
+        assert decoder.pending() == 0
+
+    def test_error_stream_decoder(self):
+        decoder = ldap.StreamDecoder()
+        assert_raises(ldap.Error, decoder.feed, '\x04\x03foo')
+        decoder = ldap.StreamDecoder()
+        assert_raises(ldap.Error, decoder.feed, '\x30\x80')
+        decoder = ldap.StreamDecoder(maxsize=100)
+        assert_raises(ldap.Error, decoder.feed, '\x30\x81\xff')
+
+    def _encode_filter(self, filter):
+        client = ldap.Client()
+        encoder = asn1.Encoder()
+        encoder.start()
+        client._encode_filter(encoder, ldapfilter.parse(filter))
+        return encoder.output()
+
+    def test_encode_filter(self):
+        assert self._encode_filter('(cn=*)') == '\x87\x02cn'
+        assert self._encode_filter('(!(cn=x))') == \
+                '\xa2\x09\xa3\x07\x04\x02cn\x04\x01x'
+        assert self._encode_filter('(cn>=x)')[0] == '\xa5'
+        assert self._encode_filter('(cn<=x)')[0] == '\xa6'
+
+    def test_encode_substring_filter(self):
+        assert self._encode_filter('(cn=jo*n*)') == \
+                '\xa4\x0d\x04\x02cn\x30\x07\x80\x02jo\x81\x01n'
+        assert self._encode_filter('(cn=*a*b)') == \
+                '\xa4\x0c\x04\x02cn\x30\x06\x81\x01a\x82\x01b'
+
+    def test_encode_extensible_filter(self):
+        filt = '(userAccountControl:1.2.840.113556.1.4.803:=2)'
+        assert self._encode_filter(filt) == \
+                '\xa9\x2f\x81\x16' + '1.2.840.113556.1.4.803' + \
+                '\x82\x12userAccountControl\x83\x012'
+        assert self._encode_filter('(cn:dn:=x)') == \
+                '\xa9\x0a\x82\x02cn\x83\x01x\x84\x01\xff'
+        assert self._encode_filter('(:1.2:=x)') == \
+                '\xa9\x08\x81\x031.2\x83\x01x'
+
+    def test_encode_filter_template(self):
+        client = ldap.Client()
+        tmpl = ldapfilter.Template('(&(objectClass=user)(|(cn=?)(!(sn=?)))'
+                                   '(x=*)(y<=z))')
+        for params in (('foo', 'bar'), ('x' * 200, 'y'), ('(*)', 'y' * 70000)):
+            encoded = client.encode_filter_template(tmpl, params)
+            assert encoded == self._encode_filter(tmpl.format(*params))
+        tmpl = ldapfilter.Template('(&(cn=a*b)(memberOf:dn:1.2.3:=?)'
+                                   '(member:1.2.840.113556.1.4.1941:=?))')
+        params = ('cn=x,dc=y', 'z')
+        encoded = client.encode_filter_template(tmpl, params)
+        assert encoded == self._encode_filter(tmpl.format(*params))
+        assert_raises(ldapfilter.Error, client.encode_filter_template,
+                      tmpl, ('foo',))
+
+    def test_search_request_template(self):
+        client = ldap.Client()
+        tmpl = ldapfilter.Template('(&(DnsDomain=?)(Host=?)(NtVer=?))')
+        req = client.create_search_request('', tmpl, ('NetLogon',),
+                                           scope=ldap.SCOPE_BASE, msgid=4,
+                                           params=('FREEADI.ORG', 'magellan',
+                                                   '\x06\x00\x00\x00'))
+        fname = os.path.join(self.basedir(), 'lib/ad/protocol/test',
+                             'searchrequest.bin')
+        fin = file(fname)
+        buf = fin.read()
+        fin.close()
+        assert req == buf
+
+    def test_encode_bind_request(self):
+        client = ldap.Client()
+        req = client.create_bind_request('cn=x', 'pw', msgid=1)
+        assert req == '\x30\x12\x02\x01\x01\x60\x0d\x02\x01\x03' \
+                      '\x04\x04cn=x\x80\x02pw'
+        req = client.create_bind_request(mechanism='GSSAPI', msgid=2)
+        assert req.endswith('\xa3\x08\x04\x06GSSAPI')
+
+    def test_encode_requests(self):
+        client = ldap.Client()
+        req = client.create_delete_request('cn=x', msgid=5)
+        assert req == '\x30\x09\x02\x01\x05\x4a\x04cn=x'
+        req = client.create_abandon_request(5, msgid=6)
+        assert req == '\x30\x06\x02\x01\x06\x50\x01\x05'
+        req = client.create_unbind_request(msgid=7)
+        assert req == '\x30\x05\x02\x01\x07\x42\x00'
+        req = client.create_modify_request('cn=x',
+                        [(ldap.MOD_REPLACE, 'sn', ['y'])], msgid=1)
+        assert req == '\x30\x1d\x02\x01\x01\x66\x18\x04\x04cn=x' \
+                      '\x30\x10\x30\x0e\x0a\x01\x02\x30\x09\x04\x02sn' \
+                      '\x31\x03\x04\x01y'
+        req = client.create_modrdn_request('cn=x', 'cn=y', True, 'ou=z',
+                                           msgid=1)
+        assert req == '\x30\x1a\x02\x01\x01\x6c\x15\x04\x04cn=x' \
+                      '\x04\x04cn=y\x01\x01\xff\x80\x04ou=z'
+        req = client.create_extended_request('1.2.3', msgid=1)
+        assert req == '\x30\x0c\x02\x01\x01\x77\x07\x80\x051.2.3'
+
+    def test_encode_controls(self):
+        client = ldap.Client()
+        req = client.create_delete_request('cn=x', msgid=5,
+                        controls=[('1.2.3', True, 'v'), ('1.2.4', False,
+                                                         None)])
+        assert req.endswith('\xa0\x18\x30\x0d\x04\x051.2.3\x01\x01\xff'
+                            '\x04\x01v\x30\x07\x04\x051.2.4')
+        req = client.create_search_request('dc=x', controls=[('1.2.3',
+                                           False, '')])
+        assert req.endswith('\xa0\x0b\x30\x09\x04\x051.2.3\x04\x00')
+
+    def test_parse_message(self):
+        client = ldap.Client()
+        buf = encode_entry(3, 'cn=foo', [('cn', ['foo']), ('x', [])])
+        message = client.parse_message(buf)
+        assert (message.msgid, message.op) == (3, ldap.SEARCH_RESULT_ENTRY)
+        assert message.dn == 'cn=foo'
+        assert message.attrs == { 'cn': ['foo'], 'x': [] }
+        buf = encode_result(3, ldap.EXTENDED_RESPONSE, 0, 'ok', '1.2.3',
+                            '\x01\x02')
+        message = client.parse_message(buf)
+        assert message.code == 0
+        assert message.message == 'ok'
+        assert message.name == '1.2.3'
+        assert message.value == '\x01\x02'
+        assert message.controls == []
+
+    def test_parse_message_referrals_controls(self):
+        client = ldap.Client()
+        encoder = asn1.Encoder()
+        encoder.start()
+        encoder.enter(asn1.Sequence)
+        encoder.write(4)
+        encoder.enter(ldap.SEARCH_RESULT_DONE, asn1.ClassApplication)
+        encoder.write(ldap.REFERRAL, asn1.Enumerated)
+        encoder.write('dc=x')
+        encoder.write('')
+        encoder.enter(3, asn1.ClassContext)
+        encoder.write('ldap://dc2/')
+        encoder.leave()
+        encoder.leave()
+        encoder.enter(0, asn1.ClassContext)
+        encoder.enter(asn1.Sequence)
+        encoder.write('1.2.840.113556.1.4.319')
+        encoder.write('cookie')
+        encoder.leave()
+        encoder.leave()
+        encoder.leave()
+        message = client.parse_message(encoder.output())
+        assert message.code == ldap.REFERRAL
+        assert message.matcheddn == 'dc=x'
+        assert message.referrals == ['ldap://dc2/']
+        assert message.controls == [('1.2.840.113556.1.4.319', False,
+                                     'cookie')]
+
+    def _respond(self, request):
+        if request.op == ldap.SEARCH_REQUEST:
+            return [ encode_entry(request.msgid, 'cn=%d,%s' %
+                                  (i, request.dn), [('cn', [str(i)])])
+                     for i in range(2) ] + \
+                   [ encode_result(request.msgid, ldap.SEARCH_RESULT_DONE) ]
+        elif request.op == ldap.BIND_REQUEST:
+            if request.dn == 'cn=bad':
+                return [ encode_result(request.msgid, ldap.BIND_RESPONSE,
+                                       ldap.INVALID_CREDENTIALS, 'bad') ]
+            return [ encode_result(request.msgid, ldap.BIND_RESPONSE) ]
+        elif request.op == ldap.COMPARE_REQUEST:
+            return [ encode_result(request.msgid, ldap.COMPARE_RESPONSE,
+                                   ldap.COMPARE_TRUE) ]
+        elif request.op == ldap.EXTENDED_REQUEST:
+            return [ encode_result(request.msgid, ldap.EXTENDED_RESPONSE,
+                                   name='1.2.3', value='v') ]
+        elif request.op == ldap.DEL_REQUEST:
+            return [ encode_result(request.msgid, ldap.DEL_RESPONSE,
+                                   ldap.NO_SUCH_OBJECT) ]
+        response = { ldap.ADD_REQUEST: ldap.ADD_RESPONSE,
+                     ldap.MODIFY_REQUEST: ldap.MODIFY_RESPONSE,
+                     ldap.MODDN_REQUEST: ldap.MODDN_RESPONSE }[request.op]
+        return [ encode_result(request.msgid, response) ]
+
+    def _connect(self, server):
+        host, port = server.address()
+        conn = ldap.Connection(host, port, timeout=5)
+        conn.connect()
+        return conn
+
+    def test_connection(self):
+        server = FakeServer(self._respond)
+        server.start()
+        try:
+            conn = self._connect(server)
+            assert conn.bind('cn=x', 'pw').result() is None
+            error = assert_raises(ldap.ResultError,
+                                  conn.bind('cn=bad', 'pw').result)
+            entries = conn.search('dc=x', filter='(cn=*)').result()
+            assert entries == [('cn=0,dc=x', { 'cn': ['0'] }),
+                               ('cn=1,dc=x', { 'cn': ['1'] })]
+            assert conn.compare('cn=x', 'cn', 'x').result() is True
+            assert conn.extended('1.2.3').result() == ('1.2.3', 'v')
+            assert conn.add('cn=x', [('cn', ['x'])]).result() is None
+            mods = [(ldap.MOD_ADD, 'sn', ['y'])]
+            assert conn.modify('cn=x', mods).result() is None
+            assert conn.modrdn('cn=x', 'cn=y').result() is None
+            try:
+                conn.delete('cn=y').result()
+            except ldap.ResultError, err:
+                assert err.code == ldap.NO_SUCH_OBJECT
+            else:
+                assert False
+            conn.close()
+        finally:
+            server.stop()
+        assert server.requests[-1].op == ldap.UNBIND_REQUEST
+
+    def test_connection_multiplexing(self):
+        server = FakeServer(self._respond, batch=10)
+        server.start()
+        try:
+            conn = self._connect(server)
+            ops = [ conn.search('ou=%d' % i) for i in range(10) ]
+            assert conn.outstanding() == 10
+            completed = []
+            for i in range(50):
+                completed += conn.process(0.1)
+                if len(completed) == 10:
+                    break
+            assert completed[0] is ops[-1]
+            for i, op in enumerate(ops):
+                assert op.done()
+                assert op.result()[0][0] == 'cn=0,ou=%d' % i
+            assert conn.outstanding() == 0
+            conn.close()
+        finally:
+            server.stop()
+        assert server.connections == 1
+
+    def test_connection_abandon_and_close(self):
+        server = FakeServer(self._respond, batch=3)
+        server.start()
+        try:
+            conn = self._connect(server)
+            op1 = conn.search('ou=1')
+            op2 = conn.search('ou=2')
+            conn.abandon(op1)
+            assert_raises(ldap.Error, op1.result)
+            op3 = conn.search('ou=3')
+            assert len(op2.result()) == 2
+            assert op3.result()[1][0] == 'cn=1,ou=3'
+            op4 = conn.search('ou=4')
+            server.disconnect()
+            assert_raises(ldap.Error, op4.result)
+            assert_raises(ldap.Error, conn.search, 'ou=5')
+        finally:
+            server.stop()
+
+    def test_connection_protocol_error(self):
+        bad = { 'ou=bad': '\x04\x00',
+                # SearchResultEntry without contents
+                'ou=empty': '\x30\x05\x02\x01%s\x64\x00',
+                # SearchResultEntry with a truncated DN
+                'ou=short': '\x30\x07\x02\x01%s\x64\x02\x04\x05' }
+        def respond(request):
+            if request.dn in bad:
+                response = bad[request.dn]
+                if '%s' in response:
+                    response = response % chr(request.msgid)
+                return [response]
+            return self._respond(request)
+        server = FakeServer(respond, batch=2)
+        server.start()
+        try:
+            for dn in bad:
+                conn = self._connect(server)
+                op1 = conn.search('ou=1')
+                op2 = conn.search(dn)
+                assert_raises(ldap.Error, op1.result)
+                assert op2.done()
+                assert conn.outstanding() == 0
+                assert conn.m_socket is None
+                assert_raises(ldap.Error, conn.search, 'ou=2')
+        finally:
+            server.stop()
+
+    def _wait_for_request(self, server, op):
+        for i in range(50):
+            if [ req for req in server.requests if req.op == op ]:
+                return True
+            time.sleep(0.01)
+        return False
+
+    def test_connection_timeout(self):
+        def respond(request):
+            if request.dn == 'ou=slow':
+                return []
+            return self._respond(request)
+        server = FakeServer(respond)
+        server.start()
+        try:
+            conn = self._connect(server)
+            op = conn.search('ou=slow')
+            assert_raises(ldap.Error, op.result, 0.1)
+            assert conn.outstanding() == 0
+            assert self._wait_for_request(server, ldap.ABANDON_REQUEST)
+            assert len(conn.search('ou=1').result()) == 2
+            conn.close()
+        finally:
+            server.stop()
+
+    def test_dispatcher(self):
+        server = FakeServer(self._respond)
+        server.start()
+        try:
+            conns = [ self._connect(server) for i in range(2) ]
+            dispatcher = ldap.Dispatcher(conns, maxinflight=4)
+            errors = []
+            def worker(n):
+                try:
+                    for i in range(20):
+                        base = 'ou=%d-%d' % (n, i)
+                        result = dispatcher.search(base).result()
+                        assert result[1][0] == 'cn=1,' + base
+                except Exception, err:
+                    errors.append(err)
+            threads = [ threading.Thread(target=worker, args=(n,))
+                        for n in range(8) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert not errors
+            stats = dispatcher.stats()
+            assert len(stats) == 2
+            for conn in stats:
+                assert conn['outstanding'] == 0
+                assert 1 <= conn['peak'] <= 4
+            dispatcher.close()
+            assert_raises(ldap.Error, dispatcher.search, 'ou=x')
+        finally:
+            server.stop()
+        assert server.connections == 2
+
+    def test_dispatcher_concurrent(self):
+        # The server only answers once 4 requests are outstanding on the
+        # connection, so this only completes if they are multiplexed.
+        server = FakeServer(self._respond, batch=4)
+        server.start()
+        try:
+            dispatcher = ldap.Dispatcher([self._connect(server)])
+            results = {}
+            def worker(n):
+                base = 'ou=%d' % n
+                results[n] = dispatcher.search(base).result(5)
+            threads = [ threading.Thread(target=worker, args=(n,))
+                        for n in range(4) ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            assert len(results) == 4
+            for n in range(4):
+                assert results[n][0][0] == 'cn=0,ou=%d' % n
+            dispatcher.close()
+        finally:
+            server.stop()
+
+    def test_dispatcher_limit(self):
+        server = FakeServer(self._respond, batch=3)
+        server.start()
+        try:
+            dispatcher = ldap.Dispatcher([self._connect(server)],
+                                         maxinflight=2)
+            op1 = dispatcher.search('ou=1')
+            op2 = dispatcher.search('ou=2')
+            ops = []
+            thread = threading.Thread(target=lambda:
+                                      ops.append(dispatcher.search('ou=3')))
+            thread.start()
+            time.sleep(0.2)
+            assert not ops
+            assert dispatcher.outstanding() == 2
+            dispatcher.abandon(op1)
+            thread.join()
+            assert len(op2.result(5)) == 2
+            assert ops[0].result(5)[0][0] == 'cn=0,ou=3'
+            assert_raises(ldap.Error, op1.result)
+            assert dispatcher.outstanding() == 0
+            dispatcher.close()
+        finally:
+            server.stop()
+
+    def test_dispatcher_timeout(self):
+        def respond(request):
+            if request.dn == 'ou=slow':
+                return []
+            return self._respond(request)
+        server = FakeServer(respond)
+        server.start()
+        try:
+            dispatcher = ldap.Dispatcher([self._connect(server)],
+                                         maxinflight=1)
+            for i in range(3):
+                op = dispatcher.search('ou=slow')
+                assert_raises(ldap.Error, op.result, 0.1)
+            assert dispatcher.outstanding() == 0
+            assert len(dispatcher.search('ou=1').result(5)) == 2
+            dispatcher.close()
+        finally:
+            server.stop()
+
+    def test_dispatcher_malformed_response(self):
+        def respond(request):
+            if request.dn == 'ou=bad':
+                # A correctly framed SearchResultEntry without contents.
+                return ['\x30\x05\x02\x01%s\x64\x00' % chr(request.msgid)]
+            return self._respond(request)
+        server = FakeServer(respond)
+        server.start()
+        try:
+            conns = [ self._connect(server) for i in range(2) ]
+            dispatcher = ldap.Dispatcher(conns, maxinflight=1)
+            op = dispatcher.search('ou=bad')
+            assert_raises(ldap.Error, op.result, 5)
+            assert dispatcher.m_thread.isAlive()
+            for i in range(3):
+                assert len(dispatcher.search('ou=%d' % i).result(5)) == 2
+            dispatcher.close()
+        finally:
+            server.stop()
+
+    def test_dispatcher_blocked_connection(self):
+        # A server that does not read its requests. Sending a large request
+        # to it blocks, which must not hold up the other connection.
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+        host, port = listener.getsockname()
+        stuck = ldap.Connection(host, port, timeout=5)
+        stuck.connect()
+        peer = listener.accept()[0]
+        server = FakeServer(self._respond)
+        server.start()
+        try:
+            dispatcher = ldap.Dispatcher([stuck, self._connect(server)])
+            errors = []
+            def sender():
+                value = 'x' * (16 * 1024 * 1024)
+                try:
+                    dispatcher.add('cn=x', [('description', [value])])
+                except ldap.Error, err:
+                    errors.append(err)
+            thread = threading.Thread(target=sender)
+            thread.start()
+            time.sleep(0.2)
+            assert thread.isAlive()
+            begin = time.time()
+            for i in range(5):
+                assert len(dispatcher.search('ou=%d' % i).result(2)) == 2
+            assert time.time() - begin < 2
+            peer.close()
+            thread.join()
+            assert errors
+            dispatcher.close()
+        finally:
+            server.stop()
+            listener.close()
@@ -6,6 +6,7 @@
 # Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
 # "AUTHORS" for a complete overview.
 
+import threading
 from nose.tools import assert_raises
 from ad.protocol import ldapfilter
 
@@ -13,9 +14,11 @@ from ad.protocol import ldapfilter
 class TestLDAPFilterParser(object):
     """Test suite for ad.protocol.ldapfilter."""
 
+    parser = ldapfilter.Parser
+
     def test_equals(self):
         filt = '(type=value)'
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         res = parser.parse(filt)
         assert isinstance(res, ldapfilter.EQUALS)
         assert res.type == 'type'
@@ -23,7 +26,7 @@ class TestLDAPFilterParser(object):
 
     def test_and(self):
         filt = '(&(type=value)(type2=value2))'
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         res = parser.parse(filt)
         assert isinstance(res, ldapfilter.AND)
         assert len(res.terms) == 2
@@ -32,7 +35,7 @@ class TestLDAPFilterParser(object):
 
     def test_and_multi_term(self):
         filt = '(&(type=value)(type2=value2)(type3=value3))'
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         res = parser.parse(filt)
         assert isinstance(res, ldapfilter.AND)
         assert len(res.terms) == 3
@@ -42,7 +45,7 @@ class TestLDAPFilterParser(object):
 
     def test_or(self):
         filt = '(|(type=value)(type2=value2))'
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         res = parser.parse(filt)
         assert isinstance(res, ldapfilter.OR)
         assert len(res.terms) == 2
@@ -51,7 +54,7 @@ class TestLDAPFilterParser(object):
 
     def test_or_multi_term(self):
         filt = '(|(type=value)(type2=value2)(type3=value3))'
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         res = parser.parse(filt)
         assert isinstance(res, ldapfilter.OR)
         assert len(res.terms) == 3
@@ -61,14 +64,14 @@ class TestLDAPFilterParser(object):
 
     def test_not(self):
         filt = '(!(type=value))'
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         res = parser.parse(filt)
         assert isinstance(res, ldapfilter.NOT)
         assert isinstance(res.term, ldapfilter.EQUALS)
 
     def test_lte(self):
         filt = '(type<=value)'
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         res = parser.parse(filt)
         assert isinstance(res, ldapfilter.LTE)
         assert res.type == 'type'
@@ -76,7 +79,7 @@ class TestLDAPFilterParser(object):
 
     def test_gte(self):
         filt = '(type>=value)'
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         res = parser.parse(filt)
         assert isinstance(res, ldapfilter.GTE)
         assert res.type == 'type'
@@ -84,7 +87,7 @@ class TestLDAPFilterParser(object):
 
     def test_approx(self):
         filt = '(type~=value)'
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         res = parser.parse(filt)
         assert isinstance(res, ldapfilter.APPROX)
         assert res.type == 'type'
@@ -92,19 +95,19 @@ class TestLDAPFilterParser(object):
 
     def test_present(self):
         filt = '(type=*)'
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         res = parser.parse(filt)
         assert isinstance(res, ldapfilter.PRESENT)
         assert res.type == 'type'
 
     def test_escape(self):
         filt = r'(type=\5c\00\2a)'
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         res = parser.parse(filt)
         assert res.value == '\\\x00*'
 
     def test_error_incomplete_term(self):
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         filt = '('
         assert_raises(ldapfilter.Error, parser.parse, filt)
         filt = '(type'
@@ -115,16 +118,237 @@ class TestLDAPFilterParser(object):
         assert_raises(ldapfilter.Error, parser.parse, filt)
 
     def test_error_not_multi_term(self):
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         filt = '(!(type=value)(type2=value2))'
         assert_raises(ldapfilter.Error, parser.parse, filt)
 
     def test_error_illegal_operator(self):
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         filt = '($(type=value)(type2=value2))'
         assert_raises(ldapfilter.Error, parser.parse, filt)
 
     def test_error_illegal_character(self):
-        parser = ldapfilter.Parser()
+        parser = self.parser()
         filt = '(type=val*e)'
         assert_raises(ldapfilter.Error, parser.parse, filt)
+
+    def test_reuse(self):
+        parser = self.parser()
+        res = parser.parse('(type=value)')
+        assert isinstance(res, ldapfilter.EQUALS)
+        assert_raises(ldapfilter.Error, parser.parse, '(type=')
+        parser = self.parser()
+        res = parser.parse('(type2>=value2)')
+        assert isinstance(res, ldapfilter.GTE)
+        assert res.type == 'type2'
+        assert res.value == 'value2'
+
+    def test_threads(self):
+        errors = []
+        def parse(n):
+            try:
+                for i in range(50):
+                    filt = '(&(type=%d)(type2=%d))' % (n, i)
+                    res = self.parser().parse(filt)
+                    assert res.terms[0].value == str(n)
+                    assert res.terms[1].value == str(i)
+            except Exception, err:
+                errors.append(err)
+        threads = [ threading.Thread(target=parse, args=(n,))
+                    for n in range(5) ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        assert not errors
+
+    def test_immutable(self):
+        parser = self.parser()
+        res = parser.parse('(&(type=value)(type2=value2))')
+        assert_raises(AttributeError, setattr, res, 'terms', ())
+        assert_raises(AttributeError, setattr, res.terms[0], 'value', 'x')
+
+    def test_hashable(self):
+        parser = self.parser()
+        res1 = parser.parse('(&(type=value)(!(type2=*)))')
+        res2 = parser.parse('(&(type=value)(!(type2=*)))')
+        res3 = parser.parse('(&(type=value)(!(type3=*)))')
+        assert res1 == res2
+        assert hash(res1) == hash(res2)
+        assert res1 != res3
+        assert ldapfilter.EQUALS('a', 'b') != ldapfilter.LTE('a', 'b')
+        assert len(set([res1, res2, res3])) == 2
+
+
+class TestDescentParser(TestLDAPFilterParser):
+    """Run the parser test suite against ldapfilter.DescentParser."""
+
+    parser = ldapfilter.DescentParser
+
+    def test_parity(self):
+        filters = ('(a=b)', '(&(a=b)(!(c>=d))(|(e<=f)(g~=h)(i=*)))',
+                   '( a = b )', r'(a=\28\29\2a\5c)', '(a=b', '(a=b))',
+                   '(&)', '(!)', '(a)', '(a<b)', '((a=b))',
+                   '(& (a=b))', '(a=b)(c=d)', '', ')', '(=b)')
+        for filt in filters:
+            try:
+                expected = ldapfilter.Parser().parse(filt)
+            except ldapfilter.Error:
+                assert_raises(ldapfilter.Error, self.parser().parse, filt)
+            else:
+                assert self.parser().parse(filt) == expected
+
+    def test_error_incomplete_term(self):
+        parser = self.parser()
+        assert_raises(ldapfilter.Error, parser.parse, '(')
+        assert_raises(ldapfilter.Error, parser.parse, '(type')
+        assert_raises(ldapfilter.Error, parser.parse, '(type=')
+
+    def test_empty_value(self):
+        parser = self.parser()
+        assert parser.parse('(type=)') == ldapfilter.EQUALS('type', '')
+        assert parser.parse('(type>=)') == ldapfilter.GTE('type', '')
+        assert parser.parse('(type:=)') == \
+                ldapfilter.EXTENSIBLE('type', None, '', False)
+
+    def test_nesting(self):
+        parser = self.parser()
+        depth = parser._maxdepth
+        filt = '(!' * (depth - 1) + '(a=b)' + ')' * (depth - 1)
+        assert isinstance(parser.parse(filt), ldapfilter.NOT)
+        filt = '(!' * depth + '(a=b)' + ')' * depth
+        assert_raises(ldapfilter.Error, parser.parse, filt)
+        assert_raises(ldapfilter.Error, parser.parse, '(!' * 2000)
+        assert_raises(ldapfilter.Error, parser.parse, '(&' * 2000)
+
+    def test_error_illegal_character(self):
+        parser = self.parser()
+        filt = '(type=val(e)'
+        assert_raises(ldapfilter.Error, parser.parse, filt)
+        filt = '(type>=val*e)'
+        assert_raises(ldapfilter.Error, parser.parse, filt)
+
+    def test_value_characters(self):
+        parser = self.parser()
+        res = parser.parse('(member=cn=a&b,dc=c)')
+        assert isinstance(res, ldapfilter.EQUALS)
+        assert res.value == 'cn=a&b,dc=c'
+
+    def test_substring(self):
+        parser = self.parser()
+        res = parser.parse('(cn=jo*n*)')
+        assert res == ldapfilter.SUBSTRING('cn', 'jo', ('n',), None)
+        res = parser.parse('(cn=*a*b*c)')
+        assert res == ldapfilter.SUBSTRING('cn', None, ('a', 'b'), 'c')
+        res = parser.parse('(cn=a*)')
+        assert res == ldapfilter.SUBSTRING('cn', 'a', (), None)
+        res = parser.parse(r'(cn=\2a*\28)')
+        assert res == ldapfilter.SUBSTRING('cn', '*', (), '(')
+
+    def test_error_substring(self):
+        parser = self.parser()
+        assert_raises(ldapfilter.Error, parser.parse, '(cn=a**b)')
+        assert_raises(ldapfilter.Error, parser.parse, '(cn=**)')
+
+    def test_extensible(self):
+        parser = self.parser()
+        res = parser.parse('(memberOf:1.2.840.113556.1.4.1941:=cn=g,dc=x)')
+        assert res == ldapfilter.EXTENSIBLE('memberOf',
+                        '1.2.840.113556.1.4.1941', 'cn=g,dc=x', False)
+        res = parser.parse('(cn:dn:2.4.6.8.10:=Dino)')
+        assert res == ldapfilter.EXTENSIBLE('cn', '2.4.6.8.10', 'Dino', True)
+        res = parser.parse('(:DN:2.4.6.8.10:=Dino)')
+        assert res == ldapfilter.EXTENSIBLE(None, '2.4.6.8.10', 'Dino', True)
+        res = parser.parse('(:1.2.3:=x)')
+        assert res == ldapfilter.EXTENSIBLE(None, '1.2.3', 'x', False)
+        res = parser.parse('(cn:=x)')
+        assert res == ldapfilter.EXTENSIBLE('cn', None, 'x', False)
+
+    def test_error_extensible(self):
+        parser = self.parser()
+        assert_raises(ldapfilter.Error, parser.parse, '(:=x)')
+        assert_raises(ldapfilter.Error, parser.parse, '(:dn:=x)')
+        assert_raises(ldapfilter.Error, parser.parse, '(cn:1:2:=x)')
+        assert_raises(ldapfilter.Error, parser.parse, '(cn:1.2:=x*)')
+
+
+class TestLDAPFilterCache(object):
+    """Test suite for ad.protocol.ldapfilter.Cache."""
+
+    def test_hit(self):
+        cache = ldapfilter.Cache()
+        res1 = cache.parse('(type=value)')
+        res2 = cache.parse('(type=value)')
+        assert res1 is res2
+        info = cache.info()
+        assert info['hits'] == 1
+        assert info['misses'] == 1
+        assert info['size'] == 1
+
+    def test_eviction(self):
+        cache = ldapfilter.Cache(maxsize=2)
+        res1 = cache.parse('(a=1)')
+        cache.parse('(b=2)')
+        assert cache.parse('(a=1)') is res1
+        cache.parse('(c=3)')  # evicts (b=2)
+        assert cache.info()['size'] == 2
+        assert cache.parse('(a=1)') is res1
+        cache.parse('(b=2)')
+        info = cache.info()
+        assert info['hits'] == 2
+        assert info['misses'] == 4
+
+    def test_clear(self):
+        cache = ldapfilter.Cache()
+        cache.parse('(a=1)')
+        cache.clear()
+        assert cache.info() == { 'hits': 0, 'misses': 0, 'size': 0,
+                                 'maxsize': cache.m_maxsize }
+
+    def test_error_not_cached(self):
+        cache = ldapfilter.Cache()
+        assert_raises(ldapfilter.Error, cache.parse, '(type=')
+        assert_raises(ldapfilter.Error, cache.parse, '(type=')
+        assert cache.info()['size'] == 0
+
+    def test_shared_cache(self):
+        res = ldapfilter.parse('(shared=value)')
+        assert ldapfilter.parse('(shared=value)') is res
+        assert ldapfilter.cache_info()['hits'] >= 1
+
+
+class TestLDAPFilterTemplate(object):
+    """Test suite for ad.protocol.ldapfilter.Template."""
+
+    def test_format(self):
+        tmpl = ldapfilter.Template('(&(objectClass=user)(cn=?)(!(sn>=?)))')
+        assert tmpl.nparams() == 2
+        filt = tmpl.format('foo', 'bar')
+        assert filt == '(&(objectClass=user)(cn=foo)(!(sn>=bar)))'
+
+    def test_escape(self):
+        assert ldapfilter.escape('a*b') == r'a\2ab'
+        assert ldapfilter.escape('(\\)') == r'\28\5c\29'
+        assert ldapfilter.escape('\x00') == r'\00'
+        tmpl = ldapfilter.Template('(cn=?)')
+        filt = tmpl.format('*)(objectClass=*')
+        res = ldapfilter.Parser().parse(filt)
+        assert isinstance(res, ldapfilter.EQUALS)
+        assert res.value == '*)(objectClass=*'
+
+    def test_bind(self):
+        tmpl = ldapfilter.Template('(|(cn=?)(sn~=?)(cn=*)(x<=\\3f))')
+        res = tmpl.bind('a*', 'b')
+        assert res == ldapfilter.Parser().parse(tmpl.format('a*', 'b'))
+        assert res.terms[0].value == 'a*'
+        assert res.terms[3].value == '?'
+        assert isinstance(tmpl.filter().terms[0].value, ldapfilter.PARAM)
+
+    def test_error_params(self):
+        tmpl = ldapfilter.Template('(&(cn=?)(sn=?))')
+        assert_raises(ldapfilter.Error, tmpl.format, 'foo')
+        assert_raises(ldapfilter.Error, tmpl.bind, 'foo', 'bar', 'baz')
+        assert_raises(ldapfilter.Error, tmpl.bind, 'foo', 1)
+
+    def test_error_template(self):
+        assert_raises(ldapfilter.Error, ldapfilter.Template, '(cn=?')
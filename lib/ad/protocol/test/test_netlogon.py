@@ -7,12 +7,16 @@
 # "AUTHORS" for a complete overview.
 
 import os.path
+import time
 import signal
+import socket
+import select
 import dns.resolver
 
 from threading import Timer
 from nose.tools import assert_raises
 from ad.test.base import BaseTest
+from ad.test.cldap import FakeServer
 from ad.protocol import netlogon
 
 
@@ -248,3 +252,137 @@ class TestClient(BaseTest):
         t = Timer(3, self.remove_network_blocks); t.start()
         result = client.call()
         assert len(result) == len(addrs)
+
+
+class TestFakeClient(BaseTest):
+    """Test suite for netlogon.Client against a local fake server."""
+
+    def _start_server(self, nports, drop=0):
+        fname = os.path.join(self.basedir(), 'lib/ad/protocol/test',
+                             'netlogon.bin')
+        fin = file(fname)
+        reply = fin.read()
+        fin.close()
+        server = FakeServer(reply, nports, drop)
+        server.start()
+        return server
+
+    def test_call(self):
+        server = self._start_server(3)
+        addrs = server.addresses()
+        try:
+            client = netlogon.Client()
+            for addr in addrs:
+                client.query(addr, 'FREEADI.ORG')
+            result = client.call(timeout=1)
+        finally:
+            server.stop()
+        assert len(result) == 3
+        replied = [ (res.q_hostname, res.q_port) for res in result ]
+        assert sorted(replied) == sorted(addrs)
+        for res in result:
+            assert res.domain == 'freeadi.org'
+            assert res.q_domain == 'FREEADI.ORG'
+
+    def test_event_loop(self):
+        server = self._start_server(3)
+        try:
+            client = netlogon.Client()
+            for addr in server.addresses():
+                client.query(addr, 'FREEADI.ORG')
+            client.start(timeout=1)
+            result = []
+            while not client.done():
+                select.select([client], [], [], client.timeleft())
+                result += client.process()
+            client.close()
+        finally:
+            server.stop()
+        assert len(result) == 3
+
+    def test_retry(self):
+        server = self._start_server(2, drop=1)
+        try:
+            client = netlogon.Client()
+            for addr in server.addresses():
+                client.query(addr, 'FREEADI.ORG')
+            result = client.call(timeout=0.2, retries=2)
+        finally:
+            server.stop()
+        assert len(result) == 2
+
+    def test_ping_many_want(self):
+        server = self._start_server(2)
+        # An address that never replies.
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        addrs = server.addresses() + [sock.getsockname()]
+        try:
+            begin = time.time()
+            result = netlogon.ping_many(addrs, 'FREEADI.ORG', timeout=30,
+                                        retries=1, want=2)
+            end = time.time()
+        finally:
+            server.stop()
+            sock.close()
+        assert len(result) == 2
+        # Returned without waiting for the silent address to time out.
+        assert end - begin < 10
+
+    def test_call_predicate(self):
+        server = self._start_server(3)
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(('127.0.0.1', 0))
+        addrs = server.addresses()
+        good = addrs[1]
+        try:
+            client = netlogon.Client()
+            for addr in addrs + [sock.getsockname()]:
+                client.query(addr, 'FREEADI.ORG')
+            begin = time.time()
+            result = client.call(timeout=30, retries=1, want=1,
+                                 predicate=lambda r: r.q_address == good)
+            end = time.time()
+        finally:
+            server.stop()
+            sock.close()
+        assert good in [ res.q_address for res in result ]
+        # Returned without waiting for the silent address to time out.
+        assert end - begin < 10
+
+    def test_resolve(self):
+        server = self._start_server(2)
+        addrs = server.addresses()
+        try:
+            client = netlogon.Client()
+            for addr in addrs:
+                client.query(('localhost', addr[1]), 'FREEADI.ORG')
+            client.query(('nonexistent.invalid', 389), 'FREEADI.ORG')
+            result = client.call(timeout=1, retries=1)
+        finally:
+            server.stop()
+        assert len(result) == 2
+        for res in result:
+            assert res.q_hostname == 'localhost'
+            assert res.q_address in addrs
+
+    def test_address_hint(self):
+        server = self._start_server(2)
+        addrs = server.addresses()
+        try:
+            client = netlogon.Client()
+            for i in range(len(addrs)):
+                client.query(('dc%d.freeadi.org.' % i, addrs[i][1]),
+                             'FREEADI.ORG', address=addrs[i][0])
+            result = client.call(timeout=1)
+        finally:
+            server.stop()
+        assert len(result) == 2
+        names = [ res.q_hostname for res in result ]
+        assert sorted(names) == ['dc0.freeadi.org.', 'dc1.freeadi.org.']
+
+    def test_error_not_started(self):
+        client = netlogon.Client()
+        assert_raises(netlogon.Error, client.fileno)
+        assert_raises(netlogon.Error, client.process)
+        assert_raises(netlogon.Error, client.done)
@@ -0,0 +1,66 @@
+#
+# This file is part of Python-AD. Python-AD is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
+# "AUTHORS" for a complete overview.
+
+"""Benchmark search result prefetching against a local stub LDAP server.
+
+Usage: python -m ad.test.benchmark [pages [entries [delay]]]
+
+The server answers each page after `delay' seconds, and the consumer
+spends the same time on each page. The throughput is printed for a
+number of prefetch depths.
+"""
+
+import sys
+import time
+
+from ad.core.client import Client
+from ad.core.locate import Locator
+from ad.test.paged import PagedSearchServer, PagedConnection
+
+
+def search(server, prefetch, entries, delay):
+    """Run one paged search with `prefetch' and return the number of
+    entries and the elapsed time."""
+    client = Client('freeadi.org')
+    client.m_locator = Locator()
+    client.m_naming_contexts = ['dc=freeadi,dc=org']
+    client._open_ldap_connection = \
+            lambda nc, srv, scheme: PagedConnection(server.address())
+    begin = time.time()
+    count = 0
+    for dn, attrs in client.search_iter(base='dc=freeadi,dc=org',
+                                        prefetch=prefetch):
+        count += 1
+        if count % entries == 0:
+            time.sleep(delay)  # process a page
+    elapsed = time.time() - begin
+    client.close()
+    return count, elapsed
+
+
+def main(args):
+    pages, entries, delay = 20, 500, 0.02
+    if len(args) > 0:
+        pages = int(args[0])
+    if len(args) > 1:
+        entries = int(args[1])
+    if len(args) > 2:
+        delay = float(args[2])
+    server = PagedSearchServer(pages, entries, delay)
+    server.start()
+    try:
+        for prefetch in (0, 1, 2):
+            count, elapsed = search(server, prefetch, entries, delay)
+            print 'prefetch=%d: %d entries in %.3fs, %.0f entries/s' % \
+                    (prefetch, count, elapsed, count / elapsed)
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,69 @@
+#
+# This file is part of Python-AD. Python-AD is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
+# "AUTHORS" for a complete overview.
+
+import socket
+import select
+import threading
+
+from ad.protocol import asn1, ldap
+
+
+class FakeServer(threading.Thread):
+    """A fake CLDAP server that answers Netlogon queries on a number of
+    local UDP ports. The first `drop' queries to each port are ignored."""
+
+    def __init__(self, reply, nports, drop=0):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.m_reply = reply
+        self.m_sockets = []
+        self.m_dropped = {}
+        self.m_drop = drop
+        for i in range(nports):
+            sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.bind(('127.0.0.1', 0))
+            self.m_sockets.append(sock)
+        self.m_stop = threading.Event()
+
+    def addresses(self):
+        return [ sock.getsockname() for sock in self.m_sockets ]
+
+    def run(self):
+        client = ldap.Client()
+        while not self.m_stop.isSet():
+            readable = select.select(self.m_sockets, [], [], 0.05)[0]
+            for sock in readable:
+                data, addr = sock.recvfrom(8192)
+                dropped = self.m_dropped.get(sock, 0)
+                if dropped < self.m_drop:
+                    self.m_dropped[sock] = dropped + 1
+                    continue
+                msgid, opcode = client.parse_message_header(data)
+                encoder = asn1.Encoder()
+                encoder.start()
+                encoder.enter(asn1.Sequence)
+                encoder.write(msgid)
+                encoder.enter(4, asn1.ClassApplication)
+                encoder.write('')
+                encoder.enter(asn1.Sequence)
+                encoder.enter(asn1.Sequence)
+                encoder.write('netlogon')
+                encoder.enter(asn1.Set)
+                encoder.write(self.m_reply)
+                encoder.leave()
+                encoder.leave()
+                encoder.leave()
+                encoder.leave()
+                encoder.leave()
+                sock.sendto(encoder.output(), addr)
+
+    def stop(self):
+        self.m_stop.set()
+        self.join()
+        for sock in self.m_sockets:
+            sock.close()
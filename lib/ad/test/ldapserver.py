@@ -0,0 +1,191 @@
+#
+# This file is part of Python-AD. Python-AD is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
+# "AUTHORS" for a complete overview.
+
+import socket
+import select
+import threading
+
+from ad.protocol import asn1, ldap
+
+
+def encode_entry(msgid, dn, attrs):
+    """Encode a SearchResultEntry. `attrs' is a list of (type, values)
+    tuples."""
+    encoder = asn1.Encoder()
+    encoder.start()
+    encoder.enter(asn1.Sequence)
+    encoder.write(msgid)
+    encoder.enter(ldap.SEARCH_RESULT_ENTRY, asn1.ClassApplication)
+    encoder.write(dn)
+    encoder.enter(asn1.Sequence)
+    for type, values in attrs:
+        encoder.enter(asn1.Sequence)
+        encoder.write(type)
+        encoder.enter(asn1.Set)
+        for value in values:
+            encoder.write(value)
+        encoder.leave()
+        encoder.leave()
+    encoder.leave()
+    encoder.leave()
+    encoder.leave()
+    return encoder.output()
+
+
+def encode_result(msgid, op, code=0, message='', name=None, value=None,
+                  controls=None):
+    """Encode a response with protocol operation `op'. For an extended
+    response, `name' and `value' are the response name and value.
+    `controls' is a list of (oid, critical, value) tuples."""
+    encoder = asn1.Encoder()
+    encoder.start()
+    encoder.enter(asn1.Sequence)
+    encoder.write(msgid)
+    encoder.enter(op, asn1.ClassApplication)
+    encoder.write(code, asn1.Enumerated)
+    encoder.write('')
+    encoder.write(message)
+    if name is not None:
+        encoder.write(name, 10, asn1.TypePrimitive, asn1.ClassContext)
+    if value is not None:
+        encoder.write(value, 11, asn1.TypePrimitive, asn1.ClassContext)
+    encoder.leave()
+    if controls:
+        encoder.enter(0, asn1.ClassContext)
+        for oid, critical, value in controls:
+            encoder.enter(asn1.Sequence)
+            encoder.write(oid)
+            if critical:
+                encoder.write(True, asn1.Boolean)
+            if value is not None:
+                encoder.write(value)
+            encoder.leave()
+        encoder.leave()
+    encoder.leave()
+    return encoder.output()
+
+
+def encode_paged_value(size, cookie):
+    """Encode the value of a paged results control."""
+    encoder = asn1.Encoder()
+    encoder.start()
+    encoder.enter(asn1.Sequence)
+    encoder.write(size)
+    encoder.write(cookie)
+    encoder.leave()
+    return encoder.output()
+
+
+def decode_paged_value(value):
+    """Decode the value of a paged results control into a tuple (size,
+    cookie)."""
+    decoder = asn1.Decoder()
+    decoder.start(value)
+    decoder.enter()
+    size = decoder.read()[1]
+    cookie = decoder.read()[1]
+    return size, cookie
+
+
+class Request(object):
+    """A decoded request: `msgid', `op' and `dn', the first string of the
+    request if there is one."""
+
+    def __init__(self, buffer):
+        decoder = asn1.Decoder()
+        decoder.start(buffer)
+        decoder.enter()
+        self.msgid = decoder.read()[1]
+        tag = decoder.peek()
+        self.op = tag[0]
+        self.dn = None
+        if tag[1] == asn1.TypeConstructed:
+            decoder.enter()
+            if self.op == ldap.BIND_REQUEST:
+                decoder.read()  # version
+            self.dn = decoder.read()[1]
+        elif self.op == ldap.DEL_REQUEST:
+            self.dn = decoder.read()[1]
+
+
+class FakeServer(threading.Thread):
+    """A fake LDAP server on a local TCP port.
+
+    The function `respond' is called for each request with a Request
+    instance and returns a list of encoded response messages. Requests are
+    answered in batches of `batch', in reverse order, to exercise message
+    ID matching. Unbind and abandon requests are counted but not answered.
+    """
+
+    def __init__(self, respond, batch=1):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.m_respond = respond
+        self.m_batch = batch
+        self.m_listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.m_listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.m_listener.bind(('127.0.0.1', 0))
+        self.m_listener.listen(5)
+        self.m_address = self.m_listener.getsockname()
+        self.m_clients = {}
+        self.m_stop = threading.Event()
+        self.m_disconnect = threading.Event()
+        self.requests = []
+        self.connections = 0
+
+    def address(self):
+        return self.m_address
+
+    def run(self):
+        while not self.m_stop.isSet():
+            if self.m_disconnect.isSet():
+                self._close_clients()
+                self.m_disconnect.clear()
+            sockets = [self.m_listener] + self.m_clients.keys()
+            readable = select.select(sockets, [], [], 0.05)[0]
+            for sock in readable:
+                if sock is self.m_listener:
+                    conn, addr = sock.accept()
+                    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                    self.m_clients[conn] = (ldap.StreamDecoder(), [])
+                    self.connections += 1
+                    continue
+                data = sock.recv(65536)
+                if not data:
+                    del self.m_clients[sock]
+                    sock.close()
+                    continue
+                decoder, pending = self.m_clients[sock]
+                for buffer in decoder.feed(data):
+                    request = Request(buffer)
+                    self.requests.append(request)
+                    if request.op in (ldap.UNBIND_REQUEST,
+                                      ldap.ABANDON_REQUEST):
+                        continue
+                    pending.append(request)
+                if len(pending) >= self.m_batch:
+                    pending.reverse()
+                    for request in pending:
+                        for response in self.m_respond(request):
+                            sock.sendall(response)
+                    del pending[:]
+
+    def disconnect(self):
+        """Close all client connections."""
+        self.m_disconnect.set()
+
+    def stop(self):
+        self.m_stop.set()
+        self.join()
+        self._close_clients()
+        self.m_listener.close()
+
+    def _close_clients(self):
+        for sock in self.m_clients.keys():
+            del self.m_clients[sock]
+            sock.close()
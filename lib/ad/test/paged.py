@@ -0,0 +1,76 @@
+#
+# This file is part of Python-AD. Python-AD is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
+# "AUTHORS" for a complete overview.
+
+import time
+import ldap
+import ldap.controls
+
+from ad.protocol.ldap import Connection as LDAPConnection, \
+        SEARCH_REQUEST, SEARCH_RESULT_DONE
+from ad.test.ldapserver import FakeServer, encode_entry, encode_result, \
+        encode_paged_value, decode_paged_value
+
+
+class PagedSearchServer(FakeServer):
+    """A fake LDAP server that answers every search with the next one of
+    `pages' pages of `entries' entries, after `delay' seconds. The number
+    of search requests received is available as `searches'."""
+
+    def __init__(self, pages, entries, delay=0):
+        FakeServer.__init__(self, self._respond)
+        self.m_pages = pages
+        self.m_entries = entries
+        self.m_delay = delay
+        self.searches = 0
+
+    def _respond(self, request):
+        if request.op != SEARCH_REQUEST:
+            return []
+        if self.m_delay:
+            time.sleep(self.m_delay)
+        page = self.searches % self.m_pages
+        self.searches += 1
+        result = [ encode_entry(request.msgid, 'cn=%d-%d,%s' %
+                                (page, i, request.dn), [('cn', [str(i)])])
+                   for i in range(self.m_entries) ]
+        cookie = page < self.m_pages - 1 and str(page + 1) or ''
+        control = (ldap.LDAP_CONTROL_PAGE_OID, False,
+                   encode_paged_value(self.m_entries, cookie))
+        result.append(encode_result(request.msgid, SEARCH_RESULT_DONE,
+                                    controls=[control]))
+        return result
+
+
+class PagedConnection(object):
+    """The part of a python-ldap connection that is used for paged
+    searches, implemented on top of ad.protocol.ldap."""
+
+    def __init__(self, address):
+        self.m_conn = LDAPConnection(address[0], address[1])
+        self.m_conn.connect()
+        self.m_operations = {}
+
+    def search_ext(self, base, scope, filter, attrs, serverctrls):
+        ctrl = serverctrls[0]
+        value = encode_paged_value(*ctrl.controlValue)
+        op = self.m_conn.search(base, scope, filter, attrs,
+                                controls=[(ctrl.controlType, ctrl.criticality,
+                                           value)])
+        self.m_operations[op.msgid] = op
+        return op.msgid
+
+    def result3(self, msgid):
+        op = self.m_operations.pop(msgid)
+        entries = op.result()
+        ctrls = [ ldap.controls.SimplePagedResultsControl(oid, critical,
+                        decode_paged_value(value))
+                  for oid, critical, value in op.response.controls ]
+        return ldap.RES_SEARCH_RESULT, entries, msgid, ctrls
+
+    def unbind_s(self):
+        self.m_conn.close()
@@ -0,0 +1,106 @@
+#
+# This file is part of Python-AD. Python-AD is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
+# "AUTHORS" for a complete overview.
+
+import time
+import threading
+
+
+class LRUCache(object):
+    """A bounded, thread-safe cache that evicts the least recently used
+    entry when it holds more than `maxsize' entries.
+
+    An entry can have an absolute expiration time, after which it is no
+    longer returned.
+    """
+
+    _maxsize = 1000
+
+    def __init__(self, maxsize=None):
+        """Constructor."""
+        if maxsize is None:
+            maxsize = self._maxsize
+        self.m_maxsize = maxsize
+        self.m_lock = threading.Lock()
+        self.m_entries = {}
+        # Circular doubly linked list of [prev, next, key, value, expires]
+        # in order of use. The root is the sentinel; root[1] is the least
+        # recently used entry.
+        self.m_root = []
+        self.m_root[:] = [self.m_root, self.m_root, None, None, None]
+        self.m_hits = 0
+        self.m_misses = 0
+
+    def get(self, key):
+        """Return a tuple (found, value) for `key'."""
+        self.m_lock.acquire()
+        try:
+            link = self.m_entries.get(key)
+            if link is None:
+                self.m_misses += 1
+                return False, None
+            self._unlink(link)
+            if link[4] is not None and link[4] <= time.time():
+                del self.m_entries[key]
+                self.m_misses += 1
+                return False, None
+            self._append(link)
+            self.m_hits += 1
+            return True, link[3]
+        finally:
+            self.m_lock.release()
+
+    def put(self, key, value, expires=None):
+        """Store `value' under `key', until time `expires' if given."""
+        self.m_lock.acquire()
+        try:
+            link = self.m_entries.get(key)
+            if link is not None:
+                self._unlink(link)
+            link = [None, None, key, value, expires]
+            self._append(link)
+            self.m_entries[key] = link
+            if len(self.m_entries) > self.m_maxsize:
+                oldest = self.m_root[1]
+                self._unlink(oldest)
+                del self.m_entries[oldest[2]]
+        finally:
+            self.m_lock.release()
+
+    def clear(self):
+        """Remove all entries and reset the statistics."""
+        self.m_lock.acquire()
+        try:
+            self.m_entries.clear()
+            self.m_root[:] = [self.m_root, self.m_root, None, None, None]
+            self.m_hits = 0
+            self.m_misses = 0
+        finally:
+            self.m_lock.release()
+
+    def info(self):
+        """Return a dictionary with cache statistics."""
+        self.m_lock.acquire()
+        try:
+            return { 'hits': self.m_hits, 'misses': self.m_misses,
+                     'size': len(self.m_entries), 'maxsize': self.m_maxsize }
+        finally:
+            self.m_lock.release()
+
+    def _unlink(self, link):
+        """Remove `link' from the list."""
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        """Insert `link' as the most recently used entry."""
+        last = self.m_root[0]
+        link[0] = last
+        link[1] = self.m_root
+        last[1] = link
+        self.m_root[0] = link
@@ -8,8 +8,7 @@
 
 import sys
 import os.path
-
-from ply import lex, yacc
+import threading
 
 
 class Parser(object):
@@ -28,21 +27,46 @@ class Parser(object):
 
     def _write_parsetab(cls):
         """Write parser table (distribution purposes)."""
+        from ply import yacc
         parser = cls()
         tabname = cls._parsetab_name(False)
         yacc.yacc(module=parser, debug=0, tabmodule=tabname)
 
     _write_parsetab = classmethod(_write_parsetab)
 
+    _local = threading.local()
+
+    def _compiled(self):
+        """Return a (worker, lexer, parser) tuple for our class.
+
+        Creating a PLY lexer and parser is expensive, so this is done only
+        once per class. PLY parsers are not reentrant and the grammar actions
+        are bound to the instance that created them, so the result is cached
+        per thread. The instance that created the parser is returned as the
+        worker; it carries the per-parse state.
+        """
+        try:
+            cache = self._local.cache
+        except AttributeError:
+            cache = self._local.cache = {}
+        cls = type(self)
+        if cls not in cache:
+            # Import PLY only when it is needed.
+            from ply import lex, yacc
+            lexer = lex.lex(object=self)
+            parser = yacc.yacc(module=self, debug=0,
+                               tabmodule=self._parsetab_name())
+            cache[cls] = (self, lexer, parser)
+        return cache[cls]
+
     def parse(self, input, fname=None):
-        lexer = lex.lex(object=self)
+        worker, lexer, parser = self._compiled()
+        lexer = lexer.clone()
         if hasattr(input, 'read'):
             input = input.read()
         lexer.input(input)
-        self.m_input = input
-        self.m_fname = fname
-        parser = yacc.yacc(module=self, debug=0,
-                           tabmodule=self._parsetab_name())
+        worker.m_input = input
+        worker.m_fname = fname
         parsed = parser.parse(lexer=lexer, tracking=True)
         return parsed
 
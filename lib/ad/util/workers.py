@@ -0,0 +1,84 @@
+#
+# This file is part of Python-AD. Python-AD is free software that is made
+# available under the MIT license. Consult the file "LICENSE" that is
+# distributed together with this file for the exact licensing terms.
+#
+# Python-AD is copyright (c) 2007 by the Python-AD authors. See the file
+# "AUTHORS" for a complete overview.
+
+import sys
+import Queue
+import threading
+
+
+class WorkerPool(object):
+    """Call functions in up to `size' daemon threads.
+
+    Threads are started when work is submitted and exit as soon as there
+    is no more work, so an idle pool has no threads. The pool can be used
+    by multiple threads at the same time.
+    """
+
+    def __init__(self, size):
+        """Constructor."""
+        if size < 1:
+            raise ValueError, 'Illegal pool size: %s' % size
+        self.m_size = size
+        self.m_lock = threading.Lock()
+        self.m_work = Queue.Queue()
+        self.m_threads = 0
+
+    def submit(self, results, func, *args):
+        """Call func(*args) in a worker thread. When it returns, the tuple
+        (args, result, error) is put on the Queue `results'. The error is
+        None, or an exc_info() tuple if the function raised an
+        exception."""
+        self.m_work.put((results, func, args))
+        self.m_lock.acquire()
+        try:
+            if self.m_threads >= self.m_size:
+                return
+            self.m_threads += 1
+        finally:
+            self.m_lock.release()
+        thread = threading.Thread(target=self._run)
+        thread.setDaemon(True)
+        thread.start()
+
+    def map(self, func, items):
+        """Return [ func(item) for item in items ], with the calls running
+        concurrently. If a call raises an exception, it is re-raised once
+        all calls have finished."""
+        if len(items) <= 1:
+            return map(func, items)
+        results = Queue.Queue()
+        for i in range(len(items)):
+            self.submit(results, lambda i: func(items[i]), i)
+        values = [None] * len(items)
+        errors = []
+        for i in range(len(items)):
+            args, value, error = results.get()
+            values[args[0]] = value
+            if error is not None:
+                errors.append(error)
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        return values
+
+    def _run(self):
+        """Worker thread: call functions until there is no more work."""
+        while True:
+            self.m_lock.acquire()
+            try:
+                try:
+                    results, func, args = self.m_work.get_nowait()
+                except Queue.Empty:
+                    self.m_threads -= 1
+                    return
+            finally:
+                self.m_lock.release()
+            try:
+                value, error = func(*args), None
+            except Exception:
+                value, error = None, sys.exc_info()
+            results.put((args, value, error))